@@ -0,0 +1,99 @@
+"""
+Compare the ways of processing a raw dataset chunk into its collated tensors.
+
+- `sample`: `transform_data` applied to every snapshot and the `Data` list
+  collated, the `process` of a dataset given `transform=transform_data`;
+- `batch`: `transform_columns`, the whole chunk from its column arrays (the
+  default).
+
+Each method runs in a fresh process, whose peak resident memory above the one
+after reading the chunk is reported (from `/proc`, so on Linux only).
+
+```bash
+python benchmarks/dataset_process.py --chunk qm9star_dataset/raw/qm9star_full_chunk00
+```
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import time
+
+from torch_geometric.data import InMemoryDataset
+
+from qm9star_query.dataset.base_dataset import transform_columns, transform_data
+from qm9star_query.dataset.columnar import chunk_length, iter_records, load_columns
+
+
+def process_sample(columns):
+    return InMemoryDataset.collate(
+        [transform_data(record) for record in iter_records(columns)]
+    )
+
+
+def process_batch(columns):
+    return transform_columns(columns)
+
+
+methods = {"sample": process_sample, "batch": process_batch}
+
+
+def rss_mb(field: str) -> float:
+    # `VmRSS` (current) or `VmHWM` (peak) resident memory, Linux only
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def reset_peak_rss() -> None:
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def digest(data, slices) -> dict[str, str]:
+    return {
+        key: hashlib.sha256(
+            data[key].numpy().tobytes() + slices[key].numpy().tobytes()
+        ).hexdigest()
+        for key in data.keys()
+    }
+
+
+def run(name: str, chunk: str, queue: multiprocessing.Queue) -> None:
+    # read the whole chunk first, so its pages count in the baseline
+    columns = {key: array.copy() for key, array in load_columns(chunk).items()}
+    reset_peak_rss()
+    baseline = rss_mb("VmRSS")
+    start = time.perf_counter()
+    data, slices = methods[name](columns)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, rss_mb("VmHWM") - baseline, digest(data, slices)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunk", required=True, help="a raw chunk directory")
+    args = parser.parse_args()
+
+    count = chunk_length(load_columns(args.chunk))
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in methods:
+        queue = context.Queue()
+        process = context.Process(target=run, args=(name, args.chunk, queue))
+        process.start()
+        elapsed, peak, digests = queue.get()
+        process.join()
+        results[name] = digests
+        print(
+            f"{name:8s} {elapsed:8.2f} s, {count / elapsed:10.0f} snapshots/s, "
+            f"peak +{peak:8.1f} MB"
+        )
+
+    print(f"same tensors: {results['sample'] == results['batch']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compare an epoch of `DimeNetPPCM` with and without a cached topology.
+
+- `online`: the radius graph and its triplets computed for every batch
+  (`radius_graph`, `xyz_to_dat`), the default;
+- `cached`: both read from the graphs, stored once by the `DimeNetTopology`
+  pre-transform, `DimeNetPPCM(cached_topology=True)`.
+
+An epoch is the forward and backward pass of an energy loss (plus a force loss, the
+forces being the gradients of the energy, with `--forces`) over every batch. The
+one-off time of the pre-transform is reported too.
+Needs the `dl` extra (`poetry install -E dl`).
+
+```bash
+python benchmarks/dimenet_topology.py --chunk qm9star_dataset/raw/qm9star_full_chunk00 \
+    --limit 20000 --forces
+```
+"""
+
+import argparse
+import time
+
+import torch
+from torch_geometric.data.separate import separate
+from torch_geometric.loader import DataLoader
+
+from qm9star_query.dataset.base_dataset import transform_columns
+from qm9star_query.dataset.columnar import load_columns, slice_columns
+from qm9star_query.dataset.topology import DimeNetTopology
+from qm9star_query.nn.dimenetpp import DimeNetPPCM
+
+
+def load_graphs(chunk: str, limit: int) -> list:
+    columns = load_columns(chunk)
+    data, slices = transform_columns(slice_columns(columns, 0, limit))
+    graphs = []
+    for idx in range(len(slices["pos"]) - 1):
+        graph = separate(
+            cls=data.__class__, batch=data, idx=idx, slice_dict=slices, decrement=False
+        )
+        graph.nxyz = torch.cat([graph.z.view(-1, 1), graph.pos], dim=-1)
+        graphs.append(graph)
+    return graphs
+
+
+def run_epoch(model, loader, forces: bool, device: str) -> tuple[float, list]:
+    energies = []
+    start = time.perf_counter()
+    for batch in loader:
+        batch = batch.to(device)
+        results = model(batch)
+        loss = results["energy"].view(-1).sub(batch.energy).abs().mean()
+        if forces:
+            loss = loss + results["energy_grad"].sub(batch.energy_grad).abs().mean()
+        loss.backward()
+        energies.append(results["energy"].detach().cpu())
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return time.perf_counter() - start, energies
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--chunk", required=True, help="a raw chunk directory")
+    parser.add_argument("--limit", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=192)
+    parser.add_argument("--cutoff", type=float, default=5.0)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--forces", action="store_true")
+    parser.add_argument(
+        "--device", default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    graphs = load_graphs(args.chunk, args.limit)
+    start = time.perf_counter()
+    topology = DimeNetTopology(cutoff=args.cutoff)
+    cached_graphs = [topology(graph) for graph in graphs]
+    print(
+        f"pre-transform {time.perf_counter() - start:8.2f} s for {len(graphs)} graphs "
+        "(once per dataset)"
+    )
+
+    torch.manual_seed(0)
+    online = DimeNetPPCM(
+        energy_and_force=args.forces, cutoff=args.cutoff, ret_res_dict=True
+    ).to(args.device)
+    cached = DimeNetPPCM(
+        energy_and_force=args.forces,
+        cutoff=args.cutoff,
+        ret_res_dict=True,
+        cached_topology=True,
+    ).to(args.device)
+    cached.load_state_dict(online.state_dict())
+
+    energies = {}
+    for name, model, dataset in [
+        ("online", online, graphs),
+        ("cached", cached, cached_graphs),
+    ]:
+        loader = DataLoader(dataset, args.batch_size, shuffle=False)
+        # the first epoch warms up the allocator and kernels
+        for epoch in range(args.epochs):
+            elapsed, energies[name] = run_epoch(model, loader, args.forces, args.device)
+            print(
+                f"{name:8s} epoch {epoch}: {elapsed:8.2f} s, "
+                f"{len(dataset) / elapsed:8.0f} graphs/s"
+            )
+
+    difference = max(
+        (a - b).abs().max().item()
+        for a, b in zip(energies["online"], energies["cached"])
+    )
+    print(f"max energy difference: {difference:.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+HTTP caching of the single-record endpoints.
+
+Records do not change once committed, so their responses carry a strong `ETag`
+derived from the record version (`hash_token`, `update_time`) and a
+`Cache-Control` max-age. A request whose `If-None-Match` holds the current ETag is
+answered with `304 Not Modified` after reading the version columns only.
+"""
+
+import hashlib
+from typing import Sequence
+
+from fastapi import Request, Response
+
+from qm9star_query.core.config import settings
+
+
+def record_etag(version: str, variant: str | Sequence[str] | None = None) -> str:
+    """
+    The ETag of a record representation: `variant` distinguishes e.g. the SDF block
+    or a sparse fieldset from the full JSON record.
+    """
+    if variant is not None and not isinstance(variant, str):
+        variant = ",".join(sorted(set(variant)))
+    digest = hashlib.sha256(f"{version}|{variant or ''}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def cache_headers(etag: str) -> dict[str, str]:
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={settings.RECORD_CACHE_MAX_AGE}",
+    }
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        # `If-None-Match` uses the weak comparison
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(headers: dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
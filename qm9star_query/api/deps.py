@@ -1,16 +1,61 @@
-from collections.abc import Generator
-from typing import Annotated
+from collections.abc import AsyncGenerator, Generator
+from typing import Annotated, Literal
 
 from fastapi import Depends
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from qm9star_query.core.config import settings
-from qm9star_query.core.db import engine
+from qm9star_query.core.db import async_engine, engine
+from qm9star_query.crud.counts import count_cache
+from qm9star_query.crud.result_cache import LRUCache, SQLiteCache, set_result_cache
+from qm9star_query.utils import get_rdkit_executor, mol_block_cache
+
+# size the RDKit pool of the async routes before the first request uses it
+get_rdkit_executor(settings.RDKIT_MAX_WORKERS)
+count_cache.ttl = settings.COUNT_CACHE_TTL
+mol_block_cache.maxsize = settings.SDF_CACHE_SIZE
+if settings.RESULT_CACHE == "memory":
+    set_result_cache(LRUCache(max_bytes=settings.RESULT_CACHE_MAX_BYTES))
+elif settings.RESULT_CACHE == "sqlite":
+    set_result_cache(
+        SQLiteCache(
+            settings.RESULT_CACHE_PATH, max_bytes=settings.RESULT_CACHE_MAX_BYTES
+        )
+    )
+else:
+    set_result_cache(None)
+
+
+def get_session_info(kind: Literal["fast", "vector", "export"]) -> dict:
+    """
+    `Session.info` bounding the statements of an endpoint class, applied by
+    `qm9star_query.core.engine` when the transaction begins.
+    """
+    return {"statement_timeout": settings.statement_timeouts[kind]}
 
 
 def get_db() -> Generator[Session, None, None]:
-    with Session(engine) as session:
+    with Session(engine, info=get_session_info("fast")) as session:
         yield session
 
 
+def async_db_dependency(kind: Literal["fast", "vector", "export"]):
+    async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+        # `expire_on_commit=False` keeps loaded rows readable while the response is
+        # serialized, where an expired attribute could not be refreshed without await
+        async with AsyncSession(
+            async_engine, expire_on_commit=False, info=get_session_info(kind)
+        ) as session:
+            yield session
+
+    return get_async_db
+
+
+get_async_db = async_db_dependency("fast")
+get_vector_async_db = async_db_dependency("vector")
+
 SessionDep = Annotated[Session, Depends(get_db)]
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_db)]
+# for the slow endpoints: ordering by fingerprint distance, counting by filters
+VectorSessionDep = Annotated[AsyncSession, Depends(get_vector_async_db)]
@@ -0,0 +1,83 @@
+"""
+Incremental serializers for streaming query results.
+
+Both take an iterator of row batches, as produced by
+`snapshots_crud.stream_snapshots_by_conditions`, and yield bytes as soon as a batch is
+encoded, so a response never holds more than one batch.
+"""
+
+import json
+from datetime import datetime
+from typing import Any, Iterable, Iterator
+
+from sqlalchemy import ARRAY, Boolean, Column, DateTime, Float, Integer
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# end-of-stream marker of the Arrow IPC streaming format
+_ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+
+def _json_default(value: Any):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def ndjson_stream(batches: Iterable[list[dict[str, Any]]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield "".join(
+            json.dumps(row, default=_json_default) + "\n" for row in batch
+        ).encode()
+
+
+def arrow_type(column: Column):
+    column_type = column.type
+    if isinstance(column_type, ARRAY):
+        value_type = arrow_type(Column(column_type.item_type))
+        for _ in range(column_type.dimensions or 1):
+            value_type = pa.list_(value_type)
+        return value_type
+    if isinstance(column_type, Boolean):
+        return pa.bool_()
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def arrow_schema(columns: list[Column]):
+    return pa.schema([pa.field(column.name, arrow_type(column)) for column in columns])
+
+
+def arrow_stream(
+    batches: Iterable[list[dict[str, Any]]], columns: list[Column]
+) -> Iterator[bytes]:
+    """
+    Encode the batches as an Arrow IPC stream, one record batch per row batch.
+
+    The schema is derived from the column types rather than inferred from the first
+    batch, so all-null columns keep their type.
+    """
+    if pa is None:
+        raise ImportError("""
+Arrow export requires pyarrow.
+Please install it following the instructions in README.md.
+```bash
+# cd <root dir of qm9star_query>
+poetry install -E api
+```""")
+    schema = arrow_schema(columns)
+    yield schema.serialize().to_pybytes()
+    for batch in batches:
+        yield pa.RecordBatch.from_pylist(batch, schema=schema).serialize().to_pybytes()
+    yield _ARROW_EOS
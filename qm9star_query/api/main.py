@@ -1,10 +1,11 @@
-'''
+"""
 Author: TMJ
 Date: 2025-02-02 16:35:58
 LastEditors: TMJ
 LastEditTime: 2025-02-02 16:59:48
 Description: 请填写简介
-'''
+"""
+
 from fastapi import APIRouter
 
 from qm9star_query.api.routes import formula, molecules, snapshots, utils
@@ -1,69 +1,107 @@
 import os
 from typing import Any, List, Literal
 
-from qm9star_query.api.deps import SessionDep
+from qm9star_query.api import caching
+from qm9star_query.api.deps import AsyncSessionDep
 from qm9star_query.crud import formulas_crud
 from qm9star_query.models import Formula
 from qm9star_query.models.formula import FormulaOut, FormulasOut
 from qm9star_query.models.utils import ItemCount, FormulaFilter
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
 from sqlmodel import column, func, select
 
 router = APIRouter()
 
 
 @router.get("/{id}", response_model=FormulaOut)
-def read_formula_by_id(session: SessionDep, id: int) -> Any:
+async def read_formula_by_id(
+    session: AsyncSessionDep, request: Request, response: Response, id: int
+) -> Any:
     """
     Get a formula by id
+
+    The response carries an `ETag`; send it back as `If-None-Match` to get a `304`
+    without the payload while the formula is unchanged.
     """
-    formula = formulas_crud.get_formula_by_id(session=session, formula_id=id)
+    version = await formulas_crud.get_formula_version_async(
+        session=session, formula_id=id
+    )
+    if version is None:
+        raise HTTPException(status_code=404, detail="Formula not found")
+    headers = caching.cache_headers(caching.record_etag(version))
+    if caching.etag_matches(request, headers["ETag"]):
+        return caching.not_modified(headers)
+    formula = await formulas_crud.get_formula_by_id_async(
+        session=session, formula_id=id
+    )
     if not formula:
         raise HTTPException(status_code=404, detail="Formula not found")
+    response.headers.update(headers)
     return FormulaOut.model_validate(formula)
 
 
 @router.get("/count/", response_model=ItemCount)
-def read_formulas_count(
-    session: SessionDep,
+async def read_formulas_count(
+    session: AsyncSessionDep,
+    estimate: bool = False,
 ) -> ItemCount:
     """
     Get the number of formulas in the database.
+
+    Counts are cached for a while. With `estimate`, the count is read from the
+    planner statistics instead, which is instant but only as fresh as the last
+    `ANALYZE`.
     """
-    count_statement = select(func.count()).select_from(Formula)
-    count = session.exec(count_statement).one()
-    return ItemCount(count=count)
+    return await formulas_crud.get_formula_count_async(
+        session=session, estimate=estimate
+    )
 
 
 @router.get("/", response_model=FormulasOut)
-def read_formulas(session: SessionDep, skip: int = 0, limit: int = 100) -> Any:
+async def read_formulas(
+    session: AsyncSessionDep, skip: int = 0, limit: int = 100, cursor: str | None = None
+) -> Any:
     """
     Retrieve formulas.
-    """
-    statement = select(Formula).offset(skip).limit(limit)
-    formulas = session.exec(statement).all()
 
-    return FormulasOut(data=formulas, count=len(formulas))
+    Pass the `next_cursor` of a page as `cursor` to fetch the next one, which stays fast
+    deep into the table unlike `skip`.
+    """
+    try:
+        formulas, next_cursor = (
+            await formulas_crud.get_formulas_page_by_conditions_async(
+                session=session, skip=skip, limit=limit, cursor=cursor
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FormulasOut(data=formulas, count=len(formulas), next_cursor=next_cursor)
 
 
 @router.post("/filter/", response_model=FormulasOut)
-def read_formulas_by_filter(
-    session: SessionDep,
+async def read_formulas_by_filter(
+    session: AsyncSessionDep,
     filters: FormulaFilter = None,
     skip: int = 0,
     limit: int = 100,
+    cursor: str | None = None,
 ) -> Any:
     """
-    Retrieve formulas by filter. 
+    Retrieve formulas by filter.
 
-    Detailed filters setting can be found in the schema of `FormulaFilter`.
+    Detailed filters setting can be found in the schema of `FormulaFilter`. Pass the
+    `next_cursor` of a page as `cursor`, with the same filters, to fetch the next one.
     """
-    formulas = formulas_crud.get_formulas_by_conditions(
-        session=session,
-        formula_filter=filters,
-        skip=skip,
-        limit=limit,
-    )
-    return FormulasOut(data=formulas, count=len(formulas))
-
-
+    try:
+        formulas, next_cursor = (
+            await formulas_crud.get_formulas_page_by_conditions_async(
+                session=session,
+                formula_filter=filters,
+                skip=skip,
+                limit=limit,
+                cursor=cursor,
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FormulasOut(data=formulas, count=len(formulas), next_cursor=next_cursor)
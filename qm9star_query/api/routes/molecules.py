@@ -1,75 +1,149 @@
 import os
 from typing import Any, List, Literal
 
-from fastapi import APIRouter, HTTPException
-from rdkit import Chem
+from fastapi import APIRouter, HTTPException, Request, Response
 from sqlmodel import column, func, select
 
-from qm9star_query.api.deps import SessionDep
+from qm9star_query.api import caching
+from qm9star_query.api.deps import AsyncSessionDep, VectorSessionDep
 from qm9star_query.crud import molecules_crud
 from qm9star_query.models import Formula, Molecule
-from qm9star_query.models.molecule import MoleculeOut, MoleculeSDFOut, MoleculesOut
-from qm9star_query.models.utils import ItemCount, MoleculeFilter
+from qm9star_query.models.molecule import (
+    MoleculeNeighboursOut,
+    MoleculeOut,
+    MoleculesBatchOut,
+    MoleculeSDFOut,
+    MoleculesOut,
+)
+from qm9star_query.models.utils import ItemCount, MoleculeFilter, MoleculeSmilesBatch
+from qm9star_query.utils import run_rdkit, smiles_to_mol_block
 
 router = APIRouter()
 
 
 @router.get("/{id}", response_model=MoleculeOut)
-def read_molecule_by_id(session: SessionDep, id: int):
+async def read_molecule_by_id(
+    session: AsyncSessionDep, request: Request, response: Response, id: int
+):
     """
     Get molecule by id
+
+    The response carries an `ETag`; send it back as `If-None-Match` to get a `304`
+    without the payload while the molecule is unchanged.
     """
-    molecule = session.get(Molecule, id)
+    version = await molecules_crud.get_molecule_version_async(
+        session=session, molecule_id=id
+    )
+    if version is None:
+        raise HTTPException(status_code=404, detail="Molecule not found")
+    headers = caching.cache_headers(caching.record_etag(version))
+    if caching.etag_matches(request, headers["ETag"]):
+        return caching.not_modified(headers)
+    molecule = await molecules_crud.get_molecule_by_id_async(
+        session=session, molecule_id=id
+    )
     if not molecule:
         raise HTTPException(status_code=404, detail="Molecule not found")
+    response.headers.update(headers)
     return MoleculeOut.model_validate(molecule)
 
 
 @router.get("/sdf/{id}", response_model=MoleculeSDFOut)
-def read_molecule_sdf_by_id(session: SessionDep, id: int):
+async def read_molecule_sdf_by_id(
+    session: AsyncSessionDep, request: Request, response: Response, id: int
+):
     """
     Get sdf of molecule by id
+
+    The response carries an `ETag`; send it back as `If-None-Match` to get a `304`
+    without the payload while the molecule is unchanged.
     """
-    molecule = session.get(Molecule, id)
+    version = await molecules_crud.get_molecule_version_async(
+        session=session, molecule_id=id
+    )
+    if version is None:
+        raise HTTPException(status_code=404, detail="Molecule not found")
+    headers = caching.cache_headers(caching.record_etag(version, "sdf"))
+    if caching.etag_matches(request, headers["ETag"]):
+        return caching.not_modified(headers)
+    molecule = await molecules_crud.get_molecule_by_id_async(
+        session=session, molecule_id=id
+    )
     if not molecule:
         raise HTTPException(status_code=404, detail="Molecule not found")
+    response.headers.update(headers)
     return MoleculeSDFOut(
         smiles=molecule.smiles,
-        sdf_block=Chem.MolToMolBlock(Chem.MolFromSmiles(molecule.smiles)),
+        sdf_block=await run_rdkit(smiles_to_mol_block, molecule.smiles),
     )
 
 
 @router.get("/count/", response_model=ItemCount)
-def read_molecules_count(
-    session: SessionDep,
+async def read_molecules_count(
+    session: AsyncSessionDep,
+    estimate: bool = False,
 ) -> ItemCount:
     """
     Get the number of molecules in the database.
+
+    Counts are cached for a while. With `estimate`, the count is read from the
+    planner statistics instead, which is instant but only as fresh as the last
+    `ANALYZE`.
+    """
+    return await molecules_crud.get_molecule_count_async(
+        session=session, estimate=estimate
+    )
+
+
+@router.post("/count/filter/", response_model=ItemCount)
+async def read_molecules_count_by_filter(
+    session: VectorSessionDep, filters: MoleculeFilter = None
+) -> ItemCount:
+    """
+    Get the number of molecules matching the filters.
+
+    The SMILES search fields only order results and are ignored here. Counts are
+    cached for a while under the normalized filters.
     """
-    count_statement = select(func.count()).select_from(Molecule)
-    count = session.exec(count_statement).one()
-    return ItemCount(count=count)
+    return await molecules_crud.get_molecule_count_by_conditions_async(
+        session=session, molecule_filter=filters
+    )
 
 
 @router.get("/", response_model=MoleculesOut)
-def read_molecules(session: SessionDep, skip: int = 0, limit: int = 100) -> Any:
+async def read_molecules(
+    session: AsyncSessionDep, skip: int = 0, limit: int = 100, cursor: str | None = None
+) -> Any:
     """
     Retrieve molecules.
-    """
-    statement = select(Molecule).offset(skip).limit(limit)
-    molecules = session.exec(statement).all()
 
-    return MoleculesOut(data=molecules, count=len(molecules))
+    Pass the `next_cursor` of a page as `cursor` to fetch the next one, which stays fast
+    deep into the table unlike `skip`.
+    """
+    try:
+        molecules, next_cursor = (
+            await molecules_crud.get_molecules_page_by_conditions_async(
+                session=session, skip=skip, limit=limit, cursor=cursor
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return MoleculesOut(data=molecules, count=len(molecules), next_cursor=next_cursor)
 
 
 @router.get("/smiles/", response_model=MoleculesOut)
-def read_molecules_by_smiles(
-    session: SessionDep,
+async def read_molecules_by_smiles(
+    session: VectorSessionDep,
     smiles: str,
     skip: int = 0,
     limit: int = 5,
+    cursor: str | None = None,
     method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
-    distance: Literal["l2", "inner_product", "cosine"] = "cosine",
+    distance: Literal[
+        "l2", "inner_product", "cosine", "tanimoto", "hamming"
+    ] = "cosine",
+    ef_search: int | None = None,
+    probes: int | None = None,
 ) -> MoleculesOut:
     """
     Fuzzy search through SMILES
@@ -77,28 +151,74 @@ def read_molecules_by_smiles(
     The SMILES string will be transformed into an embedding you selected and used to find
     similar molecules in the database by vector distance.
 
-    SLOW: This method is very slow for large datasets.
+    SLOW: This method is very slow for large datasets unless the vector indexes are built
+    (`qm9star-build-index`). With an HNSW index, `ef_search` trades accuracy for speed;
+    with an IVFFlat index, `probes` does.
+
+    Pass the `next_cursor` of a page as `cursor` to fetch the next closest molecules.
+    """
+    try:
+        db_molecules, next_cursor = (
+            await molecules_crud.get_molecules_page_by_smiles_async(
+                session=session,
+                smiles=smiles,
+                method=method,
+                distance=distance,
+                skip=skip,
+                limit=limit,
+                cursor=cursor,
+                ef_search=ef_search,
+                probes=probes,
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return MoleculesOut(
+        data=db_molecules, count=len(db_molecules), next_cursor=next_cursor
+    )
+
+
+@router.post("/smiles/batch/", response_model=MoleculesBatchOut)
+async def read_molecules_by_smiles_batch(
+    session: VectorSessionDep,
+    query: MoleculeSmilesBatch,
+) -> MoleculesBatchOut:
+    """
+    Fuzzy search through many SMILES at once
+
+    Fingerprints are computed in a worker pool and all neighbours are resolved in a single
+    SQL statement, which is much faster than calling `/smiles/` once per SMILES.
     """
-    db_molecules = molecules_crud.get_molecules_by_smiles(
-        session=session,
-        smiles=smiles,
-        method=method,
-        distance=distance,
-        skip=skip,
-        limit=limit,
+    try:
+        db_results = await molecules_crud.get_molecules_by_smiles_batch_async(
+            session=session,
+            smiles_list=query.smiles,
+            method=query.method,
+            distance=query.distance,
+            limit=query.limit,
+            ef_search=query.ef_search,
+            probes=query.probes,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return MoleculesBatchOut(
+        count=len(db_results),
+        results=[
+            MoleculeNeighboursOut(smiles=smiles, count=len(molecules), data=molecules)
+            for smiles, molecules in zip(query.smiles, db_results)
+        ],
     )
-    return MoleculesOut(data=db_molecules, count=len(db_molecules))
 
 
 @router.get("/smiles_strict/", response_model=MoleculeOut)
-def read_molecule_by_smiles_strict_match(
-    session: SessionDep,
+async def read_molecule_by_smiles_strict_match(
+    session: AsyncSessionDep,
     smiles: str,
 ) -> MoleculeOut:
     """
     Precise search through SMILES
     """
-    db_molecule = molecules_crud.get_molecule_by_smiles(
+    db_molecule = await molecules_crud.get_molecule_by_smiles_async(
         session=session, smiles=smiles
     )
     if not db_molecule:
@@ -107,21 +227,31 @@ def read_molecule_by_smiles_strict_match(
 
 
 @router.post("/filter/", response_model=MoleculesOut)
-def read_molecules_by_filter(
-    session: SessionDep,
+async def read_molecules_by_filter(
+    session: VectorSessionDep,
     filters: MoleculeFilter = None,
     skip: int = 0,
     limit: int = 100,
+    cursor: str | None = None,
 ) -> MoleculesOut:
     """
     Retrieve molecules by filters.
 
-    Detailed filters setting can be found in the schema of `MoleculeFilter`.
+    Detailed filters setting can be found in the schema of `MoleculeFilter`. Pass the
+    `next_cursor` of a page as `cursor`, with the same filters, to fetch the next one.
     """
-    session_molecules = molecules_crud.get_molecules_by_conditions(
-        session=session,
-        molecule_filter=filters,
-        skip=skip,
-        limit=limit,
+    try:
+        session_molecules, next_cursor = (
+            await molecules_crud.get_molecules_page_by_conditions_async(
+                session=session,
+                molecule_filter=filters,
+                skip=skip,
+                limit=limit,
+                cursor=cursor,
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return MoleculesOut(
+        data=session_molecules, count=len(session_molecules), next_cursor=next_cursor
     )
-    return MoleculesOut(data=session_molecules, count=len(session_molecules))
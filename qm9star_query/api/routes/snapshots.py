@@ -1,81 +1,270 @@
 import os
-from typing import Literal
+from typing import List, Literal
 
-from fastapi import APIRouter, HTTPException
-from rdkit import Chem
-from sqlmodel import col, column, func, select
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlmodel import Session, col, column, func, select
 
-from qm9star_query.api.deps import SessionDep
+from qm9star_query.api import caching, export
+from qm9star_query.api.deps import AsyncSessionDep, VectorSessionDep, get_session_info
+from qm9star_query.core.db import engine
+from qm9star_query.core.sdf_cache import render_mol_blocks
 from qm9star_query.crud import molecules_crud, snapshots_crud
 from qm9star_query.models import Molecule, Snapshot
+from qm9star_query.models.molecule import MoleculeOut
 from qm9star_query.models.snapshot import SnapshotOut, SnapshotSDFOut, SnapshotsOut
-from qm9star_query.models.utils import ItemCount,  SnapshotFilter
-from qm9star_query.utils import recover_rdmol_from_snapshot
+from qm9star_query.models.utils import ItemCount, SnapshotFilter
+from qm9star_query.utils import mol_block_columns, run_rdkit, snapshot_to_mol_block
 
 router = APIRouter()
 
+FieldsQuery = Query(
+    default=None,
+    description="Only return these fields of `SnapshotOut` (and `id`), "
+    "e.g. `fields=single_point_energy&fields=zpve`",
+)
+
+
+def check_fields(fields: List[str] | None) -> None:
+    if fields is None:
+        return
+    unknown = [field for field in fields if field not in SnapshotOut.model_fields]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown snapshot fields: {', '.join(unknown)}"
+        )
+
+
+def snapshot_fields_out(snapshot: Snapshot, fields: List[str]) -> dict:
+    """
+    Serialize only `fields` of a snapshot loaded with `columns=fields`, without
+    validating (or lazy loading) the other columns.
+    """
+    values = {field: getattr(snapshot, field) for field in ("id", *fields)}
+    if "molecule" in values:
+        values["molecule"] = MoleculeOut.model_validate(snapshot.molecule)
+    return SnapshotOut.model_construct(**values).model_dump(
+        mode="json", exclude_unset=True
+    )
+
+
+def sdf_record(snapshot: Snapshot, sdf_block: str) -> str:
+    """
+    One record of an SD file: the MolBlock plus the snapshot id and SMILES as data
+    fields.
+    """
+    return (
+        f"{sdf_block}> <id>\n{snapshot.id}\n\n"
+        f"> <smiles>\n{snapshot.molecule.smiles}\n\n$$$$\n"
+    )
+
+
+def snapshots_out(
+    db_snapshots, fields: List[str] | None = None, next_cursor: str | None = None
+) -> SnapshotsOut | JSONResponse:
+    if fields is None:
+        return SnapshotsOut(
+            snapshots=db_snapshots, count=len(db_snapshots), next_cursor=next_cursor
+        )
+    return JSONResponse(
+        {
+            "count": len(db_snapshots),
+            "snapshots": [
+                snapshot_fields_out(snapshot, fields) for snapshot in db_snapshots
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
+
 
 @router.get("/{id}", response_model=SnapshotOut)
-def read_snapshot_by_id(session: SessionDep, id: int) -> SnapshotOut:
+async def read_snapshot_by_id(
+    session: AsyncSessionDep,
+    request: Request,
+    response: Response,
+    id: int,
+    fields: List[str] | None = FieldsQuery,
+) -> SnapshotOut:
     """
     Get a snapshot by id.
+
+    The response carries an `ETag`; send it back as `If-None-Match` to get a `304`
+    without the payload while the snapshot is unchanged.
     """
-    snapshot = session.get(Snapshot, id)
+    check_fields(fields)
+    version = await snapshots_crud.get_snapshot_version_async(
+        session=session, snapshot_id=id
+    )
+    if version is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    headers = caching.cache_headers(caching.record_etag(version, fields))
+    if caching.etag_matches(request, headers["ETag"]):
+        return caching.not_modified(headers)
+    snapshot = await snapshots_crud.get_snapshot_by_id_async(
+        session=session, snapshot_id=id, columns=fields
+    )
     if not snapshot:
         raise HTTPException(status_code=404, detail="Snapshot not found")
+    if fields is not None:
+        return JSONResponse(snapshot_fields_out(snapshot, fields), headers=headers)
+    response.headers.update(headers)
     return SnapshotOut.model_validate(snapshot)
 
 
 @router.get("/sdf/{id}", response_model=SnapshotSDFOut)
-def read_snapshot_sdf_by_id(session: SessionDep, id: int) -> SnapshotSDFOut:
+async def read_snapshot_sdf_by_id(
+    session: AsyncSessionDep, request: Request, response: Response, id: int
+) -> SnapshotSDFOut:
     """
-    Get a snapshot by id.
+    Get the 3D SDF block of a snapshot by id.
+
+    The block is read from the precomputed `snapshotsdf` table when present, else
+    rendered and kept in a per-worker LRU. The response carries an `ETag`; send it
+    back as `If-None-Match` to get a `304` without the payload while the snapshot is
+    unchanged.
     """
-    snapshot = session.get(Snapshot, id)
+    version = await snapshots_crud.get_snapshot_version_async(
+        session=session, snapshot_id=id
+    )
+    if version is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    headers = caching.cache_headers(caching.record_etag(version, "sdf"))
+    if caching.etag_matches(request, headers["ETag"]):
+        return caching.not_modified(headers)
+    snapshot = await snapshots_crud.get_snapshot_by_id_async(
+        session=session, snapshot_id=id
+    )
     if not snapshot:
         raise HTTPException(status_code=404, detail="Snapshot not found")
-    rdmol = recover_rdmol_from_snapshot(snapshot)
-    return SnapshotSDFOut(
-        smiles=snapshot.molecule.smiles,
-        sdf_block=Chem.MolToMolBlock(rdmol),
+    precomputed = await snapshots_crud.get_precomputed_sdf_blocks_async(
+        session=session, hash_tokens=[snapshot.hash_token]
+    )
+    sdf_block = precomputed.get(snapshot.hash_token) or await run_rdkit(
+        snapshot_to_mol_block, snapshot
+    )
+    response.headers.update(headers)
+    return SnapshotSDFOut(smiles=snapshot.molecule.smiles, sdf_block=sdf_block)
+
+
+@router.get("/sdf/")
+async def read_snapshots_sdf_by_ids(
+    session: AsyncSessionDep,
+    ids: List[int] = Query(description="The snapshot ids, at most 1000"),
+) -> StreamingResponse:
+    """
+    Download the snapshots `ids` as one SD file, in the order of `ids`.
+
+    Each record carries the snapshot `id` and `smiles` as data fields. Precomputed
+    blocks are streamed as they are; the others are rendered before the file is
+    written. Unknown ids, and snapshots RDKit cannot render, are skipped.
+    """
+    if len(ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 ids per request")
+    snapshots = await snapshots_crud.get_snapshots_by_ids_async(
+        session=session,
+        snapshot_ids=list(dict.fromkeys(ids)),
+        columns=["hash_token", *mol_block_columns, "molecule"],
+    )
+    precomputed = await snapshots_crud.get_precomputed_sdf_blocks_async(
+        session=session, hash_tokens=[snapshot.hash_token for snapshot in snapshots]
+    )
+
+    # rendered before the response starts, so a failure cannot cut the file off
+    missing = [
+        snapshot for snapshot in snapshots if snapshot.hash_token not in precomputed
+    ]
+    rendered = await run_rdkit(
+        render_mol_blocks,
+        [
+            [getattr(snapshot, column) for column in mol_block_columns]
+            for snapshot in missing
+        ],
+    )
+    sdf_blocks = {snapshot.id: block for snapshot, block in zip(missing, rendered)}
+
+    async def records():
+        for snapshot in snapshots:
+            sdf_block = precomputed.get(snapshot.hash_token) or sdf_blocks[snapshot.id]
+            if sdf_block is not None:
+                yield sdf_record(snapshot, sdf_block).encode()
+
+    return StreamingResponse(
+        records(),
+        media_type="chemical/x-mdl-sdfile",
+        headers={"Content-Disposition": 'attachment; filename="snapshots.sdf"'},
     )
 
 
 @router.get("/count/", response_model=ItemCount)
-def read_snapshots_count(
-    session: SessionDep,
+async def read_snapshots_count(
+    session: AsyncSessionDep,
+    estimate: bool = False,
 ) -> ItemCount:
     """
     Get the number of snapshots in the database.
+
+    Counts are cached for a while. With `estimate`, the count is read from the
+    planner statistics instead, which is instant but only as fresh as the last
+    `ANALYZE`.
+    """
+    return await snapshots_crud.get_snapshot_count_async(
+        session=session, estimate=estimate
+    )
+
+
+@router.post("/count/filter/", response_model=ItemCount)
+async def read_snapshots_count_by_filter(
+    session: VectorSessionDep, filters: SnapshotFilter = None
+) -> ItemCount:
     """
-    count_statement = select(func.count()).select_from(Snapshot)
-    count = session.exec(count_statement).one()
-    return ItemCount(count=count)
+    Get the number of snapshots matching the filters.
+
+    The SMILES search fields only order results and are ignored here. Counts are
+    cached for a while under the normalized filters.
+    """
+    return await snapshots_crud.get_snapshot_count_by_conditions_async(
+        session=session, snapshot_filter=filters
+    )
 
 
 @router.get("/", response_model=SnapshotsOut)
-def read_snapshots(
-    session: SessionDep,
+async def read_snapshots(
+    session: AsyncSessionDep,
     skip: int = 0,
     limit: int = 100,
+    cursor: str | None = None,
+    fields: List[str] | None = FieldsQuery,
 ) -> SnapshotsOut:
     """
     Retrieve snapshots.
-    """
-    statement = select(Snapshot).offset(skip).limit(limit)
-    snapshots = session.exec(statement).all()
 
-    return SnapshotsOut(snapshots=snapshots, count=len(snapshots))
+    Pass the `next_cursor` of a page as `cursor` to fetch the next one, which stays fast
+    deep into the table unlike `skip`.
+    """
+    check_fields(fields)
+    try:
+        snapshots, next_cursor = (
+            await snapshots_crud.get_snapshots_page_by_conditions_async(
+                session=session, skip=skip, limit=limit, cursor=cursor, columns=fields
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return snapshots_out(snapshots, fields, next_cursor)
 
 
 @router.get("/smiles/", response_model=SnapshotsOut)
-def read_snapshots_by_smiles(
-    session: SessionDep,
+async def read_snapshots_by_smiles(
+    session: VectorSessionDep,
     smiles: str,
     method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
-    distance: Literal["l2", "inner_product", "cosine"] = "l2",
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"] = "l2",
     skip: int = 0,
     limit: int = 1,
+    cursor: str | None = None,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    fields: List[str] | None = FieldsQuery,
 ) -> SnapshotsOut:
     """
     Fuzzy search through SMILES
@@ -89,56 +278,132 @@ def read_snapshots_by_smiles(
 
     We recommend using `limit=1`, which will return all snapshots of the molecule that
     most closely match a given SMILES.
+
+    Pass the `next_cursor` of a page as `cursor` to fetch the next closest snapshots.
     """
-    db_snapshots = snapshots_crud.get_snapshots_by_conditions(
-        session=session,
-        snapshot_filter=SnapshotFilter(
-            smiles=smiles,
-            method=method,
-            distance=distance,
-            numeric_filters=[],
-            class_filters=[],
-            bool_filters=[],
-            element_filters=[],
-        ),
-        skip=skip,
-        limit=limit,
-    )
-    return SnapshotsOut(snapshots=db_snapshots, count=len(db_snapshots))
+    check_fields(fields)
+    try:
+        db_snapshots, next_cursor = (
+            await snapshots_crud.get_snapshots_page_by_conditions_async(
+                session=session,
+                snapshot_filter=SnapshotFilter(
+                    smiles=smiles,
+                    method=method,
+                    distance=distance,
+                    ef_search=ef_search,
+                    probes=probes,
+                    numeric_filters=[],
+                    class_filters=[],
+                    bool_filters=[],
+                    element_filters=[],
+                ),
+                skip=skip,
+                limit=limit,
+                cursor=cursor,
+                columns=fields,
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return snapshots_out(db_snapshots, fields, next_cursor)
 
 
 @router.get("/smiles_strict/", response_model=SnapshotsOut)
-def read_snapshots_by_smiles_strict_match(
-    session: SessionDep, smiles: str
+async def read_snapshots_by_smiles_strict_match(
+    session: AsyncSessionDep, smiles: str, fields: List[str] | None = FieldsQuery
 ) -> SnapshotsOut:
     """
     Precise search through SMILES
     """
-    db_molecule = molecules_crud.get_molecule_by_smiles(session=session, smiles=smiles)
+    check_fields(fields)
+    db_molecule = await molecules_crud.get_molecule_by_smiles_async(
+        session=session, smiles=smiles
+    )
     if db_molecule:
-        return SnapshotsOut(
-            snapshots=db_molecule.snapshots, count=len(db_molecule.snapshots)
+        db_snapshots = await snapshots_crud.get_snapshots_by_molecule_id_async(
+            session=session, molecule_id=db_molecule.id, columns=fields
         )
+        return snapshots_out(db_snapshots, fields)
     else:
         raise HTTPException(status_code=404, detail="Molecule not found")
 
 
 @router.post("/filter/", response_model=SnapshotsOut)
-def read_molecules_by_filter(
-    session: SessionDep,
+async def read_molecules_by_filter(
+    session: VectorSessionDep,
     filters: SnapshotFilter = None,
     skip: int = 0,
     limit: int = 5,
+    cursor: str | None = None,
+    fields: List[str] | None = FieldsQuery,
 ) -> SnapshotsOut:
     """
     Retrieve snapshots by filters.
 
-    Detailed filters setting can be found in the schema of `SnapshotFilter`.
+    Detailed filters setting can be found in the schema of `SnapshotFilter`. Pass the
+    `next_cursor` of a page as `cursor`, with the same filters, to fetch the next one.
     """
-    db_snapshots = snapshots_crud.get_snapshots_by_conditions(
-        session=session,
-        snapshot_filter=filters,
-        skip=skip,
-        limit=limit,
+    check_fields(fields)
+    try:
+        db_snapshots, next_cursor = (
+            await snapshots_crud.get_snapshots_page_by_conditions_async(
+                session=session,
+                snapshot_filter=filters,
+                skip=skip,
+                limit=limit,
+                cursor=cursor,
+                columns=fields,
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return snapshots_out(db_snapshots, fields, next_cursor)
+
+
+@router.post("/export/")
+def export_snapshots_by_filter(
+    filters: SnapshotFilter = None,
+    format: Literal["ndjson", "arrow"] = "ndjson",
+    fields: List[str] | None = Query(default=None),
+    limit: int | None = None,
+    batch_size: int = Query(default=1000, ge=1),
+) -> StreamingResponse:
+    """
+    Export snapshots by filters as a stream.
+
+    Rows are read through a server-side cursor and written as soon as each batch of
+    `batch_size` rows is fetched, as newline-delimited JSON (`ndjson`) or Arrow IPC
+    record batches (`arrow`, needs `pyarrow`). Use `fields` to export only some columns
+    of the snapshot table, e.g. `fields=coords&fields=atoms&fields=single_point_energy`.
+    """
+    if format == "arrow" and export.pa is None:
+        raise HTTPException(status_code=501, detail="Arrow export requires pyarrow")
+    # built (and the SMILES fingerprinted) before the response starts, so an invalid
+    # filter is a 400 rather than a truncated body
+    try:
+        columns = snapshots_crud.get_snapshot_columns(fields)
+        query = snapshots_crud.build_snapshots_stream_query(
+            filters, [column.name for column in columns], limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    def batches():
+        # the request-scoped session may be closed before the body is streamed
+        with Session(engine, info=get_session_info("export")) as session:
+            yield from snapshots_crud.stream_snapshots_by_conditions(
+                session=session,
+                snapshot_filter=filters,
+                columns=[column.name for column in columns],
+                limit=limit,
+                batch_size=batch_size,
+                query=query,
+            )
+
+    if format == "arrow":
+        return StreamingResponse(
+            export.arrow_stream(batches(), columns), media_type=export.ARROW_MEDIA_TYPE
+        )
+    return StreamingResponse(
+        export.ndjson_stream(batches()), media_type=export.NDJSON_MEDIA_TYPE
     )
-    return SnapshotsOut(snapshots=db_snapshots, count=len(db_snapshots))
@@ -1,3 +1,31 @@
 from fastapi import APIRouter
 
+from qm9star_query.core.db import async_engine, engine
+from qm9star_query.core.engine import get_pool_status
+from qm9star_query.crud.result_cache import get_result_cache
+from qm9star_query.models.utils import PoolsStatus, PoolStatus, ResultCacheStats
+
 router = APIRouter()
+
+
+@router.get("/pool/", response_model=PoolsStatus)
+def read_pool_status() -> PoolsStatus:
+    """
+    Connection pool usage of this worker process.
+    """
+    return PoolsStatus(
+        sync_engine=PoolStatus(**get_pool_status(engine)),
+        async_engine=PoolStatus(**get_pool_status(async_engine)),
+    )
+
+
+@router.get("/cache/", response_model=ResultCacheStats)
+def read_result_cache_stats() -> ResultCacheStats:
+    """
+    Hit and miss statistics of the filter and SMILES search result cache of this
+    worker process.
+    """
+    result_cache = get_result_cache()
+    if result_cache is None:
+        return ResultCacheStats(backend=None)
+    return ResultCacheStats(**result_cache.stats())
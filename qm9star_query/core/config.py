@@ -78,6 +78,65 @@ class Settings(BaseSettings):
             path=self.POSTGRES_DB,
         )
 
+    @computed_field  # type: ignore[misc]
+    @property
+    def SQLALCHEMY_ASYNC_DATABASE_URI(self) -> PostgresDsn:
+        return MultiHostUrl.build(
+            scheme="postgresql+psycopg",
+            username=self.POSTGRES_USER,
+            password=self.POSTGRES_PASSWORD,
+            host=self.POSTGRES_SERVER,
+            port=self.POSTGRES_PORT,
+            path=self.POSTGRES_DB,
+        )
+
+    # threads running RDKit (fingerprints, SDF rendering) for the async routes
+    RDKIT_MAX_WORKERS: int | None = None
+
+    # connection pool of each engine (the sync and the async one), per worker process
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_TIMEOUT: float = 30
+
+    # statement timeouts in milliseconds per endpoint class, 0 disables the timeout
+    STATEMENT_TIMEOUT_FAST: int = 5_000
+    STATEMENT_TIMEOUT_VECTOR: int = 60_000
+    STATEMENT_TIMEOUT_EXPORT: int = 0
+
+    # seconds the /count/ endpoints serve a cached count, 0 disables the cache
+    COUNT_CACHE_TTL: int = 60
+
+    # cache of filter and SMILES search results, `sqlite` shares it between workers
+    RESULT_CACHE: Literal["memory", "sqlite", "off"] = "memory"
+    RESULT_CACHE_MAX_BYTES: int = 64 * 2**20
+    RESULT_CACHE_PATH: str = "result_cache.sqlite3"
+
+    # `Cache-Control: max-age` in seconds of the single-record endpoints
+    RECORD_CACHE_MAX_AGE: int = 86400
+
+    # SDF blocks rendered on the fly (not found in `snapshotsdf`) kept per worker
+    SDF_CACHE_SIZE: int = 4096
+
+    @property
+    def db_pool_kwargs(self) -> dict[str, Any]:
+        return dict(
+            pool_size=self.DB_POOL_SIZE,
+            max_overflow=self.DB_MAX_OVERFLOW,
+            pool_recycle=self.DB_POOL_RECYCLE,
+            pool_pre_ping=self.DB_POOL_PRE_PING,
+            pool_timeout=self.DB_POOL_TIMEOUT,
+        )
+
+    @property
+    def statement_timeouts(self) -> dict[str, int]:
+        return {
+            "fast": self.STATEMENT_TIMEOUT_FAST,
+            "vector": self.STATEMENT_TIMEOUT_VECTOR,
+            "export": self.STATEMENT_TIMEOUT_EXPORT,
+        }
+
     def _check_default_secret(self, var_name: str, value: str | None) -> None:
         if value == "changethis":
             message = (
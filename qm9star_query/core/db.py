@@ -1,12 +1,20 @@
-from sqlmodel import Session, create_engine, select
+from sqlmodel import Session, select
 
 from qm9star_query.core.config import settings
+from qm9star_query.core.engine import create_async_db_engine, create_db_engine
 
-engine = create_engine(str(settings.SQLALCHEMY_DATABASE_URI))
+engine = create_db_engine(
+    str(settings.SQLALCHEMY_DATABASE_URI), **settings.db_pool_kwargs
+)
 with engine.begin() as conn:
     conn.exec_driver_sql("CREATE EXTENSION IF NOT EXISTS vector")
     conn.commit()
 
+# psycopg 3 engine for the async routes, sharing no connections with `engine`
+async_engine = create_async_db_engine(
+    str(settings.SQLALCHEMY_ASYNC_DATABASE_URI), **settings.db_pool_kwargs
+)
+
 
 # make sure all SQLModel models are imported (qm9star_query.models) before initializing DB
 # otherwise, SQLModel might fail to initialize relationships properly
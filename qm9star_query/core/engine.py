@@ -0,0 +1,78 @@
+"""
+Engine construction shared by the API server and the dataset loaders.
+
+Everything here is independent of `Settings`, so the datasets can use it with their
+own connection arguments without a `.env` file.
+"""
+
+from typing import Any
+
+from sqlalchemy import Engine, event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import Session, create_engine
+
+_engines: dict[tuple, Engine] = {}
+
+
+def get_pool_kwargs(
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_recycle: int = 1800,
+    pool_pre_ping: bool = True,
+    pool_timeout: float = 30,
+) -> dict[str, Any]:
+    return dict(
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=pool_pre_ping,
+        pool_timeout=pool_timeout,
+    )
+
+
+def create_db_engine(url: str, **pool_kwargs) -> Engine:
+    """
+    A sync engine with a bounded connection pool, see `get_pool_kwargs` for the
+    pool arguments and their defaults.
+    """
+    return create_engine(url, **get_pool_kwargs(**pool_kwargs))
+
+
+def create_async_db_engine(url: str, **pool_kwargs) -> AsyncEngine:
+    return create_async_engine(url, **get_pool_kwargs(**pool_kwargs))
+
+
+def get_engine(url: str, **pool_kwargs) -> Engine:
+    """
+    The engine of `url`, created on first use and then shared, so every dataset
+    reading from the same database draws from one pool.
+    """
+    key = (url, tuple(sorted(pool_kwargs.items())))
+    if key not in _engines:
+        _engines[key] = create_db_engine(url, **pool_kwargs)
+    return _engines[key]
+
+
+def get_pool_status(engine: Engine | AsyncEngine) -> dict[str, int]:
+    """
+    Connection usage of the pool of `engine`: `size` connections kept open, of
+    which `checked_in` are idle and `checked_out` in use, plus the `overflow`
+    connections opened beyond `size`.
+    """
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # negative while the pool itself is not full
+        "overflow": max(pool.overflow(), 0),
+    }
+
+
+@event.listens_for(Session, "after_begin")
+def _apply_statement_timeout(session: Session, transaction, connection) -> None:
+    # `Session(engine, info={"statement_timeout": ms})` bounds every statement of
+    # the session's transactions; 0 or no entry keeps the server default
+    timeout = session.info.get("statement_timeout")
+    if timeout:
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
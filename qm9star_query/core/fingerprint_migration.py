@@ -0,0 +1,85 @@
+"""
+Fill the compact `moleculefingerprint` table from the `molecule` vector columns.
+
+pgvector's `binary_quantize` turns each 0/1 `vector(1024)` into a `bit(1024)`, so the
+migration runs entirely inside PostgreSQL. It works in id ranges and upserts, so it can
+be interrupted and re-run, e.g. after new molecules are committed.
+
+```bash
+qm9star-migrate-bit-fp --batch-size 50000 --index tanimoto
+```
+"""
+
+import argparse
+import time
+
+from pgvector.sqlalchemy import BIT
+from sqlalchemy import Engine, cast, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from qm9star_query.core.vector_index import build_vector_indexes
+from qm9star_query.models import Molecule, MoleculeFingerprint
+from qm9star_query.models.molecule import fingerprint_columns
+
+
+def migrate_bit_fingerprints(
+    engine: Engine, batch_size: int = 50000, log: bool = True
+) -> int:
+    MoleculeFingerprint.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        min_id, max_id = conn.execute(
+            select(func.min(Molecule.id), func.max(Molecule.id))
+        ).one()
+    if min_id is None:
+        return 0
+    columns = list(fingerprint_columns.values())
+    migrated = 0
+    start_time = time.perf_counter()
+    for start in range(min_id, max_id + 1, batch_size):
+        source = select(
+            Molecule.id,
+            *[
+                cast(func.binary_quantize(getattr(Molecule, column)), BIT(1024))
+                for column in columns
+            ],
+        ).where(Molecule.id >= start, Molecule.id < start + batch_size)
+        statement = insert(MoleculeFingerprint).from_select(
+            ["molecule_id", *columns], source
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["molecule_id"],
+            set_={column: statement.excluded[column] for column in columns},
+        )
+        with engine.begin() as conn:
+            migrated += conn.execute(statement).rowcount
+        if log:
+            print(
+                f"migrated {migrated} molecules up to id {start + batch_size - 1} "
+                f"({time.perf_counter() - start_time:.1f}s)"
+            )
+    return migrated
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Copy the molecule fingerprints into the bit(1024) table."
+    )
+    parser.add_argument("--batch-size", type=int, default=50000)
+    parser.add_argument(
+        "--index",
+        action="append",
+        choices=["tanimoto", "hamming"],
+        default=None,
+        help="build HNSW indexes for these distances afterwards",
+    )
+    args = parser.parse_args(argv)
+
+    from qm9star_query.core.db import engine
+
+    migrate_bit_fingerprints(engine, batch_size=args.batch_size)
+    if args.index:
+        build_vector_indexes(engine, distances=args.index, kind="hnsw")
+
+
+if __name__ == "__main__":
+    main()
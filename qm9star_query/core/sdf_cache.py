@@ -0,0 +1,121 @@
+"""
+Precompute the SDF blocks of the snapshots into the `snapshotsdf` table.
+
+Rendering a MolBlock rebuilds the RDKit molecule from the stored geometry, which
+dominates the cost of the SDF endpoints. The blocks are content-addressed by the
+snapshot `hash_token`, rendered in a process pool and inserted batch by batch, so the
+build can be interrupted and re-run, e.g. after new snapshots are committed; only the
+snapshots without a block are rendered.
+
+```bash
+qm9star-build-sdf --batch-size 20000 --workers 8
+```
+"""
+
+import argparse
+import os
+import time
+from typing import Sequence
+
+from sqlalchemy import Engine, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from qm9star_query.models import Snapshot, SnapshotSDF
+from qm9star_query.utils import (
+    get_embedding_executor,
+    mol_block_columns,
+    mol_block_from_record,
+)
+
+
+def try_mol_block(record: Sequence) -> str | None:
+    # a snapshot RDKit cannot sanitize is left to the on-the-fly path of the API
+    try:
+        return mol_block_from_record(record)
+    except Exception:
+        return None
+
+
+def render_mol_blocks(
+    records: Sequence[Sequence], parallel_threshold: int = 64
+) -> list[str | None]:
+    if len(records) < parallel_threshold:
+        return [try_mol_block(record) for record in records]
+    chunksize = max(1, len(records) // (4 * (os.cpu_count() or 1)))
+    return list(
+        get_embedding_executor().map(try_mol_block, records, chunksize=chunksize)
+    )
+
+
+def build_sdf_blocks(
+    engine: Engine, batch_size: int = 20000, log: bool = True
+) -> tuple[int, int]:
+    """
+    Render the missing SDF blocks, returns the numbers of blocks inserted and of
+    snapshots that failed to render.
+    """
+    SnapshotSDF.__table__.create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        min_id, max_id = conn.execute(
+            select(func.min(Snapshot.id), func.max(Snapshot.id))
+        ).one()
+    if min_id is None:
+        return 0, 0
+    inserted = failed = 0
+    start_time = time.perf_counter()
+    for start in range(min_id, max_id + 1, batch_size):
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(
+                    Snapshot.hash_token,
+                    *[getattr(Snapshot, column) for column in mol_block_columns],
+                )
+                .outerjoin(SnapshotSDF, SnapshotSDF.hash_token == Snapshot.hash_token)
+                .where(Snapshot.id >= start, Snapshot.id < start + batch_size)
+                .where(Snapshot.hash_token.is_not(None))
+                .where(SnapshotSDF.hash_token.is_(None))
+            ).all()
+        if rows:
+            blocks = render_mol_blocks([tuple(row[1:]) for row in rows])
+            values = [
+                {"hash_token": row.hash_token, "sdf_block": block}
+                for row, block in zip(rows, blocks)
+                if block is not None
+            ]
+            failed += len(rows) - len(values)
+            if values:
+                with engine.begin() as conn:
+                    inserted += conn.execute(
+                        insert(SnapshotSDF)
+                        .values(values)
+                        .on_conflict_do_nothing(index_elements=["hash_token"])
+                    ).rowcount
+        if log:
+            print(
+                f"rendered {inserted} SDF blocks ({failed} failed) up to id "
+                f"{start + batch_size - 1} ({time.perf_counter() - start_time:.1f}s)"
+            )
+    return inserted, failed
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Precompute the snapshot SDF blocks into the snapshotsdf table."
+    )
+    parser.add_argument("--batch-size", type=int, default=20000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="rendering processes, all CPUs by default",
+    )
+    args = parser.parse_args(argv)
+
+    from qm9star_query.core.db import engine
+
+    get_embedding_executor(args.workers)
+    build_sdf_blocks(engine, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+pgvector approximate nearest-neighbour indexes for the `Molecule` fingerprint columns.
+
+Every fingerprint method x distance metric pair gets its own index, because pgvector
+only uses an index whose operator class matches the distance operator in `ORDER BY`.
+Building all of them is expensive, so only the requested pairs are built, e.g.
+
+```bash
+qm9star-build-index --method morgan --distance cosine
+qm9star-build-index --kind ivfflat --lists 2000 --rebuild
+```
+"""
+
+import argparse
+import time
+from typing import Iterable, Literal
+
+from sqlalchemy import Column, Engine, Index, MetaData, Table, text
+
+from qm9star_query.models import Molecule, MoleculeFingerprint
+from qm9star_query.models.molecule import fingerprint_columns
+
+distance_opclasses = {
+    "l2": "vector_l2_ops",
+    "inner_product": "vector_ip_ops",
+    "cosine": "vector_cosine_ops",
+    # on the `MoleculeFingerprint` bit columns, needs pgvector >= 0.7.0
+    "tanimoto": "bit_jaccard_ops",
+    "hamming": "bit_hamming_ops",
+}
+
+
+def vector_index_name(
+    method: Literal["morgan", "rdk", "atompair", "torsion"],
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+    kind: Literal["hnsw", "ivfflat"] = "hnsw",
+) -> str:
+    table = MoleculeFingerprint if distance in ("tanimoto", "hamming") else Molecule
+    return f"ix_{table.__tablename__}_{fingerprint_columns[method]}_{kind}_{distance}"
+
+
+def get_vector_index(
+    method: Literal["morgan", "rdk", "atompair", "torsion"],
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+    kind: Literal["hnsw", "ivfflat"] = "hnsw",
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int = 1000,
+) -> Index:
+    """
+    Declare the index on the `molecule` (or `moleculefingerprint`) table with these
+    build parameters.
+
+    The index is declared on a copy of the table in its own `MetaData`, so it is not
+    added to the models' metadata (and created by `create_all`).
+    """
+    column_name = fingerprint_columns[method]
+    table = MoleculeFingerprint if distance in ("tanimoto", "hamming") else Molecule
+    if kind == "hnsw":
+        with_params = {"m": m, "ef_construction": ef_construction}
+    elif kind == "ivfflat":
+        if distance == "tanimoto":
+            raise ValueError("IVFFlat does not support the jaccard distance")
+        with_params = {"lists": lists}
+    else:
+        raise ValueError("Invalid index kind")
+    column = table.__table__.c[column_name]
+    detached = Table(table.__tablename__, MetaData(), Column(column_name, column.type))
+    return Index(
+        vector_index_name(method, distance, kind),
+        detached.c[column_name],
+        postgresql_using=kind,
+        postgresql_with=with_params,
+        postgresql_ops={column_name: distance_opclasses[distance]},
+    )
+
+
+def build_vector_indexes(
+    engine: Engine,
+    methods: Iterable[str] = tuple(fingerprint_columns),
+    distances: Iterable[str] = ("cosine",),
+    kind: Literal["hnsw", "ivfflat"] = "hnsw",
+    rebuild: bool = False,
+    m: int = 16,
+    ef_construction: int = 64,
+    lists: int = 1000,
+    maintenance_work_mem: str | None = None,
+    parallel_workers: int | None = None,
+    log: bool = True,
+) -> None:
+    for method in methods:
+        for distance in distances:
+            index = get_vector_index(
+                method,
+                distance,
+                kind,
+                m=m,
+                ef_construction=ef_construction,
+                lists=lists,
+            )
+            start = time.perf_counter()
+            with engine.begin() as conn:
+                if maintenance_work_mem is not None:
+                    conn.execute(
+                        text("SELECT set_config('maintenance_work_mem', :v, true)"),
+                        {"v": maintenance_work_mem},
+                    )
+                if parallel_workers is not None:
+                    conn.execute(
+                        text(
+                            "SELECT set_config('max_parallel_maintenance_workers', :v, true)"
+                        ),
+                        {"v": str(parallel_workers)},
+                    )
+                if rebuild:
+                    index.drop(conn, checkfirst=True)
+                index.create(conn, checkfirst=True)
+            if log:
+                print(f"{index.name} ready in {time.perf_counter() - start:.1f}s")
+
+
+def drop_vector_indexes(
+    engine: Engine,
+    methods: Iterable[str] = tuple(fingerprint_columns),
+    distances: Iterable[str] = tuple(distance_opclasses),
+    kind: Literal["hnsw", "ivfflat"] = "hnsw",
+) -> None:
+    """
+    Drop the indexes by name, so the pairs an index of `kind` does not support (IVFFlat
+    and the jaccard distance) are skipped without error.
+    """
+    with engine.begin() as conn:
+        quote = conn.dialect.identifier_preparer.quote
+        for method in methods:
+            for distance in distances:
+                name = vector_index_name(method, distance, kind)
+                conn.execute(text(f"DROP INDEX IF EXISTS {quote(name)}"))
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Build pgvector indexes for the molecule fingerprint columns."
+    )
+    parser.add_argument("--kind", choices=["hnsw", "ivfflat"], default="hnsw")
+    parser.add_argument(
+        "--method", action="append", choices=list(fingerprint_columns), default=None
+    )
+    parser.add_argument(
+        "--distance", action="append", choices=list(distance_opclasses), default=None
+    )
+    parser.add_argument("--rebuild", action="store_true", help="drop and recreate")
+    parser.add_argument("--drop", action="store_true", help="only drop the indexes")
+    parser.add_argument("--m", type=int, default=16, help="HNSW max connections")
+    parser.add_argument("--ef-construction", type=int, default=64)
+    parser.add_argument("--lists", type=int, default=1000, help="IVFFlat list count")
+    parser.add_argument(
+        "--maintenance-work-mem", default=None, help="e.g. 8GB, speeds up HNSW builds"
+    )
+    parser.add_argument("--parallel-workers", type=int, default=None)
+    args = parser.parse_args(argv)
+
+    from qm9star_query.core.db import engine
+
+    methods = args.method or list(fingerprint_columns)
+    if args.drop:
+        drop_vector_indexes(
+            engine,
+            methods=methods,
+            distances=args.distance or list(distance_opclasses),
+            kind=args.kind,
+        )
+        return
+    build_vector_indexes(
+        engine,
+        methods=methods,
+        distances=args.distance or ["cosine"],
+        kind=args.kind,
+        rebuild=args.rebuild,
+        m=args.m,
+        ef_construction=args.ef_construction,
+        lists=args.lists,
+        maintenance_work_mem=args.maintenance_work_mem,
+        parallel_workers=args.parallel_workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Row counts served from a TTL cache.
+
+`count(*)` on the snapshot table is a full scan, so counts are kept for
+`count_cache.ttl` seconds and dropped as soon as a session of this process flushes
+rows of the counted table. Whole-table counts can also be estimated from the
+planner statistics in `pg_class.reltuples`, which costs nothing but is only as
+fresh as the last `ANALYZE`.
+"""
+
+import threading
+import time
+from typing import Hashable
+
+from sqlalchemy import event, text
+from sqlmodel import Session, SQLModel, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from qm9star_query.crud.utils import filter_cache_key
+from qm9star_query.models.utils import ItemCount
+
+# fields of the filters that only order the results, not restrict them
+ordering_fields = {"smiles", "method", "distance", "ef_search", "probes"}
+
+
+class CountCache:
+    def __init__(self, ttl: float = 60):
+        """
+        Args:
+            ttl: seconds a count is served before it is counted again, 0 disables
+                the cache.
+        """
+        self.ttl = ttl
+        self._counts: dict[tuple[str, Hashable], tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, table: str, key: Hashable = None) -> int | None:
+        with self._lock:
+            entry = self._counts.get((table, key))
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, table: str, key: Hashable, count: int) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._counts[(table, key)] = (time.monotonic() + self.ttl, count)
+
+    def invalidate(self, *tables: str) -> None:
+        """
+        Drop the counts of `tables` (all counts by default). Filtered counts are
+        always dropped, as their filters may join any other table.
+        """
+        with self._lock:
+            if not tables:
+                self._counts.clear()
+                return
+            for table, key in list(self._counts):
+                if table in tables or key is not None:
+                    del self._counts[(table, key)]
+
+
+count_cache = CountCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _invalidate_flushed_counts(session: Session, flush_context) -> None:
+    tables = {
+        instance.__tablename__
+        for instance in (*session.new, *session.dirty, *session.deleted)
+    }
+    if tables:
+        count_cache.invalidate(*tables)
+
+
+def count_filter_key(query_filter: SQLModel | None) -> str | None:
+    """
+    The cache key of the rows matched by `query_filter`, with the fields that only
+    order the results left out, so e.g. all SMILES searches share one count.
+    """
+    if query_filter is None:
+        return None
+    return filter_cache_key(query_filter, exclude=ordering_fields)
+
+
+def without_ordering(query_filter: SQLModel | None):
+    """
+    `query_filter` without its SMILES, so counting does not compute the distances.
+    """
+    if query_filter is None:
+        return None
+    return query_filter.model_copy(update={"smiles": None})
+
+
+def estimate_statement(model: type[SQLModel]):
+    return text(
+        "SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"
+    ).bindparams(table=model.__tablename__)
+
+
+def get_count(
+    *,
+    session: Session,
+    model: type[SQLModel],
+    statement=None,
+    key: Hashable = None,
+    estimate: bool = False,
+) -> ItemCount:
+    """
+    The number of rows of `model` matched by the `count(*)` `statement` (all rows by
+    default), cached under `key`.
+
+    With `estimate`, a whole-table count is read from the planner statistics instead,
+    unless the table was never analyzed.
+    """
+    table = model.__tablename__
+    if estimate and statement is None:
+        count = session.exec(estimate_statement(model)).scalar()
+        if count is not None and count >= 0:
+            return ItemCount(count=count, estimated=True)
+    count = count_cache.get(table, key)
+    if count is None:
+        statement = (
+            select(func.count()).select_from(model) if statement is None else statement
+        )
+        count = session.exec(statement).one()
+        count_cache.set(table, key, count)
+    return ItemCount(count=count)
+
+
+async def get_count_async(
+    *,
+    session: AsyncSession,
+    model: type[SQLModel],
+    statement=None,
+    key: Hashable = None,
+    estimate: bool = False,
+) -> ItemCount:
+    table = model.__tablename__
+    if estimate and statement is None:
+        count = (await session.exec(estimate_statement(model))).scalar()
+        if count is not None and count >= 0:
+            return ItemCount(count=count, estimated=True)
+    count = count_cache.get(table, key)
+    if count is None:
+        statement = (
+            select(func.count()).select_from(model) if statement is None else statement
+        )
+        count = (await session.exec(statement)).one()
+        count_cache.set(table, key, count)
+    return ItemCount(count=count)
@@ -1,7 +1,10 @@
 from typing import Sequence
 
 from sqlmodel import Session, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from qm9star_query.crud import counts
+from qm9star_query.crud.utils import next_id_cursor, paginate_by_id, record_version
 from qm9star_query.models import Formula
 from qm9star_query.models.utils import FormulaFilter, ItemCount
 from qm9star_query.utils import elements_in_pt
@@ -11,6 +14,29 @@ def get_formula_by_id(*, session: Session, formula_id: int) -> Formula:
     return session.get(Formula, formula_id)
 
 
+async def get_formula_by_id_async(*, session: AsyncSession, formula_id: int) -> Formula:
+    return await session.get(Formula, formula_id)
+
+
+def build_formula_version_query(formula_id: int):
+    return select(Formula.id, Formula.update_time).where(Formula.id == formula_id)
+
+
+def get_formula_version(*, session: Session, formula_id: int) -> str | None:
+    """
+    A string that changes whenever the formula changes, read without loading it.
+    """
+    return record_version(session.exec(build_formula_version_query(formula_id)).first())
+
+
+async def get_formula_version_async(
+    *, session: AsyncSession, formula_id: int
+) -> str | None:
+    return record_version(
+        (await session.exec(build_formula_version_query(formula_id))).first()
+    )
+
+
 def get_formula_by_formula_str(*, session: Session, formula_str: str) -> Formula | None:
     statement = select(Formula).where(Formula.formula_string == formula_str)
     db_formula = session.exec(statement).first()
@@ -20,13 +46,7 @@ def get_formula_by_formula_str(*, session: Session, formula_str: str) -> Formula
         return None
 
 
-def get_formulas_by_conditions(
-    *,
-    session: Session,
-    formula_filter: FormulaFilter = None,
-    skip: int = 0,
-    limit: int = 100,
-) -> Sequence[Formula]:
+def build_formulas_query(formula_filter: FormulaFilter | None = None):
     query = select(Formula)
     if formula_filter:
         # numeric_filters
@@ -45,12 +65,70 @@ def get_formulas_by_conditions(
                 query = query.where(
                     getattr(Formula, element_filter.element) == element_filter.count
                 )
-    statement = query.offset(skip).limit(limit).order_by(Formula.id)
+    return query
+
+
+def get_formulas_page_by_conditions(
+    *,
+    session: Session,
+    formula_filter: FormulaFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> tuple[Sequence[Formula], str | None]:
+    """
+    One page of formulas ordered by id, and the cursor of the next page.
+
+    `cursor` continues after the previous page without an `OFFSET` scan, `skip` is
+    only kept for backwards compatibility.
+    """
+    statement = paginate_by_id(
+        build_formulas_query(formula_filter), Formula.id, skip, limit, cursor
+    )
     db_formulas = session.exec(statement).all()
+    return db_formulas, next_id_cursor(db_formulas, limit)
+
+
+async def get_formulas_page_by_conditions_async(
+    *,
+    session: AsyncSession,
+    formula_filter: FormulaFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> tuple[Sequence[Formula], str | None]:
+    statement = paginate_by_id(
+        build_formulas_query(formula_filter), Formula.id, skip, limit, cursor
+    )
+    db_formulas = (await session.exec(statement)).all()
+    return db_formulas, next_id_cursor(db_formulas, limit)
+
+
+def get_formulas_by_conditions(
+    *,
+    session: Session,
+    formula_filter: FormulaFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> Sequence[Formula]:
+    db_formulas, _ = get_formulas_page_by_conditions(
+        session=session,
+        formula_filter=formula_filter,
+        skip=skip,
+        limit=limit,
+        cursor=cursor,
+    )
     return db_formulas
 
 
-def get_formula_count(*, session: Session) -> ItemCount:
-    count_statement = select(func.count()).select_from(Formula)
-    count = session.exec(count_statement).one()
-    return ItemCount(count=count)
+def get_formula_count(*, session: Session, estimate: bool = False) -> ItemCount:
+    return counts.get_count(session=session, model=Formula, estimate=estimate)
+
+
+async def get_formula_count_async(
+    *, session: AsyncSession, estimate: bool = False
+) -> ItemCount:
+    return await counts.get_count_async(
+        session=session, model=Formula, estimate=estimate
+    )
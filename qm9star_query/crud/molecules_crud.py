@@ -1,75 +1,400 @@
-from typing import Literal, Sequence
+from typing import Any, List, Literal, Sequence
 
 from qm9star_query.models import Formula, Molecule
+from qm9star_query.crud import counts
+from qm9star_query.crud.result_cache import (
+    cache_page,
+    get_cached_page,
+    result_cache_key,
+    result_cache_key_async,
+)
+from qm9star_query.crud.utils import (
+    get_distance_expression,
+    get_filter_distance,
+    get_filter_embedding_async,
+    has_row_filters,
+    join_fingerprints,
+    order_by_ids,
+    page_result,
+    paginate_by_distance,
+    paginate_by_id,
+    record_version,
+    set_vector_search_params,
+    set_vector_search_params_async,
+    unnest_embeddings,
+)
+from qm9star_query.models.molecule import fingerprint_columns
 from qm9star_query.models.utils import MoleculeFilter, ItemCount
 from qm9star_query.utils import (
     elements_in_pt,
+    run_rdkit,
     smi_to_embedding,
     smiles_to_formula_dict,
+    smis_to_embeddings,
 )
-from sqlmodel import Session, select, func
+from sqlalchemy import true
+from sqlalchemy.orm import defer, selectinload
+from sqlmodel import Session, col, select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+
+def get_molecule_load_options() -> list:
+    """
+    Loader options matching `MoleculeOut`: the formulas of a whole page are loaded
+    with one `IN` query instead of one lazy load per molecule, and the fingerprint
+    vectors, which `MoleculeOut` leaves out, are deferred.
+    """
+    return [
+        selectinload(Molecule.formula),
+        *[defer(getattr(Molecule, column)) for column in fingerprint_columns.values()],
+    ]
 
 
 def get_molecule_by_id(*, session: Session, molecule_id: int) -> Molecule:
-    return session.get(Molecule, molecule_id)
+    return session.get(Molecule, molecule_id, options=get_molecule_load_options())
+
+
+async def get_molecule_by_id_async(
+    *, session: AsyncSession, molecule_id: int
+) -> Molecule:
+    return await session.get(Molecule, molecule_id, options=get_molecule_load_options())
+
+
+def build_molecule_version_query(molecule_id: int):
+    # `MoleculeOut` embeds the formula, so its changes change the molecule too
+    return (
+        select(Molecule.id, Molecule.update_time, Formula.update_time)
+        .join(Formula)
+        .where(Molecule.id == molecule_id)
+    )
+
+
+def get_molecule_version(*, session: Session, molecule_id: int) -> str | None:
+    """
+    A string that changes whenever the molecule changes, read without loading it.
+    """
+    return record_version(
+        session.exec(build_molecule_version_query(molecule_id)).first()
+    )
+
+
+async def get_molecule_version_async(
+    *, session: AsyncSession, molecule_id: int
+) -> str | None:
+    return record_version(
+        (await session.exec(build_molecule_version_query(molecule_id))).first()
+    )
+
 
 def get_molecule_ids(*, session: Session) -> Sequence[int]:
     return session.exec(select(Molecule.id)).all()
 
 
-def get_molecule_by_smiles(*, session: Session, smiles: str) -> Molecule:
-    formula_dict = smiles_to_formula_dict(smiles)
-    formula_str = "".join(
-        [f"{symbol}{element}" for symbol, element in formula_dict.items()]
+def build_molecules_by_ids_query(molecule_ids: Sequence[int]):
+    return (
+        select(Molecule)
+        .where(col(Molecule.id).in_(list(molecule_ids)))
+        .options(*get_molecule_load_options())
     )
-    session_molecule = session.exec(
+
+
+def get_molecules_by_ids(
+    *, session: Session, molecule_ids: Sequence[int]
+) -> Sequence[Molecule]:
+    """
+    Fetch molecules with one `IN` query, in the order of `molecule_ids`.
+    """
+    if not molecule_ids:
+        return []
+    return order_by_ids(
+        session.exec(build_molecules_by_ids_query(molecule_ids)).all(), molecule_ids
+    )
+
+
+async def get_molecules_by_ids_async(
+    *, session: AsyncSession, molecule_ids: Sequence[int]
+) -> Sequence[Molecule]:
+    if not molecule_ids:
+        return []
+    return order_by_ids(
+        (await session.exec(build_molecules_by_ids_query(molecule_ids))).all(),
+        molecule_ids,
+    )
+
+
+def smiles_to_formula_str(smiles: str) -> str:
+    formula_dict = smiles_to_formula_dict(smiles)
+    return "".join([f"{symbol}{element}" for symbol, element in formula_dict.items()])
+
+
+def build_molecule_by_smiles_query(smiles: str, formula_str: str):
+    return (
         select(Molecule)
         .join(Formula)
         .where(Formula.formula_string == formula_str)
         .where(Molecule.smiles == smiles)
+        .options(*get_molecule_load_options())
+    )
+
+
+def get_molecule_by_smiles(*, session: Session, smiles: str) -> Molecule:
+    formula_str = smiles_to_formula_str(smiles)
+    session_molecule = session.exec(
+        build_molecule_by_smiles_query(smiles, formula_str)
     ).first()
     return session_molecule
 
 
-def get_molecules_by_smiles(
+async def get_molecule_by_smiles_async(
+    *, session: AsyncSession, smiles: str
+) -> Molecule:
+    formula_str = await run_rdkit(smiles_to_formula_str, smiles)
+    return (
+        await session.exec(build_molecule_by_smiles_query(smiles, formula_str))
+    ).first()
+
+
+def build_molecules_by_smiles_page_query(
+    embedding: List[int],
+    method: Literal["morgan", "rdk", "atompair", "torsion"],
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+    skip: int = 0,
+    limit: int = 5,
+    cursor: str | None = None,
+) -> tuple[Any, dict[str, Any]]:
+    fp_distance = get_distance_expression(method, distance, embedding)
+    return paginate_by_distance(
+        join_fingerprints(
+            select(Molecule, fp_distance.label("distance")), distance
+        ).options(*get_molecule_load_options()),
+        fp_distance,
+        Molecule.id,
+        skip,
+        limit,
+        cursor,
+    )
+
+
+def get_molecules_page_by_smiles(
     *,
     session: Session,
     smiles: str,
     method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
-    distance: Literal["l2", "inner_product", "cosine"] = "cosine",
+    distance: Literal[
+        "l2", "inner_product", "cosine", "tanimoto", "hamming"
+    ] = "cosine",
     skip: int = 0,
     limit: int = 5,
-) -> Sequence[Molecule]:
+    cursor: str | None = None,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> tuple[Sequence[Molecule], str | None]:
+    """
+    One page of the molecules closest to `smiles`, and the cursor of the next page.
+
+    Pages are served from the result cache when the same search was made before.
+    """
+    cache_key = result_cache_key(
+        "molecules/smiles",
+        smiles=smiles,
+        method=method,
+        distance=distance,
+        skip=skip,
+        limit=limit,
+        cursor=cursor,
+        ef_search=ef_search,
+        probes=probes,
+    )
+    cached = get_cached_page(cache_key)
+    if cached is not None:
+        ids, next_cursor = cached
+        return get_molecules_by_ids(session=session, molecule_ids=ids), next_cursor
     embedding = smi_to_embedding(smiles, method)
-    query = select(Molecule)
-    if method == "morgan":
-        fp = Molecule.morgan_fp3_1024
-    elif method == "rdk":
-        fp = Molecule.rdkit_fp_1024
-    elif method == "atompair":
-        fp = Molecule.atompair_fp_1024
-    elif method == "torsion":
-        fp = Molecule.topological_torsion_fp_1024
-    else:
-        raise ValueError("Invalid embedding method")
-    if distance == "l2":
-        query = query.order_by(fp.l2_distance(embedding))
-    elif distance == "inner_product":
-        query = query.order_by(fp.max_inner_product(embedding))
-    elif distance == "cosine":
-        query = query.order_by(fp.cosine_distance(embedding))
-    session_molecules = session.exec(query.offset(skip).limit(limit)).all()
-    return session_molecules
+    query, key = build_molecules_by_smiles_page_query(
+        embedding, method, distance, skip, limit, cursor
+    )
+    set_vector_search_params(
+        session=session, ef_search=ef_search, probes=probes, limit=key["depth"] + limit
+    )
+    db_molecules, next_cursor = page_result(session.exec(query).all(), key, limit)
+    cache_page(cache_key, db_molecules, next_cursor)
+    return db_molecules, next_cursor
 
 
-def get_molecules_by_conditions(
+async def get_molecules_page_by_smiles_async(
+    *,
+    session: AsyncSession,
+    smiles: str,
+    method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+    distance: Literal[
+        "l2", "inner_product", "cosine", "tanimoto", "hamming"
+    ] = "cosine",
+    skip: int = 0,
+    limit: int = 5,
+    cursor: str | None = None,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> tuple[Sequence[Molecule], str | None]:
+    cache_key = await result_cache_key_async(
+        "molecules/smiles",
+        smiles=smiles,
+        method=method,
+        distance=distance,
+        skip=skip,
+        limit=limit,
+        cursor=cursor,
+        ef_search=ef_search,
+        probes=probes,
+    )
+    cached = get_cached_page(cache_key)
+    if cached is not None:
+        ids, next_cursor = cached
+        db_molecules = await get_molecules_by_ids_async(
+            session=session, molecule_ids=ids
+        )
+        return db_molecules, next_cursor
+    embedding = await run_rdkit(smi_to_embedding, smiles, method)
+    query, key = build_molecules_by_smiles_page_query(
+        embedding, method, distance, skip, limit, cursor
+    )
+    await set_vector_search_params_async(
+        session=session, ef_search=ef_search, probes=probes, limit=key["depth"] + limit
+    )
+    db_molecules, next_cursor = page_result(
+        (await session.exec(query)).all(), key, limit
+    )
+    cache_page(cache_key, db_molecules, next_cursor)
+    return db_molecules, next_cursor
+
+
+def get_molecules_by_smiles(
     *,
     session: Session,
-    molecule_filter: MoleculeFilter = None,
+    smiles: str,
+    method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+    distance: Literal[
+        "l2", "inner_product", "cosine", "tanimoto", "hamming"
+    ] = "cosine",
     skip: int = 0,
-    limit: int = 100,
+    limit: int = 5,
+    cursor: str | None = None,
+    ef_search: int | None = None,
+    probes: int | None = None,
 ) -> Sequence[Molecule]:
-    query = select(Molecule).join(Formula)
+    session_molecules, _ = get_molecules_page_by_smiles(
+        session=session,
+        smiles=smiles,
+        method=method,
+        distance=distance,
+        skip=skip,
+        limit=limit,
+        cursor=cursor,
+        ef_search=ef_search,
+        probes=probes,
+    )
+    return session_molecules
+
+
+def build_molecules_by_smiles_batch_query(
+    embeddings: List[List[int]],
+    method: Literal["morgan", "rdk", "atompair", "torsion"],
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+    limit: int = 5,
+):
+    """
+    `(query_idx, Molecule)` rows of the `limit` nearest molecules of every embedding,
+    with a `LATERAL` join over the unnested query fingerprints.
+    """
+    queries = unnest_embeddings(embeddings, distance)
+    fp_distance = get_distance_expression(method, distance, queries.c.embedding)
+    neighbours = join_fingerprints(
+        select(Molecule.id.label("molecule_id"), fp_distance.label("distance")),
+        distance,
+    )
+    neighbours = (
+        neighbours.order_by(fp_distance)
+        .limit(limit)
+        .correlate(queries)
+        .lateral("neighbours")
+    )
+    return (
+        select(queries.c.query_idx, Molecule)
+        .select_from(queries)
+        .join(neighbours, true())
+        .join(Molecule, Molecule.id == neighbours.c.molecule_id)
+        .order_by(queries.c.query_idx, neighbours.c.distance)
+        .options(*get_molecule_load_options())
+    )
+
+
+def group_batch_rows(rows, size: int) -> list[list[Molecule]]:
+    results = [[] for _ in range(size)]
+    for query_idx, molecule in rows:
+        results[query_idx - 1].append(molecule)
+    return results
+
+
+def get_molecules_by_smiles_batch(
+    *,
+    session: Session,
+    smiles_list: Sequence[str],
+    method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+    distance: Literal[
+        "l2", "inner_product", "cosine", "tanimoto", "hamming"
+    ] = "cosine",
+    limit: int = 5,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[list[Molecule]]:
+    """
+    Nearest molecules for every SMILES in `smiles_list`, resolved in one statement.
+    """
+    if not smiles_list:
+        return []
+    embeddings = smis_to_embeddings(smiles_list, method)
+    statement = build_molecules_by_smiles_batch_query(
+        embeddings, method, distance, limit
+    )
+    set_vector_search_params(
+        session=session, ef_search=ef_search, probes=probes, limit=limit
+    )
+    return group_batch_rows(session.exec(statement).all(), len(smiles_list))
+
+
+async def get_molecules_by_smiles_batch_async(
+    *,
+    session: AsyncSession,
+    smiles_list: Sequence[str],
+    method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+    distance: Literal[
+        "l2", "inner_product", "cosine", "tanimoto", "hamming"
+    ] = "cosine",
+    limit: int = 5,
+    ef_search: int | None = None,
+    probes: int | None = None,
+) -> list[list[Molecule]]:
+    if not smiles_list:
+        return []
+    embeddings = await run_rdkit(smis_to_embeddings, smiles_list, method)
+    statement = build_molecules_by_smiles_batch_query(
+        embeddings, method, distance, limit
+    )
+    await set_vector_search_params_async(
+        session=session, ef_search=ef_search, probes=probes, limit=limit
+    )
+    return group_batch_rows((await session.exec(statement)).all(), len(smiles_list))
+
+
+def build_molecules_query(molecule_filter: MoleculeFilter | None = None, *entities):
+    """
+    The `Molecule`-`Formula` join selecting `entities` (the `Molecule` model by
+    default), restricted by the element and numeric filters of `molecule_filter`.
+    Ordering is left to the caller.
+    """
+    query = select(*(entities or (Molecule,))).select_from(Molecule)
+    if molecule_filter and molecule_filter.smiles:
+        query = join_fingerprints(query, molecule_filter.distance)
+    query = query.join(Formula)
     if molecule_filter:
         # element filters
         for element_filter in molecule_filter.element_filters:
@@ -96,31 +421,160 @@ def get_molecules_by_conditions(
                 query = query.where(
                     getattr(Molecule, numeric_filter.column) >= numeric_filter.min
                 ).where(getattr(Molecule, numeric_filter.column) <= numeric_filter.max)
-        if molecule_filter.smiles:
-            embedding = smi_to_embedding(molecule_filter.smiles, molecule_filter.method)
-            method = molecule_filter.method
-            distance = molecule_filter.distance
-            if method == "morgan":
-                fp = Molecule.morgan_fp3_1024
-            elif method == "rdk":
-                fp = Molecule.rdkit_fp_1024
-            elif method == "atompair":
-                fp = Molecule.atompair_fp_1024
-            elif method == "torsion":
-                fp = Molecule.topological_torsion_fp_1024
-            else:
-                raise ValueError("Invalid embedding method")
-            if distance == "l2":
-                query = query.order_by(fp.l2_distance(embedding))
-            elif distance == "inner_product":
-                query = query.order_by(fp.max_inner_product(embedding))
-            elif distance == "cosine":
-                query = query.order_by(fp.cosine_distance(embedding))
-    statement = query.offset(skip).limit(limit).order_by(Molecule.id)
-    db_molecules = session.exec(statement).all()
+    return query
+
+
+def build_molecules_page_query(
+    molecule_filter: MoleculeFilter | None = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+    embedding: List[int] | None = None,
+) -> tuple[Any, dict[str, Any] | None]:
+    """
+    The statement of one page of `get_molecules_page_by_conditions`, and the distance
+    cursor key, `None` when paging by id.
+    """
+    fp_distance = get_filter_distance(molecule_filter, embedding)
+    if fp_distance is None:
+        query = build_molecules_query(molecule_filter)
+        query = query.options(*get_molecule_load_options())
+        return paginate_by_id(query, Molecule.id, skip, limit, cursor), None
+    query = build_molecules_query(
+        molecule_filter, Molecule, fp_distance.label("distance")
+    ).options(*get_molecule_load_options())
+    return paginate_by_distance(query, fp_distance, Molecule.id, skip, limit, cursor)
+
+
+def get_molecules_page_by_conditions(
+    *,
+    session: Session,
+    molecule_filter: MoleculeFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> tuple[Sequence[Molecule], str | None]:
+    """
+    One page of molecules, and the cursor of the next page.
+
+    Pages are ordered by id, or by fingerprint distance when `molecule_filter.smiles`
+    is set. `cursor` continues after the previous page without an `OFFSET` scan,
+    `skip` is only kept for backwards compatibility. Pages are served from the result
+    cache when the same (normalized) filter was queried before.
+    """
+    cache_key = result_cache_key(
+        "molecules", molecule_filter, skip=skip, limit=limit, cursor=cursor
+    )
+    cached = get_cached_page(cache_key)
+    if cached is not None:
+        ids, next_cursor = cached
+        return get_molecules_by_ids(session=session, molecule_ids=ids), next_cursor
+    statement, key = build_molecules_page_query(molecule_filter, skip, limit, cursor)
+    if key is not None:
+        set_vector_search_params(
+            session=session,
+            ef_search=molecule_filter.ef_search,
+            probes=molecule_filter.probes,
+            limit=key["depth"] + limit,
+            exact=has_row_filters(molecule_filter),
+        )
+    db_molecules, next_cursor = page_result(session.exec(statement).all(), key, limit)
+    cache_page(cache_key, db_molecules, next_cursor)
+    return db_molecules, next_cursor
+
+
+async def get_molecules_page_by_conditions_async(
+    *,
+    session: AsyncSession,
+    molecule_filter: MoleculeFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> tuple[Sequence[Molecule], str | None]:
+    cache_key = await result_cache_key_async(
+        "molecules", molecule_filter, skip=skip, limit=limit, cursor=cursor
+    )
+    cached = get_cached_page(cache_key)
+    if cached is not None:
+        ids, next_cursor = cached
+        db_molecules = await get_molecules_by_ids_async(
+            session=session, molecule_ids=ids
+        )
+        return db_molecules, next_cursor
+    embedding = await get_filter_embedding_async(molecule_filter)
+    statement, key = build_molecules_page_query(
+        molecule_filter, skip, limit, cursor, embedding
+    )
+    if key is not None:
+        await set_vector_search_params_async(
+            session=session,
+            ef_search=molecule_filter.ef_search,
+            probes=molecule_filter.probes,
+            limit=key["depth"] + limit,
+            exact=has_row_filters(molecule_filter),
+        )
+    db_molecules, next_cursor = page_result(
+        (await session.exec(statement)).all(), key, limit
+    )
+    cache_page(cache_key, db_molecules, next_cursor)
+    return db_molecules, next_cursor
+
+
+def get_molecules_by_conditions(
+    *,
+    session: Session,
+    molecule_filter: MoleculeFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> Sequence[Molecule]:
+    db_molecules, _ = get_molecules_page_by_conditions(
+        session=session,
+        molecule_filter=molecule_filter,
+        skip=skip,
+        limit=limit,
+        cursor=cursor,
+    )
     return db_molecules
 
-def get_molecule_count(*, session: Session) -> ItemCount:
-    count_statement = select(func.count()).select_from(Molecule)
-    count = session.exec(count_statement).one()
-    return ItemCount(count=count)
+
+def get_molecule_count(*, session: Session, estimate: bool = False) -> ItemCount:
+    return counts.get_count(session=session, model=Molecule, estimate=estimate)
+
+
+async def get_molecule_count_async(
+    *, session: AsyncSession, estimate: bool = False
+) -> ItemCount:
+    return await counts.get_count_async(
+        session=session, model=Molecule, estimate=estimate
+    )
+
+
+def build_molecule_count_query(molecule_filter: MoleculeFilter | None = None):
+    return build_molecules_query(counts.without_ordering(molecule_filter), func.count())
+
+
+def get_molecule_count_by_conditions(
+    *, session: Session, molecule_filter: MoleculeFilter = None
+) -> ItemCount:
+    """
+    The number of molecules matching `molecule_filter`; its SMILES only orders the
+    results and is ignored.
+    """
+    return counts.get_count(
+        session=session,
+        model=Molecule,
+        statement=build_molecule_count_query(molecule_filter),
+        key=counts.count_filter_key(molecule_filter or MoleculeFilter()),
+    )
+
+
+async def get_molecule_count_by_conditions_async(
+    *, session: AsyncSession, molecule_filter: MoleculeFilter = None
+) -> ItemCount:
+    return await counts.get_count_async(
+        session=session,
+        model=Molecule,
+        statement=build_molecule_count_query(molecule_filter),
+        key=counts.count_filter_key(molecule_filter or MoleculeFilter()),
+    )
@@ -0,0 +1,282 @@
+"""
+Cache of filter and similarity query results.
+
+A page of results is stored as its ids and next cursor, under a key built from the
+canonical form of the query (see `result_cache_key`). A hit skips the filtered SQL
+and, for SMILES queries, the fingerprinting; the rows are then loaded by primary key.
+The database is read-only after restore, so entries are only evicted for size, or
+dropped when a session of this process flushes any change.
+
+The backend is pluggable: the in-process `LRUCache` by default, or `SQLiteCache`,
+an on-disk stand-in for a cache shared by several workers:
+
+```python
+from qm9star_query.crud.result_cache import SQLiteCache, set_result_cache
+
+set_result_cache(SQLiteCache("result_cache.sqlite3", max_bytes=256 * 2**20))
+```
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Sequence
+
+from rdkit import Chem
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel
+
+from qm9star_query.crud.utils import filter_cache_key
+from qm9star_query.utils import run_rdkit
+
+# a cached page: the ids of its items and the cursor of the next page
+CachedPage = tuple[list[int], str | None]
+
+
+class ResultCache(ABC):
+    """
+    Base class of the cache backends, which store JSON-serializable pages by key
+    and evict the least recently used ones beyond `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> CachedPage | None:
+        with self._lock:
+            value = self._get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        ids, next_cursor = json.loads(value)
+        return ids, next_cursor
+
+    def set(self, key: str, page: CachedPage) -> None:
+        value = json.dumps(page, separators=(",", ":"))
+        if len(key) + len(value) > self.max_bytes:
+            return
+        with self._lock:
+            self.evictions += self._set(key, value)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            entries, size = self._size()
+            return {
+                "backend": type(self).__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+            }
+
+    @abstractmethod
+    def _get(self, key: str) -> str | None: ...
+
+    @abstractmethod
+    def _set(self, key: str, value: str) -> int:
+        """
+        Store `value` and return the number of entries evicted to make room.
+        """
+
+    @abstractmethod
+    def _clear(self) -> None: ...
+
+    @abstractmethod
+    def _size(self) -> tuple[int, int]:
+        """
+        The number of entries and their total size.
+        """
+
+
+class LRUCache(ResultCache):
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        super().__init__(max_bytes)
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._bytes = 0
+
+    def _get(self, key: str) -> str | None:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value: str) -> int:
+        if key in self._entries:
+            self._bytes -= len(key) + len(self._entries.pop(key))
+        self._entries[key] = value
+        self._bytes += len(key) + len(value)
+        evicted = 0
+        while self._bytes > self.max_bytes:
+            old_key, old_value = self._entries.popitem(last=False)
+            self._bytes -= len(old_key) + len(old_value)
+            evicted += 1
+        return evicted
+
+    def _clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _size(self) -> tuple[int, int]:
+        return len(self._entries), self._bytes
+
+
+class SQLiteCache(ResultCache):
+    def __init__(self, path: str, max_bytes: int = 256 * 2**20):
+        """
+        Args:
+            path: the SQLite database file, shared by every process opening it.
+            max_bytes: total size of the keys and values kept.
+        """
+        super().__init__(max_bytes)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS result_cache "
+            "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_result_cache_accessed "
+            "ON result_cache (accessed)"
+        )
+        self._conn.commit()
+
+    def _get(self, key: str) -> str | None:
+        with self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM result_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE result_cache SET accessed = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return row[0]
+
+    def _set(self, key: str, value: str) -> int:
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?, ?)",
+                (key, value, len(key) + len(value), time.time()),
+            )
+            total = self._conn.execute(
+                "SELECT coalesce(sum(size), 0) FROM result_cache"
+            ).fetchone()[0]
+            evicted = 0
+            if total > self.max_bytes:
+                # drop the least recently used rows until the rest fits
+                rows = self._conn.execute(
+                    "SELECT key, size FROM result_cache ORDER BY accessed"
+                ).fetchall()
+                stale = []
+                for old_key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((old_key,))
+                    total -= size
+                self._conn.executemany("DELETE FROM result_cache WHERE key = ?", stale)
+                evicted = len(stale)
+        return evicted
+
+    def _clear(self) -> None:
+        with self._conn:
+            self._conn.execute("DELETE FROM result_cache")
+
+    def _size(self) -> tuple[int, int]:
+        return self._conn.execute(
+            "SELECT count(*), coalesce(sum(size), 0) FROM result_cache"
+        ).fetchone()
+
+
+_result_cache: ResultCache | None = LRUCache()
+
+
+def get_result_cache() -> ResultCache | None:
+    return _result_cache
+
+
+def set_result_cache(cache: ResultCache | None) -> None:
+    """
+    Replace the result cache of this process, `None` disables caching.
+    """
+    global _result_cache
+    _result_cache = cache
+
+
+@event.listens_for(Session, "after_flush")
+def _clear_flushed_results(session: Session, flush_context) -> None:
+    if _result_cache is not None and (session.new or session.dirty or session.deleted):
+        _result_cache.clear()
+
+
+def canonical_smiles(smiles: str) -> str:
+    try:
+        return Chem.CanonSmiles(smiles)
+    except Exception:
+        return smiles
+
+
+def result_cache_key(
+    kind: str, query_filter: SQLModel | None = None, **params: Any
+) -> str:
+    """
+    The key of one page of `kind` results: the canonical filter (sorted filter lists,
+    canonical SMILES) and the paging `params`.
+    """
+    if query_filter is not None and getattr(query_filter, "smiles", None):
+        query_filter = query_filter.model_copy(
+            update={"smiles": canonical_smiles(query_filter.smiles)}
+        )
+    if "smiles" in params:
+        params["smiles"] = canonical_smiles(params["smiles"])
+    return json.dumps(
+        [
+            kind,
+            (
+                None
+                if query_filter is None
+                else json.loads(filter_cache_key(query_filter))
+            ),
+            params,
+        ],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+async def result_cache_key_async(
+    kind: str, query_filter: SQLModel | None = None, **params: Any
+) -> str:
+    """
+    `result_cache_key` for the async routes, canonicalizing the SMILES with RDKit in
+    `run_rdkit` rather than on the event loop.
+    """
+    if params.get("smiles") or getattr(query_filter, "smiles", None):
+        return await run_rdkit(result_cache_key, kind, query_filter, **params)
+    return result_cache_key(kind, query_filter, **params)
+
+
+def get_cached_page(key: str) -> CachedPage | None:
+    if _result_cache is None:
+        return None
+    return _result_cache.get(key)
+
+
+def cache_page(key: str, items: Sequence[Any], next_cursor: str | None) -> None:
+    if _result_cache is not None:
+        _result_cache.set(key, ([item.id for item in items], next_cursor))
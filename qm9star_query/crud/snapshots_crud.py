@@ -1,10 +1,34 @@
-from typing import Sequence
+from typing import Any, Iterator, Sequence
 
+from sqlalchemy import Column
+from sqlalchemy.orm import load_only, selectinload
 from sqlmodel import Session, col, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from qm9star_query.models import Formula, Molecule, Snapshot
+from qm9star_query.crud import counts, molecules_crud
+from qm9star_query.crud.result_cache import (
+    cache_page,
+    get_cached_page,
+    result_cache_key,
+    result_cache_key_async,
+)
+from qm9star_query.crud.utils import (
+    get_filter_distance,
+    get_filter_embedding_async,
+    has_row_filters,
+    join_fingerprints,
+    join_missing,
+    order_by_ids,
+    page_result,
+    paginate_by_distance,
+    paginate_by_id,
+    record_version,
+    set_vector_search_params,
+    set_vector_search_params_async,
+)
+from qm9star_query.models import Formula, Molecule, Snapshot, SnapshotSDF
 from qm9star_query.models.utils import ItemCount, SnapshotFilter
-from qm9star_query.utils import elements_in_pt, smi_to_embedding, smiles_to_formula_dict
+from qm9star_query.utils import elements_in_pt, run_rdkit
 
 numeric_cols = (
     "temperature",
@@ -33,38 +57,278 @@ numeric_cols = (
     "spin_square",
 )
 
+
 def get_snapshot_ids(*, session: Session) -> Sequence[int]:
     return session.exec(select(Snapshot.id)).all()
 
 
-def get_snapshot_by_id(*, session: Session, snapshot_id: int) -> Snapshot:
-    return session.get(Snapshot, snapshot_id)
+def get_snapshot_by_id(
+    *, session: Session, snapshot_id: int, columns: Sequence[str] | None = None
+) -> Snapshot:
+    return session.get(
+        Snapshot, snapshot_id, options=get_snapshot_load_options(columns)
+    )
 
 
-def get_snapshot_by_smiles_hash(*, session: Session, smiles: str, snapshot_hash: str):
-    formula_dict = smiles_to_formula_dict(smiles)
-    formula_str = "".join(
-        [f"{symbol}{element}" for symbol, element in formula_dict.items()]
+async def get_snapshot_by_id_async(
+    *, session: AsyncSession, snapshot_id: int, columns: Sequence[str] | None = None
+) -> Snapshot:
+    return await session.get(
+        Snapshot, snapshot_id, options=get_snapshot_load_options(columns)
     )
-    db_snapshot = session.exec(
+
+
+def build_snapshot_version_query(snapshot_id: int):
+    # `SnapshotOut` embeds the molecule and its formula
+    return (
+        select(
+            Snapshot.id,
+            Snapshot.hash_token,
+            Snapshot.update_time,
+            Molecule.update_time,
+            Formula.update_time,
+        )
+        .select_from(Snapshot)
+        .join(Molecule, Snapshot.molecule_id == Molecule.id)
+        .join(Formula, Molecule.formula_id == Formula.id)
+        .where(Snapshot.id == snapshot_id)
+    )
+
+
+def get_snapshot_version(*, session: Session, snapshot_id: int) -> str | None:
+    """
+    A string that changes whenever the snapshot changes, read without loading it.
+    """
+    return record_version(
+        session.exec(build_snapshot_version_query(snapshot_id)).first()
+    )
+
+
+async def get_snapshot_version_async(
+    *, session: AsyncSession, snapshot_id: int
+) -> str | None:
+    return record_version(
+        (await session.exec(build_snapshot_version_query(snapshot_id))).first()
+    )
+
+
+def build_snapshots_by_ids_query(
+    snapshot_ids: Sequence[int], columns: Sequence[str] | None = None
+):
+    return (
+        select(Snapshot)
+        .where(col(Snapshot.id).in_(list(snapshot_ids)))
+        .options(*get_snapshot_load_options(columns))
+    )
+
+
+def get_snapshots_by_ids(
+    *,
+    session: Session,
+    snapshot_ids: Sequence[int],
+    columns: Sequence[str] | None = None,
+) -> Sequence[Snapshot]:
+    """
+    Fetch snapshots with one `IN` query, in the order of `snapshot_ids`.
+    """
+    if not snapshot_ids:
+        return []
+    return order_by_ids(
+        session.exec(build_snapshots_by_ids_query(snapshot_ids, columns)).all(),
+        snapshot_ids,
+    )
+
+
+async def get_snapshots_by_ids_async(
+    *,
+    session: AsyncSession,
+    snapshot_ids: Sequence[int],
+    columns: Sequence[str] | None = None,
+) -> Sequence[Snapshot]:
+    if not snapshot_ids:
+        return []
+    return order_by_ids(
+        (await session.exec(build_snapshots_by_ids_query(snapshot_ids, columns))).all(),
+        snapshot_ids,
+    )
+
+
+# set once the `snapshotsdf` table is seen, it is created by `qm9star-build-sdf`
+_sdf_table_exists = False
+
+
+def build_sdf_table_exists_query():
+    return select(func.to_regclass(SnapshotSDF.__tablename__).is_not(None))
+
+
+def sdf_table_exists(*, session: Session) -> bool:
+    global _sdf_table_exists
+    if not _sdf_table_exists:
+        _sdf_table_exists = session.exec(build_sdf_table_exists_query()).one()
+    return _sdf_table_exists
+
+
+async def sdf_table_exists_async(*, session: AsyncSession) -> bool:
+    global _sdf_table_exists
+    if not _sdf_table_exists:
+        _sdf_table_exists = (await session.exec(build_sdf_table_exists_query())).one()
+    return _sdf_table_exists
+
+
+def build_precomputed_sdf_blocks_query(hash_tokens: Sequence[str]):
+    return select(SnapshotSDF).where(
+        col(SnapshotSDF.hash_token).in_(list(set(hash_tokens)))
+    )
+
+
+def get_precomputed_sdf_blocks(
+    *, session: Session, hash_tokens: Sequence[str | None]
+) -> dict[str, str]:
+    """
+    The SDF blocks of `hash_tokens` found in the `snapshotsdf` table (filled by
+    `qm9star-build-sdf`), by hash token; the missing ones are rendered by the caller.
+    Empty until that table is created.
+    """
+    hash_tokens = [token for token in hash_tokens if token]
+    if not hash_tokens or not sdf_table_exists(session=session):
+        return {}
+    return {
+        row.hash_token: row.sdf_block
+        for row in session.exec(build_precomputed_sdf_blocks_query(hash_tokens))
+    }
+
+
+async def get_precomputed_sdf_blocks_async(
+    *, session: AsyncSession, hash_tokens: Sequence[str | None]
+) -> dict[str, str]:
+    hash_tokens = [token for token in hash_tokens if token]
+    if not hash_tokens or not await sdf_table_exists_async(session=session):
+        return {}
+    return {
+        row.hash_token: row.sdf_block
+        for row in (
+            await session.exec(build_precomputed_sdf_blocks_query(hash_tokens))
+        ).all()
+    }
+
+
+def build_snapshots_by_molecule_id_query(
+    molecule_id: int, columns: Sequence[str] | None = None
+):
+    return (
+        select(Snapshot)
+        .where(Snapshot.molecule_id == molecule_id)
+        .options(*get_snapshot_load_options(columns))
+        .order_by(Snapshot.id)
+    )
+
+
+def get_snapshots_by_molecule_id(
+    *, session: Session, molecule_id: int, columns: Sequence[str] | None = None
+) -> Sequence[Snapshot]:
+    return session.exec(
+        build_snapshots_by_molecule_id_query(molecule_id, columns)
+    ).all()
+
+
+async def get_snapshots_by_molecule_id_async(
+    *, session: AsyncSession, molecule_id: int, columns: Sequence[str] | None = None
+) -> Sequence[Snapshot]:
+    return (
+        await session.exec(build_snapshots_by_molecule_id_query(molecule_id, columns))
+    ).all()
+
+
+def build_snapshot_by_smiles_hash_query(
+    smiles: str, formula_str: str, snapshot_hash: str
+):
+    return (
         select(Snapshot)
         .join(Molecule)
         .join(Formula)
         .where(Formula.formula_string == formula_str)
         .where(Molecule.smiles == smiles)
         .where(Snapshot.hash_token == snapshot_hash)
+        .options(*get_snapshot_load_options())
+    )
+
+
+def get_snapshot_by_smiles_hash(*, session: Session, smiles: str, snapshot_hash: str):
+    formula_str = molecules_crud.smiles_to_formula_str(smiles)
+    db_snapshot = session.exec(
+        build_snapshot_by_smiles_hash_query(smiles, formula_str, snapshot_hash)
     ).first()
     return db_snapshot
 
 
-def get_snapshots_by_conditions(
-    *,
-    session: Session,
-    snapshot_filter: SnapshotFilter = None,
-    skip: int = 0,
-    limit: int = 100,
-) -> Sequence[Snapshot]:
-    query = select(Snapshot).join(Molecule).join(Formula)
+async def get_snapshot_by_smiles_hash_async(
+    *, session: AsyncSession, smiles: str, snapshot_hash: str
+):
+    formula_str = await run_rdkit(molecules_crud.smiles_to_formula_str, smiles)
+    return (
+        await session.exec(
+            build_snapshot_by_smiles_hash_query(smiles, formula_str, snapshot_hash)
+        )
+    ).first()
+
+
+def get_snapshot_columns(columns: Sequence[str] | None = None) -> list[Column]:
+    """
+    The `snapshot` table columns named in `columns`, all of them by default.
+    """
+    if columns is None:
+        return list(Snapshot.__table__.columns)
+    unknown = [name for name in columns if name not in Snapshot.__table__.columns]
+    if unknown:
+        raise ValueError(f"Unknown snapshot columns: {', '.join(unknown)}")
+    return [Snapshot.__table__.columns[name] for name in dict.fromkeys(columns)]
+
+
+def get_snapshot_load_options(columns: Sequence[str] | None = None) -> list:
+    """
+    ORM loader options matching `SnapshotOut`, restricted to `columns` of `Snapshot`
+    plus its id when given.
+
+    Unrequested columns are deferred, so e.g. an energy-only query does not transfer
+    the bond order matrices. The molecules (and their formulas) of a whole page are
+    loaded with one `IN` query each instead of one lazy load per snapshot; `molecule`
+    in `columns` requests them.
+    """
+    molecule_options = selectinload(Snapshot.molecule).options(
+        *molecules_crud.get_molecule_load_options()
+    )
+    if columns is None:
+        return [molecule_options]
+    selected = get_snapshot_columns([name for name in columns if name != "molecule"])
+    options = [
+        load_only(Snapshot.id, *[getattr(Snapshot, column.name) for column in selected])
+    ]
+    if "molecule" in columns:
+        options.append(molecule_options)
+    return options
+
+
+def build_snapshots_query(snapshot_filter: SnapshotFilter | None = None, *entities):
+    """
+    The `Snapshot`-`Molecule`-`Formula` join selecting `entities` (the `Snapshot` model
+    by default), restricted by the element, numeric, class and bool filters of
+    `snapshot_filter`. Ordering is left to the caller.
+    """
+    return filter_snapshots_query(
+        select(*(entities or (Snapshot,))).select_from(Snapshot), snapshot_filter
+    )
+
+
+def filter_snapshots_query(query, snapshot_filter: SnapshotFilter | None = None):
+    """
+    `query`, a select from `Snapshot`, joined to `Molecule` and `Formula` (those it
+    does not join yet, see `join_missing`) and restricted by `snapshot_filter` as in
+    `build_snapshots_query`.
+    """
+    query = join_missing(query, Molecule)
+    if snapshot_filter and snapshot_filter.smiles is not None:
+        query = join_fingerprints(query, snapshot_filter.distance)
+    query = join_missing(query, Formula)
     if snapshot_filter:
         # element filters
         for element_filter in snapshot_filter.element_filters:
@@ -108,34 +372,233 @@ def get_snapshots_by_conditions(
                 query = query.where(
                     getattr(Snapshot, bool_filter.column) == bool_filter.value
                 )
-        if snapshot_filter.smiles is not None:
-            embedding = smi_to_embedding(snapshot_filter.smiles, snapshot_filter.method)
-            method = snapshot_filter.method
-            distance = snapshot_filter.distance
-            if method == "morgan":
-                fp = Molecule.morgan_fp3_1024
-            elif method == "rdk":
-                fp = Molecule.rdkit_fp_1024
-            elif method == "atompair":
-                fp = Molecule.atompair_fp_1024
-            elif method == "torsion":
-                fp = Molecule.topological_torsion_fp_1024
-            else:
-                raise ValueError("Invalid embedding method")
-            if distance == "l2":
-                query = query.order_by(fp.l2_distance(embedding))
-            elif distance == "inner_product":
-                query = query.order_by(fp.max_inner_product(embedding))
-            elif distance == "cosine":
-                query = query.order_by(fp.cosine_distance(embedding))
-    statement = query.offset(skip).limit(limit).order_by(Snapshot.id)
-    return session.exec(statement).all()
-
-
-def get_snapshot_count(*, session: Session) -> ItemCount:
-    count_statement = select(func.count()).select_from(Snapshot)
-    count = session.exec(count_statement).one()
-    return ItemCount(count=count)
+    return query
+
+
+def build_snapshots_page_query(
+    snapshot_filter: SnapshotFilter | None = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+    columns: Sequence[str] | None = None,
+    embedding: list[int] | None = None,
+) -> tuple[Any, dict[str, Any] | None]:
+    """
+    The statement of one page of `get_snapshots_page_by_conditions`, and the distance
+    cursor key, `None` when paging by id.
+    """
+    options = get_snapshot_load_options(columns)
+    fp_distance = get_filter_distance(snapshot_filter, embedding)
+    if fp_distance is None:
+        query = build_snapshots_query(snapshot_filter).options(*options)
+        return paginate_by_id(query, Snapshot.id, skip, limit, cursor), None
+    query = build_snapshots_query(
+        snapshot_filter, Snapshot, fp_distance.label("distance")
+    ).options(*options)
+    return paginate_by_distance(query, fp_distance, Snapshot.id, skip, limit, cursor)
+
+
+def get_snapshots_page_by_conditions(
+    *,
+    session: Session,
+    snapshot_filter: SnapshotFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+    columns: Sequence[str] | None = None,
+) -> tuple[Sequence[Snapshot], str | None]:
+    """
+    One page of snapshots, and the cursor of the next page.
+
+    Pages are ordered by id, or by the fingerprint distance of their molecule when
+    `snapshot_filter.smiles` is set. `cursor` continues after the previous page
+    without an `OFFSET` scan, `skip` is only kept for backwards compatibility.
+    `columns` restricts the loaded columns, see `get_snapshot_load_options`.
+
+    Pages are served from the result cache when the same (normalized) filter was
+    queried before, whatever the `columns`.
+    """
+    cache_key = result_cache_key(
+        "snapshots", snapshot_filter, skip=skip, limit=limit, cursor=cursor
+    )
+    cached = get_cached_page(cache_key)
+    if cached is not None:
+        ids, next_cursor = cached
+        db_snapshots = get_snapshots_by_ids(
+            session=session, snapshot_ids=ids, columns=columns
+        )
+        return db_snapshots, next_cursor
+    statement, key = build_snapshots_page_query(
+        snapshot_filter, skip, limit, cursor, columns
+    )
+    if key is not None:
+        set_vector_search_params(
+            session=session,
+            ef_search=snapshot_filter.ef_search,
+            probes=snapshot_filter.probes,
+            limit=key["depth"] + limit,
+            exact=has_row_filters(snapshot_filter),
+        )
+    db_snapshots, next_cursor = page_result(session.exec(statement).all(), key, limit)
+    cache_page(cache_key, db_snapshots, next_cursor)
+    return db_snapshots, next_cursor
+
+
+async def get_snapshots_page_by_conditions_async(
+    *,
+    session: AsyncSession,
+    snapshot_filter: SnapshotFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+    columns: Sequence[str] | None = None,
+) -> tuple[Sequence[Snapshot], str | None]:
+    cache_key = await result_cache_key_async(
+        "snapshots", snapshot_filter, skip=skip, limit=limit, cursor=cursor
+    )
+    cached = get_cached_page(cache_key)
+    if cached is not None:
+        ids, next_cursor = cached
+        db_snapshots = await get_snapshots_by_ids_async(
+            session=session, snapshot_ids=ids, columns=columns
+        )
+        return db_snapshots, next_cursor
+    embedding = await get_filter_embedding_async(snapshot_filter)
+    statement, key = build_snapshots_page_query(
+        snapshot_filter, skip, limit, cursor, columns, embedding
+    )
+    if key is not None:
+        await set_vector_search_params_async(
+            session=session,
+            ef_search=snapshot_filter.ef_search,
+            probes=snapshot_filter.probes,
+            limit=key["depth"] + limit,
+            exact=has_row_filters(snapshot_filter),
+        )
+    db_snapshots, next_cursor = page_result(
+        (await session.exec(statement)).all(), key, limit
+    )
+    cache_page(cache_key, db_snapshots, next_cursor)
+    return db_snapshots, next_cursor
+
+
+def get_snapshots_by_conditions(
+    *,
+    session: Session,
+    snapshot_filter: SnapshotFilter = None,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+    columns: Sequence[str] | None = None,
+) -> Sequence[Snapshot]:
+    db_snapshots, _ = get_snapshots_page_by_conditions(
+        session=session,
+        snapshot_filter=snapshot_filter,
+        skip=skip,
+        limit=limit,
+        cursor=cursor,
+        columns=columns,
+    )
+    return db_snapshots
+
+
+def build_snapshots_stream_query(
+    snapshot_filter: SnapshotFilter = None,
+    columns: Sequence[str] | None = None,
+    limit: int | None = None,
+):
+    """
+    The query of `stream_snapshots_by_conditions`: the `snapshot` table `columns` (all
+    of them by default) of the snapshots matching `snapshot_filter`, in the order of
+    `get_snapshots_by_conditions`.
+
+    Raises `ValueError` on unknown columns or an invalid `snapshot_filter.smiles`.
+    """
+    selected = get_snapshot_columns(columns)
+    fp_distance = get_filter_distance(snapshot_filter)
+    query = build_snapshots_query(snapshot_filter, *selected)
+    if fp_distance is not None:
+        query = query.order_by(fp_distance)
+    else:
+        query = query.order_by(Snapshot.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def stream_snapshots_by_conditions(
+    *,
+    session: Session,
+    snapshot_filter: SnapshotFilter = None,
+    columns: Sequence[str] | None = None,
+    limit: int | None = None,
+    batch_size: int = 1000,
+    query=None,
+) -> Iterator[list[dict[str, Any]]]:
+    """
+    Stream the snapshots matching `snapshot_filter` as batches of `{column: value}`
+    rows, read through a server-side cursor so only one batch is held in memory.
+
+    Rows come in the order of `get_snapshots_by_conditions`. Only the `snapshot` table
+    columns listed in `columns` are selected, all of them by default. Pass the `query`
+    of `build_snapshots_stream_query` (for the same arguments) to report an invalid
+    filter before the first batch is requested.
+    """
+    if query is None:
+        query = build_snapshots_stream_query(snapshot_filter, columns, limit)
+    if snapshot_filter is not None and snapshot_filter.smiles:
+        set_vector_search_params(
+            session=session,
+            ef_search=snapshot_filter.ef_search,
+            probes=snapshot_filter.probes,
+            limit=limit,
+            exact=has_row_filters(snapshot_filter),
+        )
+    result = session.connection().execute(query.execution_options(yield_per=batch_size))
+    for partition in result.mappings().partitions():
+        yield [dict(row) for row in partition]
+
+
+def get_snapshot_count(*, session: Session, estimate: bool = False) -> ItemCount:
+    return counts.get_count(session=session, model=Snapshot, estimate=estimate)
+
+
+async def get_snapshot_count_async(
+    *, session: AsyncSession, estimate: bool = False
+) -> ItemCount:
+    return await counts.get_count_async(
+        session=session, model=Snapshot, estimate=estimate
+    )
+
+
+def build_snapshot_count_query(snapshot_filter: SnapshotFilter | None = None):
+    return build_snapshots_query(counts.without_ordering(snapshot_filter), func.count())
+
+
+def get_snapshot_count_by_conditions(
+    *, session: Session, snapshot_filter: SnapshotFilter = None
+) -> ItemCount:
+    """
+    The number of snapshots matching `snapshot_filter`; its SMILES only orders the
+    results and is ignored.
+    """
+    return counts.get_count(
+        session=session,
+        model=Snapshot,
+        statement=build_snapshot_count_query(snapshot_filter),
+        key=counts.count_filter_key(snapshot_filter or SnapshotFilter()),
+    )
+
+
+async def get_snapshot_count_by_conditions_async(
+    *, session: AsyncSession, snapshot_filter: SnapshotFilter = None
+) -> ItemCount:
+    return await counts.get_count_async(
+        session=session,
+        model=Snapshot,
+        statement=build_snapshot_count_query(snapshot_filter),
+        key=counts.count_filter_key(snapshot_filter or SnapshotFilter()),
+    )
 
 
 def get_snapshots_by_charge_multi(
@@ -0,0 +1,355 @@
+import base64
+import binascii
+import json
+from typing import Any, Iterable, List, Literal, Sequence
+
+from pgvector.sqlalchemy import BIT, Vector
+from sqlalchemy import ARRAY, ColumnElement, Join, Text, and_, bindparam, cast, or_
+from sqlalchemy.sql.util import find_tables
+from sqlmodel import Session, SQLModel, func, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from qm9star_query.models import Molecule, MoleculeFingerprint
+from qm9star_query.models.molecule import fingerprint_columns
+from qm9star_query.utils import run_rdkit, smi_to_embedding
+
+# distances computed on the `MoleculeFingerprint` bit columns
+bit_distances = ("tanimoto", "hamming")
+
+
+def get_fingerprint_column(
+    method: Literal["morgan", "rdk", "atompair", "torsion"], bits: bool = False
+):
+    if method not in fingerprint_columns:
+        raise ValueError("Invalid embedding method")
+    return getattr(
+        MoleculeFingerprint if bits else Molecule, fingerprint_columns[method]
+    )
+
+
+def to_bit_string(embedding: List[int]) -> str:
+    return "".join(str(bit) for bit in embedding)
+
+
+def get_distance_expression(
+    method: Literal["morgan", "rdk", "atompair", "torsion"],
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+    embedding: List[int] | ColumnElement,
+):
+    """
+    `embedding` is either a fingerprint or a SQL expression yielding one, e.g. a
+    column of `unnest_embeddings`.
+    """
+    if distance in bit_distances:
+        fp = get_fingerprint_column(method, bits=True)
+        if not isinstance(embedding, ColumnElement):
+            embedding = cast(to_bit_string(embedding), BIT(1024))
+        if distance == "tanimoto":
+            # jaccard distance on bit sets is 1 - tanimoto similarity
+            return fp.jaccard_distance(embedding)
+        return fp.hamming_distance(embedding)
+    fp = get_fingerprint_column(method)
+    if distance == "l2":
+        return fp.l2_distance(embedding)
+    elif distance == "inner_product":
+        return fp.max_inner_product(embedding)
+    elif distance == "cosine":
+        return fp.cosine_distance(embedding)
+    raise ValueError("Invalid distance metric")
+
+
+def get_filter_distance(query_filter, embedding: List[int] | None = None):
+    """
+    The fingerprint distance to `query_filter.smiles`, or `None` without a SMILES.
+
+    Pass `embedding` when the fingerprint was already computed, e.g. off the event
+    loop by `get_filter_embedding_async`.
+    """
+    if query_filter is None or not query_filter.smiles:
+        return None
+    if embedding is None:
+        embedding = smi_to_embedding(query_filter.smiles, query_filter.method)
+    return get_distance_expression(
+        query_filter.method, query_filter.distance, embedding
+    )
+
+
+async def get_filter_embedding_async(query_filter) -> List[int] | None:
+    if query_filter is None or not query_filter.smiles:
+        return None
+    return await run_rdkit(smi_to_embedding, query_filter.smiles, query_filter.method)
+
+
+def join_missing(query, *models):
+    """
+    Join the `models` that `query` does not join yet, e.g. in a `selector_func`.
+
+    Only the joined tables count: a table merely referenced by a `WHERE` clause is
+    joined, which also removes it from the implicit `FROM` list.
+    """
+    joined = {
+        table
+        for from_clause in query.get_final_froms()
+        if isinstance(from_clause, Join)
+        for table in find_tables(from_clause)
+    }
+    for model in models:
+        if model.__table__ not in joined:
+            query = query.join(model)
+    return query
+
+
+def join_fingerprints(
+    query,
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+):
+    """
+    Join the `MoleculeFingerprint` bit table to a query joined to `Molecule` when the
+    distance is computed on it.
+    """
+    if distance in bit_distances:
+        query = query.join(
+            MoleculeFingerprint, MoleculeFingerprint.molecule_id == Molecule.id
+        )
+    return query
+
+
+def unnest_embeddings(
+    embeddings: List[List[int]],
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"],
+):
+    """
+    A `(embedding, query_idx)` table of query fingerprints, sent as one text array
+    parameter and cast to `vector[]`/`bit[]` on the server.
+    """
+    if distance in bit_distances:
+        array_type = ARRAY(BIT(1024))
+        literals = [to_bit_string(embedding) for embedding in embeddings]
+    else:
+        array_type = ARRAY(Vector(1024))
+        literals = [f"[{','.join(map(str, embedding))}]" for embedding in embeddings]
+    return (
+        func.unnest(
+            cast(bindparam("embeddings", literals, type_=ARRAY(Text)), array_type)
+        )
+        .table_valued("embedding", with_ordinality="query_idx")
+        .render_derived()
+    )
+
+
+# pgvector's default `hnsw.ef_search` and the largest value it accepts
+DEFAULT_EF_SEARCH = 40
+MAX_EF_SEARCH = 1000
+
+
+def has_row_filters(query_filter) -> bool:
+    """
+    Whether `query_filter` restricts the rows beyond its SMILES: element, numeric,
+    class or bool filters.
+    """
+    return query_filter is not None and any(
+        getattr(query_filter, name, None)
+        for name in (
+            "element_filters",
+            "numeric_filters",
+            "class_filters",
+            "bool_filters",
+        )
+    )
+
+
+def vector_search_param_statements(
+    ef_search: int | None = None,
+    probes: int | None = None,
+    limit: int | None = 0,
+    exact: bool = False,
+) -> list:
+    """
+    Statements tuning the approximate index scan of a distance-ordered query for the
+    current transaction.
+
+    `hnsw.ef_search` bounds how many candidates an HNSW scan returns, so it is
+    raised to at least `limit` (the rows up to the end of the page) to keep the page
+    complete, also when `ef_search` is not given. An HNSW scan cannot return more
+    than `MAX_EF_SEARCH` rows, so past that depth (or for all the rows, `limit=None`)
+    index scans are disabled instead: the distance is computed for every row, an
+    exact but slower scan.
+
+    The other conditions of the query are only applied to the candidates of the
+    scan, so a filtered search (`exact=True`, see `has_row_filters`) could return a
+    short page, and end the pagination, while more rows match. It always takes the
+    exact scan.
+    """
+    if exact or limit is None or limit > MAX_EF_SEARCH:
+        return [select(func.set_config("enable_indexscan", "off", True))]
+    ef_search = min(max(ef_search or DEFAULT_EF_SEARCH, limit), MAX_EF_SEARCH)
+    statements = [select(func.set_config("hnsw.ef_search", str(ef_search), True))]
+    if probes is not None:
+        statements.append(select(func.set_config("ivfflat.probes", str(probes), True)))
+    return statements
+
+
+def set_vector_search_params(
+    *,
+    session: Session,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    limit: int | None = 0,
+    exact: bool = False,
+) -> None:
+    for statement in vector_search_param_statements(ef_search, probes, limit, exact):
+        session.exec(statement)
+
+
+async def set_vector_search_params_async(
+    *,
+    session: AsyncSession,
+    ef_search: int | None = None,
+    probes: int | None = None,
+    limit: int | None = 0,
+    exact: bool = False,
+) -> None:
+    for statement in vector_search_param_statements(ef_search, probes, limit, exact):
+        await session.exec(statement)
+
+
+def filter_cache_key(query_filter: SQLModel, exclude: Iterable[str] = ()) -> str:
+    """
+    A canonical JSON form of `query_filter`: keys are sorted and so are the entries
+    of every filter list, so filters that only differ in their order share a key.
+    """
+
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        if isinstance(value, list):
+            items = [normalize(item) for item in value]
+            return sorted(items, key=lambda item: json.dumps(item, sort_keys=True))
+        return value
+
+    return json.dumps(
+        normalize(query_filter.model_dump(mode="json", exclude=set(exclude))),
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+
+
+def encode_cursor(key: dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(
+        json.dumps(key, separators=(",", ":")).encode()
+    ).decode()
+
+
+def decode_cursor(cursor: str, fields: Sequence[str]) -> dict[str, Any]:
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, dict) or any(field not in key for field in fields):
+        raise ValueError("Invalid cursor")
+    return key
+
+
+def paginate_by_id(
+    query, id_column, skip: int = 0, limit: int = 100, cursor: str | None = None
+):
+    """
+    Keyset pagination on the primary key. `skip` is only used without a `cursor`.
+    """
+    if cursor is not None:
+        last_id = decode_cursor(cursor, ("id",))["id"]
+        if not isinstance(last_id, int):
+            raise ValueError("Invalid cursor")
+        query = query.where(id_column > last_id)
+    else:
+        query = query.offset(skip)
+    return query.order_by(id_column).limit(limit)
+
+
+def next_id_cursor(items: Sequence[Any], limit: int) -> str | None:
+    if limit <= 0 or len(items) < limit:
+        return None
+    return encode_cursor({"id": items[-1].id})
+
+
+def paginate_by_distance(
+    query,
+    fp_distance,
+    id_column,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> tuple[Any, dict[str, Any]]:
+    """
+    Keyset pagination on a fingerprint distance.
+
+    `query` selects `(item, distance)` rows. It is ordered by the distance alone, so
+    that a vector index can serve it. Rows at the same distance come in no particular
+    order, so the cursor keeps the last distance together with the ids already returned
+    at that distance, plus the number of rows returned so far (`depth`) to size
+    `hnsw.ef_search`.
+
+    Returns:
+        the paginated query and the decoded cursor key.
+    """
+    if cursor is not None:
+        key = decode_cursor(cursor, ("distance", "ids", "depth"))
+        if not isinstance(key["ids"], list) or not isinstance(key["depth"], int):
+            raise ValueError("Invalid cursor")
+        query = query.where(
+            or_(
+                fp_distance > key["distance"],
+                and_(fp_distance == key["distance"], id_column.not_in(key["ids"])),
+            )
+        )
+    else:
+        key = {"distance": None, "ids": [], "depth": skip}
+        query = query.offset(skip)
+    return query.order_by(fp_distance).limit(limit), key
+
+
+def next_distance_cursor(
+    rows: Sequence[tuple[Any, float]], key: dict[str, Any], limit: int
+) -> str | None:
+    if limit <= 0 or len(rows) < limit:
+        return None
+    last_distance = rows[-1][1]
+    ids = [item.id for item, distance in rows if distance == last_distance]
+    if key["distance"] == last_distance:
+        ids = key["ids"] + ids
+    return encode_cursor(
+        {"distance": last_distance, "ids": ids, "depth": key["depth"] + len(rows)}
+    )
+
+
+def page_result(
+    rows: Sequence[Any], key: dict[str, Any] | None, limit: int
+) -> tuple[list[Any], str | None]:
+    """
+    The items and next cursor of a page fetched with `paginate_by_id` (`key` is
+    `None`) or `paginate_by_distance`.
+    """
+    if key is None:
+        return rows, next_id_cursor(rows, limit)
+    return [item for item, _ in rows], next_distance_cursor(rows, key, limit)
+
+
+def order_by_ids(items: Sequence[Any], ids: Sequence[int]) -> list[Any]:
+    """
+    `items` fetched with an `IN` query, put back in the order of `ids`.
+    """
+    by_id = {item.id: item for item in items}
+    return [by_id[item_id] for item_id in ids if item_id in by_id]
+
+
+def record_version(row: Sequence[Any] | None) -> str | None:
+    """
+    A version string of a record from the columns selected by a `build_*_version_query`,
+    `None` when the record does not exist.
+    """
+    if row is None:
+        return None
+    return "|".join(
+        value.isoformat() if hasattr(value, "isoformat") else str(value)
+        for value in row
+    )
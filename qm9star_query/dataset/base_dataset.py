@@ -6,21 +6,50 @@ LastEditTime: 2024-05-07 10:43:34
 Description: 请填写简介
 """
 
+import hashlib
+import json
+import multiprocessing
 import os
-from typing import Callable, Dict, Sequence, Union
+import shutil
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterator, Literal, Sequence, Union
 
 import numpy as np
 import torch
 import torch.utils.data
-from sqlmodel import Session, col, create_engine, func, select
+from sqlalchemy import Text, cast, literal
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlmodel import Session, func, or_, select
 from sqlmodel.sql.expression import SelectOfScalar
 from torch import Tensor
 from torch_geometric.data import Data, Dataset, InMemoryDataset
 from torch_geometric.data.data import BaseData
+from torch_geometric.data.separate import separate
 from tqdm import tqdm
 
+from qm9star_query.core.engine import get_engine
+from qm9star_query.crud.counts import count_filter_key, without_ordering
+from qm9star_query.crud.snapshots_crud import (
+    filter_snapshots_query,
+    get_snapshot_columns,
+)
+from qm9star_query.dataset.bulk_copy import iter_copy_parts
+from qm9star_query.dataset.columnar import (
+    build_columns,
+    Columns,
+    chunk_length,
+    concat_columns,
+    default_columns,
+    iter_records,
+    load_columns,
+    save_columns,
+    slice_columns,
+    take_columns,
+)
 from qm9star_query.models import Formula, Snapshot
-from qm9star_query.models.snapshot import SnapshotOut
+from qm9star_query.models.utils import SnapshotFilter
 from qm9star_query.utils import recover_rdmol
 
 IndexType = Union[slice, Tensor, np.ndarray, Sequence]
@@ -42,6 +71,13 @@ def update_slices(slices_list: Sequence[Dict[str, Tensor]]):
     return new_slices
 
 
+def ids_hash_expression(ids):
+    # md5 of the ids in order, computed by the database
+    return func.md5(
+        func.string_agg(cast(ids, Text), aggregate_order_by(literal(","), ids))
+    )
+
+
 def transform_data(raw_data: dict):
     return Data(
         pos=torch.tensor(raw_data["coords"], dtype=torch.float32),
@@ -57,7 +93,98 @@ def transform_data(raw_data: dict):
     )
 
 
+def ragged_slices(columns: Columns, name: str) -> Tensor:
+    # the rows of each snapshot in a ragged column, see `columnar`
+    shapes = columns.get(f"{name}.shapes")
+    if shapes is None:
+        return torch.tensor(columns[f"{name}.offsets"], dtype=torch.long)
+    slices = torch.zeros(len(shapes) + 1, dtype=torch.long)
+    torch.cumsum(torch.tensor(shapes[:, 0], dtype=torch.long), 0, out=slices[1:])
+    return slices
+
+
+def transform_columns(columns: Columns) -> tuple[Data, Dict[str, Tensor]]:
+    """
+    The collated `(data, slices)` of a whole raw chunk, the same as `collate` makes of
+    `transform_data` applied to every snapshot, built from the flat column arrays
+    without a `Data` per snapshot.
+    """
+    energy = torch.tensor(columns["single_point_energy"], dtype=torch.float32)
+    data = Data(
+        pos=torch.tensor(columns["coords"], dtype=torch.float32).view(-1, 3),
+        z=torch.tensor(columns["atoms"], dtype=torch.int64),
+        energy=energy,
+        y=energy.clone(),
+        energy_grad=torch.tensor(columns["forces"], dtype=torch.float32)
+        .view(-1, 3)
+        .neg_(),
+        formal_charges=torch.tensor(columns["formal_charges"], dtype=torch.int64),
+        formal_num_radicals=torch.tensor(
+            columns["formal_num_radicals"], dtype=torch.int64
+        ),
+        bonds=torch.tensor(columns["bonds"], dtype=torch.int64).view(-1, 3),
+    )
+    graph_slices = torch.arange(chunk_length(columns) + 1)
+    slices = {
+        "pos": ragged_slices(columns, "coords"),
+        "z": ragged_slices(columns, "atoms"),
+        "energy": graph_slices,
+        "y": graph_slices.clone(),
+        "energy_grad": ragged_slices(columns, "forces"),
+        "formal_charges": ragged_slices(columns, "formal_charges"),
+        "formal_num_radicals": ragged_slices(columns, "formal_num_radicals"),
+        "bonds": ragged_slices(columns, "bonds"),
+    }
+    return data, slices
+
+
+def process_raw_part(
+    raw_path: str,
+    start: int,
+    stop: int,
+    out_path: str,
+    transform: Callable | None,
+    batch_transform: Callable,
+    pre_transform: Callable | None = None,
+) -> str:
+    """
+    Processes the snapshots `start:stop` of a raw chunk into `out_path`
+
+    Run by the workers of `BaseQM9starDataset.process`, so the transforms must be
+    picklable (module-level functions or instances of module-level classes).
+    """
+    columns = slice_columns(load_columns(raw_path), start, stop)
+    if transform is not None:
+        data_list = [transform(record) for record in iter_records(columns)]
+    else:
+        data, slices = batch_transform(columns)
+        if pre_transform is None:
+            torch.save((data, slices), out_path)
+            return out_path
+        data_list = [
+            separate(
+                cls=data.__class__,
+                batch=data,
+                idx=idx,
+                slice_dict=slices,
+                decrement=False,
+            )
+            for idx in range(chunk_length(columns))
+        ]
+    if pre_transform is not None:
+        data_list = [pre_transform(data) for data in data_list]
+    data, slices = InMemoryDataset.collate(data_list)
+    torch.save((data, slices), out_path)
+    return out_path
+
+
 class BaseQM9starDataset(InMemoryDataset):
+    dataset_name = "qm9star_full"
+    # the snapshots of the dataset, all of them by default
+    snapshot_filter: SnapshotFilter | None = None
+    # the `Snapshot` columns downloaded, by default those `transform_data` reads
+    snapshot_columns: tuple[str, ...] = default_columns
+
     def __init__(
         self,
         root=os.path.curdir,
@@ -66,17 +193,54 @@ class BaseQM9starDataset(InMemoryDataset):
         server="127.0.0.1",
         port=5432,
         db="qm9star",
-        dataset_name="qm9star_full",
+        dataset_name: str | None = None,
         block_num=5,
-        transform=transform_data,
+        transform=None,
+        batch_transform=transform_columns,
         pre_transform=None,
         pre_filter=None,
         selector_func: Callable = None,
         log=False,
+        download_workers=4,
+        download_part_size=10000,
+        snapshot_columns: Sequence[str] | None = None,
+        download_method: Literal["copy", "select"] = "copy",
+        process_workers=1,
+        process_chunk_size: int | None = None,
+        snapshot_filter: SnapshotFilter | None = None,
     ):
-        self.dataset_name = dataset_name
+        if dataset_name is not None:
+            self.dataset_name = dataset_name
+        if snapshot_filter is not None:
+            self.snapshot_filter = snapshot_filter
+        if snapshot_columns is not None:
+            # `id` orders and resumes the download
+            self.snapshot_columns = tuple(dict.fromkeys(("id", *snapshot_columns)))
+        get_snapshot_columns(self.snapshot_columns)
         self.block_num = block_num
-        self.names = [f"{dataset_name}_chunk{i:02d}" for i in range(block_num)]
+        self.download_workers = download_workers
+        self.download_part_size = download_part_size
+        self.download_method = download_method
+        self.batch_transform = batch_transform
+        self.process_workers = process_workers
+        self.process_chunk_size = process_chunk_size
+        # the files of differently filtered datasets are told apart by the filter
+        self.cache_name = self.dataset_name
+        if self.snapshot_filter is not None:
+            filter_key = count_filter_key(self.snapshot_filter)
+            self.cache_name += (
+                f"_{hashlib.sha256(filter_key.encode()).hexdigest()[:12]}"
+            )
+        self.names = [f"{self.cache_name}_chunk{i:02d}" for i in range(block_num)]
+        # written by `download`, `refresh` adds the delta chunks to it
+        self.manifest_path = os.path.join(
+            os.path.expanduser(os.path.normpath(root)),
+            "raw",
+            f"{self.cache_name}_manifest.json",
+        )
+        manifest = self.read_dataset_manifest()
+        if manifest is not None:
+            self.names += [delta["name"] for delta in manifest["deltas"]]
         self.session_url = (
             f"postgresql+psycopg2://{user}:{password}@{server}:{port}/{db}"
         )
@@ -89,18 +253,65 @@ class BaseQM9starDataset(InMemoryDataset):
             pre_filter=pre_filter,
             log=log,
         )
+        self.load_processed()
+        self.drop_superseded()
+
+    def load_processed(self) -> None:
+        """
+        Loads every processed chunk and collates them into one in-memory store
+        """
         data_lst = []
         slices_lst = []
         for processed_path in self.processed_paths:
-            data, slices = torch.load(processed_path)
+            data, slices = torch.load(processed_path, weights_only=False)
             data_lst.append(data)
             slices_lst.append(slices)
         self._data, _ = self.collate(data_lst)
         self.slices = update_slices(slices_lst)
 
+    def drop_superseded(self) -> None:
+        """
+        Hides the snapshots downloaded again by a later chunk (see `refresh`), so
+        only the latest version of each is indexed
+
+        The latest version is that of the chunk downloaded last, by the download
+        sequence of the manifest, not by the position of the chunk: a chunk
+        downloaded again comes before the delta chunks.
+        """
+        self._indices = None
+        if len(self.names) == self.block_num:
+            return
+        ids = [load_columns(raw_path)["id"] for raw_path in self.raw_paths]
+        sequences = np.repeat(
+            self.chunk_sequences(self.read_dataset_manifest()),
+            [len(chunk_ids) for chunk_ids in ids],
+        )
+        ids = np.concatenate(ids)
+        # by id, then sequence and position: the last row of every id is the latest
+        order = np.lexsort((np.arange(len(ids)), sequences, ids))
+        ordered_ids = ids[order]
+        last = np.append(ordered_ids[1:] != ordered_ids[:-1], True)
+        if not last.all():
+            self._indices = np.sort(order[last]).tolist()
+
+    @staticmethod
+    def chunk_sequences(manifest: dict) -> list[int]:
+        # the download sequence of every chunk, then every delta chunk, of the
+        # manifest; manifests written before it was recorded have the deltas in order
+        return [chunk.get("sequence", 0) for chunk in manifest["chunks"]] + [
+            delta.get("sequence", idx + 1)
+            for idx, delta in enumerate(manifest["deltas"])
+        ]
+
+    @staticmethod
+    def next_sequence(manifest: dict) -> int:
+        manifest["sequence"] = manifest.get("sequence", len(manifest["deltas"])) + 1
+        return manifest["sequence"]
+
     @property
     def raw_file_names(self) -> list[str]:
-        return [f"{name}.npz" for name in self.names]
+        # directories of columns, see `qm9star_query.dataset.columnar`
+        return self.names
 
     @property
     def processed_file_names(self) -> list[str]:
@@ -109,21 +320,308 @@ class BaseQM9starDataset(InMemoryDataset):
     def download(self) -> None:
         """
         Downloads the dataset from QM9star database to `raw` dir
+
+        Chunks are downloaded by `download_workers` threads at once, each through its
+        own connection of the shared pool, and chunks already in `raw` dir are
+        skipped. See `download_chunk` for how an interrupted chunk is resumed.
+
+        The chunks are the `ntile`s of the dataset ids, computed by the database
+        (see `get_chunk_bounds`). The dataset manifest records the id range, size and
+        a hash of the ids of every chunk, the largest id and the latest `update_time`
+        downloaded, from which `refresh` fetches what changed since. It is written
+        before the chunks are downloaded, so an interrupted download resumes with the
+        same chunks; chunks in `raw` dir without a manifest, whose id ranges are not
+        known, are downloaded again.
         """
         self.check_session()
-        for snapshot_ids, raw_path in zip(self.get_db_ids(), self.raw_paths):
-            raw_data = self.get_data(
-                snapshot_ids.tolist(), chunk_idx=self.raw_paths.index(raw_path)
+        manifest = self.read_dataset_manifest()
+        if manifest is None:
+            # read first, so the rows updated during the download are refreshed
+            max_update_time = self.get_max_update_time()
+            chunks = self.get_chunk_bounds()
+            manifest = {
+                "columns": list(self.snapshot_columns),
+                "max_id": chunks[-1]["last_id"],
+                "max_update_time": max_update_time.isoformat(),
+                "chunks": chunks,
+                "deltas": [],
+                "sequence": 0,
+            }
+            for raw_path in self.raw_paths:
+                shutil.rmtree(raw_path, ignore_errors=True)
+            self.write_dataset_manifest(manifest)
+        missing = [
+            (chunk_idx, chunk)
+            for chunk_idx, chunk in enumerate(manifest["chunks"])
+            if not os.path.exists(self.raw_paths[chunk_idx])
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, self.download_workers)) as executor:
+            futures = [
+                executor.submit(self.download_chunk, chunk_idx, chunk)
+                for chunk_idx, chunk in missing
+            ]
+            for future in futures:
+                future.result()
+
+    def refresh(self) -> int:
+        """
+        Brings the downloaded dataset up to date with the database, returns the
+        number of snapshots downloaded
+
+        Only the snapshots added or updated since the manifest was written (an id
+        above its `max_id` or an `update_time` after its `max_update_time`) are
+        downloaded, into a new delta chunk, and only that chunk is processed. The
+        former versions of updated snapshots are then hidden (see `drop_superseded`).
+        A chunk whose ids no longer match the hash of the manifest, e.g. after
+        snapshots were deleted, is downloaded and processed again, and the older
+        delta chunks are pruned of its id range (see `prune_deltas`).
+        """
+        manifest = self.read_dataset_manifest()
+        if manifest is None:
+            raise ValueError(
+                f"{self.manifest_path} not found, download the dataset again to "
+                "refresh it"
             )
-            np.savez(raw_path, data=raw_data)
-            if self.log:
-                print(f"{raw_path} saved")
+        if manifest["columns"] != list(self.snapshot_columns):
+            raise ValueError(
+                f"The dataset was downloaded with the columns {manifest['columns']}"
+            )
+        self.check_session()
+        max_update_time = self.get_max_update_time()
+        changed_since = (
+            manifest["max_id"],
+            datetime.fromisoformat(manifest["max_update_time"]),
+        )
+        downloaded = 0
+        outdated = []
+
+        for chunk_idx, chunk in enumerate(manifest["chunks"]):
+            current = self.summarize_ids(
+                Snapshot.id >= chunk["first_id"], Snapshot.id <= chunk["last_id"]
+            )
+            if (current["count"], current["ids_hash"]) == (
+                chunk["count"],
+                chunk["ids_hash"],
+            ):
+                continue
+            chunk.update(
+                count=current["count"],
+                ids_hash=current["ids_hash"],
+                sequence=self.next_sequence(manifest),
+            )
+            # replaced atomically by `save_columns`, the old chunk stays until then
+            if chunk["count"]:
+                self.download_chunk(chunk_idx, chunk)
+            else:
+                save_columns(
+                    self.raw_paths[chunk_idx], build_columns([], self.snapshot_columns)
+                )
+            downloaded += chunk["count"]
+            outdated.append(chunk_idx)
+
+        delta = self.summarize_ids(
+            or_(
+                Snapshot.id > changed_since[0],
+                Snapshot.update_time > changed_since[1],
+            )
+        )
+        if delta["count"]:
+            delta["name"] = f"{self.cache_name}_delta{len(manifest['deltas']):04d}"
+            delta["sequence"] = self.next_sequence(manifest)
+            self.names.append(delta["name"])
+            self.download_chunk(len(self.names) - 1, delta, changed_since=changed_since)
+            manifest["deltas"].append(delta)
+            manifest["max_id"] = max(manifest["max_id"], delta["last_id"])
+            downloaded += delta["count"]
+            outdated.append(len(self.names) - 1)
+        if max_update_time is not None:
+            manifest["max_update_time"] = max(
+                max_update_time, changed_since[1]
+            ).isoformat()
+
+        outdated += [idx for idx in self.prune_deltas(manifest) if idx not in outdated]
+
+        if outdated:
+            self.process_chunks(outdated)
+        self.write_dataset_manifest(manifest)
+        self.load_processed()
+        self.drop_superseded()
+        if self.log:
+            print(f"{self.dataset_name} refreshed, {downloaded} snapshots downloaded")
+        return downloaded
+
+    def prune_deltas(self, manifest: dict) -> list[int]:
+        """
+        Drops the delta chunk snapshots that were superseded or deleted since, returns
+        the indices of the delta chunks rewritten
+
+        A chunk downloaded after a delta chunk holds every current snapshot of its id
+        range, so the delta snapshots of that range are dropped. The ids above the
+        last chunk are only downloaded in delta chunks: when the database has fewer
+        of them, those that were deleted are dropped.
+        """
+        chunks = manifest["chunks"]
+        sequences = self.chunk_sequences(manifest)
+        delta_indices = range(self.block_num, len(self.names))
+        delta_ids = [
+            np.asarray(load_columns(self.raw_paths[idx])["id"]) for idx in delta_indices
+        ]
+        if not delta_ids:
+            return []
+        tail_start = chunks[-1]["last_id"]
+        tail_ids = np.unique(np.concatenate(delta_ids))
+        tail_ids = tail_ids[tail_ids > tail_start]
+        existing = None
+        if len(tail_ids) != self.summarize_ids(Snapshot.id > tail_start)["count"]:
+            existing = np.array(
+                self.session.exec(
+                    self.snapshot_query(Snapshot.id).where(Snapshot.id > tail_start)
+                ).all(),
+                dtype=np.int64,
+            )
+
+        pruned = []
+        for idx, delta, ids in zip(delta_indices, manifest["deltas"], delta_ids):
+            stale = np.zeros(len(ids), dtype=bool)
+            for chunk, sequence in zip(chunks, sequences):
+                if sequence > sequences[idx]:
+                    stale |= (ids >= chunk["first_id"]) & (ids <= chunk["last_id"])
+            if existing is not None:
+                stale |= (ids > tail_start) & ~np.isin(ids, existing)
+            if not stale.any():
+                continue
+            kept = take_columns(
+                load_columns(self.raw_paths[idx]), np.flatnonzero(~stale)
+            )
+            save_columns(self.raw_paths[idx], kept)
+            kept_ids = kept["id"]
+            delta.update(
+                first_id=int(kept_ids[0]) if len(kept_ids) else None,
+                last_id=int(kept_ids[-1]) if len(kept_ids) else None,
+                count=len(kept_ids),
+                ids_hash=(
+                    hashlib.md5(",".join(map(str, kept_ids)).encode()).hexdigest()
+                    if len(kept_ids)
+                    else None
+                ),
+            )
+            pruned.append(idx)
+        return pruned
+
+    def read_dataset_manifest(self) -> dict | None:
+        if not os.path.exists(self.manifest_path):
+            return None
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def write_dataset_manifest(self, manifest: dict) -> None:
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def download_chunk(
+        self,
+        chunk_idx: int,
+        chunk: dict,
+        changed_since: tuple[int, datetime] | None = None,
+    ) -> None:
+        """
+        Downloads one chunk, an entry of the dataset manifest, to its columnar
+        directory in `raw` dir
+
+        The snapshots are streamed (see `iter_parts`) and written in parts of about
+        `download_part_size` snapshots to `<chunk>_parts/`, whose `manifest.json`
+        lists the parts written so far. A new download of the chunk continues after
+        the last snapshot of the manifest; the parts are concatenated into the chunk
+        at the end.
+
+        `changed_since` restricts it to the snapshots changed since then (see
+        `chunk_query`).
+        """
+        raw_path = self.raw_paths[chunk_idx]
+        parts_dir = f"{raw_path}_parts"
+        manifest = self.load_manifest(parts_dir, chunk)
+        written = sum(part["count"] for part in manifest["parts"])
+        after_id = manifest["parts"][-1]["last_id"] if manifest["parts"] else None
+        start_time = time.perf_counter()
+        with tqdm(
+            total=chunk["count"],
+            initial=written,
+            desc=f"Downloading data {self.dataset_name} chunk {chunk_idx:02d}",
+            unit="snapshot",
+            position=chunk_idx,
+        ) as progress:
+            id_range = (chunk["first_id"], chunk["last_id"])
+            for part in self.iter_parts(id_range, after_id, changed_since):
+                self.write_part(parts_dir, manifest, part)
+                progress.update(chunk_length(part))
+        downloaded = sum(part["count"] for part in manifest["parts"]) - written
+        elapsed = time.perf_counter() - start_time
+
+        parts = [
+            load_columns(os.path.join(parts_dir, part["file"]))
+            for part in manifest["parts"]
+        ]
+        save_columns(
+            raw_path,
+            (
+                concat_columns(parts)
+                if parts
+                else build_columns([], self.snapshot_columns)
+            ),
+        )
+        shutil.rmtree(parts_dir)
+        if self.log:
+            print(
+                f"{raw_path} saved, {downloaded} snapshots downloaded in "
+                f"{elapsed:.1f}s ({downloaded / max(elapsed, 1e-9):.0f} snapshots/s)"
+            )
+
+    def load_manifest(self, parts_dir: str, chunk: dict) -> dict:
+        """
+        The manifest of the parts already downloaded, or a new one when there is none
+        or it was written for other snapshots.
+        """
+        manifest = {
+            "first_id": chunk["first_id"],
+            "last_id": chunk["last_id"],
+            "count": chunk["count"],
+            "columns": list(self.snapshot_columns),
+            "parts": [],
+        }
+        manifest_path = os.path.join(parts_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                previous = json.load(f)
+            if all(
+                previous.get(key) == manifest[key]
+                for key in ("first_id", "last_id", "count", "columns")
+            ):
+                return previous
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+        return manifest
+
+    def write_part(self, parts_dir: str, manifest: dict, part: Columns) -> None:
+        # the part and then the manifest are replaced atomically, so a crash leaves
+        # at most an unlisted part that is overwritten on resume
+        file = f"part{len(manifest['parts']):04d}"
+        save_columns(os.path.join(parts_dir, file), part)
+        manifest["parts"].append(
+            {"file": file, "count": chunk_length(part), "last_id": int(part["id"][-1])}
+        )
+        manifest_path = os.path.join(parts_dir, "manifest.json")
+        with open(f"{manifest_path}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{manifest_path}.tmp", manifest_path)
 
     def check_session(self):
         """
         Checks if the session is valid
+
+        Datasets with the same connection arguments share one engine and its pool.
         """
-        session = Session(create_engine(self.session_url))
+        session = Session(get_engine(self.session_url))
         try:
             session.connection()
         except:
@@ -131,44 +629,294 @@ class BaseQM9starDataset(InMemoryDataset):
         else:
             self.session = session
 
+    def snapshot_query(self, *entities):
+        """
+        The select of `entities` over the snapshots of the dataset
+
+        Those selected by `db_select`, then restricted by `snapshot_filter` with
+        `snapshots_crud.filter_snapshots_query` (its SMILES only orders results and
+        is ignored). `db_select` may join `Molecule` and `Formula` itself, the filter
+        only joins those it does not.
+        """
+        query = self.db_select(select(*entities).select_from(Snapshot))
+        if self.snapshot_filter is not None:
+            query = filter_snapshots_query(
+                query, without_ordering(self.snapshot_filter)
+            )
+        return query
+
+    def get_chunk_bounds(self) -> list[dict]:
+        """
+        The manifest entries (id range, size and ids hash) of the `block_num` chunks
+
+        The ids are split by `ntile` in the database, the same split as
+        `np.array_split` of the ids, without fetching them.
+        """
+        ids = self.snapshot_query(
+            Snapshot.id.label("id"),
+            func.ntile(self.block_num).over(order_by=Snapshot.id).label("chunk"),
+        ).subquery()
+        rows = self.session.exec(
+            select(
+                func.min(ids.c.id),
+                func.max(ids.c.id),
+                func.count(),
+                ids_hash_expression(ids.c.id),
+            )
+            .group_by(ids.c.chunk)
+            .order_by(ids.c.chunk)
+        ).all()
+        total = sum(row[2] for row in rows)
+        assert total > 0, "No data found in database"
+        assert (
+            total >= 2 * self.block_num
+        ), "No enough data to split, try smaller block_num"
+        return [
+            {
+                "name": name,
+                "first_id": first_id,
+                "last_id": last_id,
+                "count": count,
+                "ids_hash": digest,
+                "sequence": 0,
+            }
+            for name, (first_id, last_id, count, digest) in zip(self.names, rows)
+        ]
+
+    def summarize_ids(self, *conditions) -> dict:
+        """
+        The id range, number and ids hash of the dataset snapshots meeting
+        `conditions`, as in the manifest
+        """
+        ids = self.snapshot_query(Snapshot.id.label("id")).where(*conditions).subquery()
+        first_id, last_id, count, digest = self.session.exec(
+            select(
+                func.min(ids.c.id),
+                func.max(ids.c.id),
+                func.count(),
+                ids_hash_expression(ids.c.id),
+            )
+        ).one()
+        return {
+            "first_id": first_id,
+            "last_id": last_id,
+            "count": count,
+            "ids_hash": digest,
+        }
+
     def get_db_ids(self) -> list[np.ndarray]:
         total_ids = self.session.exec(
-            self.db_select(select(Snapshot.id)).order_by(Snapshot.id)
+            self.snapshot_query(Snapshot.id).order_by(Snapshot.id)
         ).all()
         assert len(total_ids) > 0, "No data found in database"
         assert (
             len(total_ids) >= 2 * self.block_num
         ), "No enough data to split, try smaller block_num"
-        self.db_ids = np.array_split(total_ids, len(self.names))
+        self.db_ids = np.array_split(total_ids, self.block_num)
         return self.db_ids
 
+    def get_max_update_time(self) -> datetime | None:
+        return self.session.exec(
+            self.snapshot_query(func.max(Snapshot.update_time))
+        ).one()
+
+    def chunk_query(
+        self,
+        id_range: tuple[int, int],
+        after_id: int | None = None,
+        changed_since: tuple[int, datetime] | None = None,
+    ):
+        """
+        The `snapshot_columns` of a chunk, optionally only after `after_id`
+
+        A chunk is a contiguous run of the dataset ids, so it is queried as the
+        `id_range` (first and last id) under the `snapshot_query` selection rather
+        than with an `IN` list. A delta chunk (see `refresh`) only keeps the snapshots
+        of the range with an id or `update_time` above the `changed_since` pair.
+        """
+        query = (
+            self.snapshot_query(
+                *[getattr(Snapshot, name) for name in self.snapshot_columns]
+            )
+            .where(Snapshot.id >= int(id_range[0]))
+            .where(Snapshot.id <= int(id_range[1]))
+            .order_by(Snapshot.id)
+        )
+        if after_id is not None:
+            query = query.where(Snapshot.id > after_id)
+        if changed_since is not None:
+            query = query.where(
+                or_(
+                    Snapshot.id > changed_since[0],
+                    Snapshot.update_time > changed_since[1],
+                )
+            )
+        return query
+
+    def iter_parts(
+        self,
+        id_range: tuple[int, int],
+        after_id: int | None = None,
+        changed_since: tuple[int, datetime] | None = None,
+    ) -> Iterator[Columns]:
+        """
+        Streams the `chunk_query` as columns of about `download_part_size` snapshots
+
+        With `download_method="copy"` the rows are extracted with a binary `COPY`
+        through psycopg 3 and decoded straight into arrays (see
+        `qm9star_query.dataset.bulk_copy`); `"select"` fetches them as rows instead.
+        """
+        if self.download_method == "copy":
+            yield from iter_copy_parts(
+                self.session_url,
+                self.chunk_query(id_range, after_id, changed_since),
+                self.snapshot_columns,
+                part_size=self.download_part_size,
+            )
+            return
+        with Session(get_engine(self.session_url)) as session:
+            rows = []
+            for row in self.iter_data(
+                session, id_range, after_id, changed_since=changed_since
+            ):
+                rows.append(row)
+                if len(rows) >= self.download_part_size:
+                    yield build_columns(rows, self.snapshot_columns)
+                    rows = []
+            if rows:
+                yield build_columns(rows, self.snapshot_columns)
+
+    def iter_data(
+        self,
+        session: Session,
+        id_range: tuple[int, int],
+        after_id: int | None = None,
+        yield_per: int = 1000,
+        changed_since: tuple[int, datetime] | None = None,
+    ) -> Iterator[dict]:
+        """
+        Streams the rows of the `chunk_query`
+
+        Only the declared columns are selected, as plain rows fetched `yield_per` at
+        a time through a server-side cursor, without building ORM or `SnapshotOut`
+        objects.
+        """
+        query = self.chunk_query(id_range, after_id, changed_since).execution_options(
+            yield_per=yield_per
+        )
+        for row in session.exec(query):
+            yield row._asdict()
+
     def get_data(self, snapshot_ids: list[int], chunk_idx):
         if self.session is None:
             raise Exception("Session is None")
-        return [
-            SnapshotOut.model_validate(snapshot).model_dump()
-            for snapshot in tqdm(
-                self.session.exec(
-                    select(Snapshot)
-                    .order_by(Snapshot.id)
-                    .where(col(Snapshot.id).in_(snapshot_ids))
-                ).all(),
+        return list(
+            tqdm(
+                self.iter_data(self.session, (snapshot_ids[0], snapshot_ids[-1])),
+                total=len(snapshot_ids),
                 desc=f"Downloading data {self.dataset_name} chunk {chunk_idx:02d}",
             )
-        ]
+        )
 
     def process(self) -> None:
-        for idx, raw_path in enumerate(self.raw_paths):
-            if self.log:
-                print(f"processing {self.processed_paths[idx]}")
-            data_list = np.load(raw_path, allow_pickle=True)["data"]
-            data, slices = self.collate([self.transform(data) for data in data_list])
-            torch.save(
-                (data, slices),
-                self.processed_paths[idx],
-            )
-            if self.log:
-                print(f"{self.processed_paths[idx]} saved")
+        """
+        Processes every raw chunk into its collated `(data, slices)`
+
+        A chunk is converted as a whole by `batch_transform` (`transform_columns` by
+        default). A per-snapshot `transform`, e.g. `transform_data`, is opt-in: when
+        given, it is applied to every snapshot of the chunk and the results collated.
+        A `pre_transform` (e.g. `DimeNetTopology`) is then applied to every graph
+        before the chunk is saved.
+
+        With `process_workers > 1` the chunks, split in parts of at most
+        `process_chunk_size` snapshots (which bounds the memory of a worker), are
+        processed by a pool of that many processes. The parts of a chunk are then
+        concatenated in order, so the output is the same as processing it at once.
+        """
+        self.process_chunks(range(len(self.raw_paths)))
+
+    def process_chunks(self, chunk_indices: Sequence[int]) -> None:
+        """
+        Processes the raw chunks at `chunk_indices`, see `process`
+        """
+        executor = None
+        if self.process_workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=self.process_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        try:
+            pending = []
+            for idx in chunk_indices:
+                raw_path = self.raw_paths[idx]
+                count = chunk_length(load_columns(raw_path))
+                part_size = self.process_chunk_size or max(count, 1)
+                bounds = [
+                    (start, min(start + part_size, count))
+                    for start in range(0, max(count, 1), part_size)
+                ]
+                pending.append(
+                    [
+                        self.submit_part(
+                            executor,
+                            raw_path,
+                            start,
+                            stop,
+                            (
+                                self.processed_paths[idx]
+                                if len(bounds) == 1
+                                else f"{self.processed_paths[idx]}.part{part:04d}"
+                            ),
+                        )
+                        for part, (start, stop) in enumerate(bounds)
+                    ]
+                )
+            for idx, futures in zip(chunk_indices, pending):
+                if self.log:
+                    print(f"processing {self.processed_paths[idx]}")
+                part_paths = [future.result() for future in futures]
+                if len(part_paths) > 1:
+                    self.merge_parts(part_paths, self.processed_paths[idx])
+                if self.log:
+                    print(f"{self.processed_paths[idx]} saved")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+    def submit_part(
+        self,
+        executor: ProcessPoolExecutor | None,
+        raw_path: str,
+        start: int,
+        stop: int,
+        out_path: str,
+    ) -> Future:
+        args = (
+            raw_path,
+            start,
+            stop,
+            out_path,
+            self.transform,
+            self.batch_transform,
+            self.pre_transform,
+        )
+        if executor is not None:
+            return executor.submit(process_raw_part, *args)
+        future = Future()
+        future.set_result(process_raw_part(*args))
+        return future
+
+    def merge_parts(self, part_paths: list[str], processed_path: str) -> None:
+        data_lst = []
+        slices_lst = []
+        for part_path in part_paths:
+            data, slices = torch.load(part_path, weights_only=False)
+            data_lst.append(data)
+            slices_lst.append(slices)
+        data, _ = self.collate(data_lst)
+        torch.save((data, update_slices(slices_lst)), processed_path)
+        for part_path in part_paths:
+            os.remove(part_path)
 
     @staticmethod
     def db_select(
@@ -179,11 +927,11 @@ class BaseQM9starDataset(InMemoryDataset):
     def get_rdmol(self, index: int):
         data = self[index]
         return recover_rdmol(
-            coords=np.array(data["pos"]).tolist(),
-            atoms=np.array(data["z"]).tolist(),
-            bonds=np.array(data["bonds"]).tolist(),
-            formal_charges=np.array(data["formal_charges"]).tolist(),
-            formal_num_radicals=np.array(data["formal_num_radicals"]).tolist(),
+            coords=np.asarray(data["pos"]),
+            atoms=np.asarray(data["z"]),
+            bonds=np.asarray(data["bonds"]),
+            formal_charges=np.asarray(data["formal_charges"]),
+            formal_num_radicals=np.asarray(data["formal_num_radicals"]),
         )
 
     def __getitem__(
@@ -208,3 +956,59 @@ class BaseQM9starDataset(InMemoryDataset):
 
         else:
             return self.index_select(idx)
+
+
+class OnDiskQM9starDataset(BaseQM9starDataset):
+    """
+    A `BaseQM9starDataset` that keeps the processed chunks on disk
+
+    The processed chunks (the same files as the in-memory dataset) are opened with
+    `torch.load(..., mmap=True)` and each graph is sliced out of them in `get`, so only
+    the pages read are loaded and, as the pages are shared through the OS page cache,
+    the workers of a `DataLoader` do not each hold a copy of the dataset. The chunks
+    are opened lazily in every process that reads them and are not pickled with the
+    dataset.
+
+    The subsets are combined with it by inheritance, e.g.
+    `class OnDiskNeutralQM9starDataset(OnDiskQM9starDataset, NeutralQM9starDataset)`.
+    """
+
+    def load_processed(self) -> None:
+        self._chunks = None
+        self._chunks_pid = None
+        self.chunk_sizes = []
+        for processed_path in self.processed_paths:
+            _, slices = torch.load(processed_path, mmap=True, weights_only=False)
+            self.chunk_sizes.append(len(next(iter(slices.values()))) - 1)
+        self.chunk_starts = np.cumsum([0] + self.chunk_sizes)
+
+    @property
+    def chunks(self) -> list[tuple[BaseData, Dict[str, Tensor]]]:
+        # opened again after a fork, the mapped files stay shared by the processes
+        if self._chunks is None or self._chunks_pid != os.getpid():
+            self._chunks = [
+                torch.load(processed_path, mmap=True, weights_only=False)
+                for processed_path in self.processed_paths
+            ]
+            self._chunks_pid = os.getpid()
+        return self._chunks
+
+    def len(self) -> int:
+        return int(self.chunk_starts[-1])
+
+    def get(self, idx: int) -> BaseData:
+        chunk_idx = int(np.searchsorted(self.chunk_starts, idx, side="right")) - 1
+        data, slices = self.chunks[chunk_idx]
+        return separate(
+            cls=data.__class__,
+            batch=data,
+            idx=idx - int(self.chunk_starts[chunk_idx]),
+            slice_dict=slices,
+            decrement=False,
+        )
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_chunks"] = None
+        state["_chunks_pid"] = None
+        return state
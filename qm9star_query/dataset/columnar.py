@@ -0,0 +1,227 @@
+"""
+Columnar storage of the raw dataset chunks.
+
+A chunk is a directory of `.npy` files, one per column, that can be memory-mapped
+instead of unpickled:
+
+- scalar columns (`single_point_energy`, `frame_id`, `filename`, ...) hold one value
+  per snapshot, missing floats stored as NaN;
+- array columns (`coords`, `atoms`, `forces`, `bonds`, ...) are ragged: the values of
+  every snapshot are concatenated into one flat array, `<column>.offsets.npy` holds
+  the `n + 1` positions where each snapshot starts (and the last one ends) and, for
+  2D columns, `<column>.shapes.npy` the shape of each snapshot's array.
+
+`columns.json` lists the columns and the number of snapshots.
+"""
+
+import json
+import os
+import shutil
+from typing import Any, Iterable, Iterator, Sequence
+
+import numpy as np
+from sqlalchemy import ARRAY, Boolean, DateTime, Float, Integer
+
+from qm9star_query.models import Snapshot
+
+# a chunk in memory: the arrays of the `.npy` files by file stem
+Columns = dict[str, np.ndarray]
+
+META_FILE = "columns.json"
+
+# the columns of an energy/force dataset, those `transform_data` reads
+default_columns = (
+    "id",
+    "coords",
+    "atoms",
+    "single_point_energy",
+    "forces",
+    "formal_charges",
+    "formal_num_radicals",
+    "bonds",
+)
+
+
+def column_spec(name: str) -> tuple[np.dtype, int]:
+    """
+    The NumPy dtype of a `Snapshot` column and its number of array dimensions, 0 for
+    a scalar column.
+    """
+    column_type = Snapshot.__table__.columns[name].type
+    ndim = 0
+    if isinstance(column_type, ARRAY):
+        ndim = column_type.dimensions or 1
+        column_type = column_type.item_type
+    if isinstance(column_type, Boolean):
+        return np.dtype(np.bool_), ndim
+    if isinstance(column_type, Integer):
+        return np.dtype(np.int64), ndim
+    if isinstance(column_type, Float):
+        return np.dtype(np.float64), ndim
+    if isinstance(column_type, DateTime):
+        return np.dtype("datetime64[us]"), ndim
+    return np.dtype(np.str_), ndim
+
+
+def build_columns(rows: Sequence[dict[str, Any]], names: Iterable[str]) -> Columns:
+    """
+    Convert snapshot rows (dicts of plain values, e.g. from
+    `BaseQM9starDataset.iter_data`) into the arrays of the `names` columns.
+    """
+    columns: Columns = {}
+    for name in names:
+        dtype, ndim = column_spec(name)
+        values = [row[name] for row in rows]
+        if ndim == 0:
+            if dtype == np.float64:
+                values = [np.nan if value is None else value for value in values]
+            elif dtype.kind == "U":
+                values = ["" if value is None else value for value in values]
+            columns[name] = np.array(values, dtype=dtype)
+            continue
+        arrays = [
+            np.asarray([] if value is None else value, dtype=dtype) for value in values
+        ]
+        sizes = np.array([array.size for array in arrays], dtype=np.int64)
+        columns[f"{name}.offsets"] = np.concatenate(
+            [np.zeros(1, dtype=np.int64), np.cumsum(sizes)]
+        )
+        columns[name] = (
+            np.concatenate([array.ravel() for array in arrays])
+            if arrays
+            else np.array([], dtype=dtype)
+        )
+        if ndim > 1:
+            columns[f"{name}.shapes"] = np.array(
+                [
+                    array.shape if array.ndim == ndim else (0,) * ndim
+                    for array in arrays
+                ],
+                dtype=np.int64,
+            ).reshape(len(arrays), ndim)
+    return columns
+
+
+def column_names(columns: Columns) -> list[str]:
+    return [key for key in columns if "." not in key]
+
+
+def chunk_length(columns: Columns) -> int:
+    name = column_names(columns)[0]
+    offsets = columns.get(f"{name}.offsets")
+    return len(columns[name]) if offsets is None else len(offsets) - 1
+
+
+def concat_columns(chunks: Sequence[Columns]) -> Columns:
+    """
+    Concatenate chunks with the same columns, shifting the ragged offsets.
+    """
+    if len(chunks) == 1:
+        return dict(chunks[0])
+    columns: Columns = {}
+    for key in chunks[0]:
+        if key.endswith(".offsets"):
+            starts = np.cumsum([0] + [chunk[key][-1] for chunk in chunks[:-1]])
+            columns[key] = np.concatenate(
+                [chunks[0][key][:1]]
+                + [chunk[key][1:] + start for chunk, start in zip(chunks, starts)]
+            )
+        else:
+            columns[key] = np.concatenate([chunk[key] for chunk in chunks])
+    return columns
+
+
+def slice_columns(columns: Columns, start: int, stop: int) -> Columns:
+    """
+    The snapshots `start:stop` of a chunk, with the ragged offsets rebased to 0.
+    """
+    sliced: Columns = {}
+    for name in column_names(columns):
+        offsets = columns.get(f"{name}.offsets")
+        if offsets is None:
+            sliced[name] = columns[name][start:stop]
+            continue
+        sliced[name] = columns[name][offsets[start] : offsets[stop]]
+        sliced[f"{name}.offsets"] = offsets[start : stop + 1] - offsets[start]
+        shapes = columns.get(f"{name}.shapes")
+        if shapes is not None:
+            sliced[f"{name}.shapes"] = shapes[start:stop]
+    return sliced
+
+
+def take_columns(columns: Columns, indices: Sequence[int]) -> Columns:
+    """
+    The snapshots at `indices` of a chunk, in that order, with rebuilt ragged offsets.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    taken: Columns = {}
+    for name in column_names(columns):
+        offsets = columns.get(f"{name}.offsets")
+        if offsets is None:
+            taken[name] = columns[name][indices]
+            continue
+        starts = offsets[indices]
+        sizes = offsets[indices + 1] - starts
+        new_offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(sizes)])
+        # the position of every value of the taken snapshots in the flat array
+        positions = np.arange(new_offsets[-1]) + np.repeat(
+            starts - new_offsets[:-1], sizes
+        )
+        taken[name] = columns[name][positions]
+        taken[f"{name}.offsets"] = new_offsets
+        shapes = columns.get(f"{name}.shapes")
+        if shapes is not None:
+            taken[f"{name}.shapes"] = shapes[indices]
+    return taken
+
+
+def save_columns(path: str, columns: Columns) -> None:
+    """
+    Write a chunk to the directory `path`, replacing it atomically.
+    """
+    tmp_path = f"{path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    for key, array in columns.items():
+        np.save(os.path.join(tmp_path, f"{key}.npy"), array)
+    with open(os.path.join(tmp_path, META_FILE), "w") as f:
+        json.dump({"count": chunk_length(columns), "columns": column_names(columns)}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_columns(path: str, mmap_mode: str | None = "r") -> Columns:
+    """
+    Open a chunk, memory-mapped by default, so only the pages read are loaded.
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        names = json.load(f)["columns"]
+    columns: Columns = {}
+    for name in names:
+        for suffix in ("", ".offsets", ".shapes"):
+            file = os.path.join(path, f"{name}{suffix}.npy")
+            if suffix == "" or os.path.exists(file):
+                columns[f"{name}{suffix}"] = np.load(file, mmap_mode=mmap_mode)
+    return columns
+
+
+def iter_records(columns: Columns) -> Iterator[dict[str, Any]]:
+    """
+    The snapshots of a chunk as dicts of NumPy values, the arrays being views of the
+    column arrays (no copy is made).
+    """
+    names = column_names(columns)
+    for index in range(chunk_length(columns)):
+        record = {}
+        for name in names:
+            offsets = columns.get(f"{name}.offsets")
+            if offsets is None:
+                record[name] = columns[name][index]
+                continue
+            value = columns[name][offsets[index] : offsets[index + 1]]
+            shapes = columns.get(f"{name}.shapes")
+            # an empty array stays 1D, like the empty list it was stored from
+            if shapes is not None and value.size:
+                value = value.reshape(shapes[index])
+            record[name] = value
+        yield record
@@ -6,189 +6,36 @@ LastEditTime: 2024-05-06 18:48:05
 Description: 请填写简介
 """
 
-import os
-from typing import Callable
+from qm9star_query.dataset.base_dataset import BaseQM9starDataset
+from qm9star_query.models.utils import NumericFilter, SnapshotFilter
 
-from sqlmodel import Session, create_engine, func, select
-from sqlmodel.sql.expression import SelectOfScalar
-from torch_geometric.data import Data
-from tqdm import tqdm
 
-from qm9star_query.dataset.base_dataset import BaseQM9starDataset, transform_data
-from qm9star_query.models import Formula, Molecule, Snapshot
+def charge_multiplicity_filter(charge: int, multiplicity: int) -> SnapshotFilter:
+    return SnapshotFilter(
+        numeric_filters=[
+            NumericFilter(column="total_charge", min=charge, max=charge),
+            NumericFilter(
+                column="total_multiplicity", min=multiplicity, max=multiplicity
+            ),
+        ]
+    )
 
 
 class NeutralQM9starDataset(BaseQM9starDataset):
-    def __init__(
-        self,
-        root=os.path.curdir,
-        user="hxchem",
-        password="hxchem",
-        server="127.0.0.1",
-        port=5432,
-        db="qm9star",
-        dataset_name="qm9star_neutral",
-        block_num=5,
-        transform=transform_data,
-        pre_transform=None,
-        pre_filter=None,
-        selector_func: Callable = None,
-        log=False,
-    ):
-        super().__init__(
-            root=root,
-            user=user,
-            password=password,
-            server=server,
-            port=port,
-            db=db,
-            dataset_name=dataset_name,
-            block_num=block_num,
-            transform=transform,
-            pre_transform=pre_transform,
-            pre_filter=pre_filter,
-            selector_func=selector_func,
-            log=log,
-        )
-
-    @staticmethod
-    def db_select(
-        selector=select(Snapshot),
-    ) -> SelectOfScalar[int] | SelectOfScalar[Snapshot]:
-        return (
-            selector.join(Molecule)
-            .where(Molecule.total_charge == 0)
-            .where(Molecule.total_multiplicity == 1)
-        )
+    dataset_name = "qm9star_neutral"
+    snapshot_filter = charge_multiplicity_filter(0, 1)
 
 
 class CationQM9starDataset(BaseQM9starDataset):
-    def __init__(
-        self,
-        root=os.path.curdir,
-        user="hxchem",
-        password="hxchem",
-        server="127.0.0.1",
-        port=5432,
-        db="qm9star",
-        dataset_name="qm9star_cation",
-        block_num=5,
-        transform=transform_data,
-        pre_transform=None,
-        pre_filter=None,
-        selector_func: Callable = None,
-        log=False,
-    ):
-        super().__init__(
-            root=root,
-            user=user,
-            password=password,
-            server=server,
-            port=port,
-            db=db,
-            dataset_name=dataset_name,
-            block_num=block_num,
-            transform=transform,
-            pre_transform=pre_transform,
-            pre_filter=pre_filter,
-            selector_func=selector_func,
-            log=log,
-        )
-
-    @staticmethod
-    def db_select(
-        selector=select(Snapshot),
-    ) -> SelectOfScalar[int] | SelectOfScalar[Snapshot]:
-        return (
-            selector.join(Molecule)
-            .where(Molecule.total_charge == 1)
-            .where(Molecule.total_multiplicity == 1)
-        )
+    dataset_name = "qm9star_cation"
+    snapshot_filter = charge_multiplicity_filter(1, 1)
 
 
 class AnionQM9starDataset(BaseQM9starDataset):
-    def __init__(
-        self,
-        root=os.path.curdir,
-        user="hxchem",
-        password="hxchem",
-        server="127.0.0.1",
-        port=5432,
-        db="qm9star",
-        dataset_name="qm9star_anion",
-        block_num=5,
-        transform=transform_data,
-        pre_transform=None,
-        pre_filter=None,
-        selector_func: Callable = None,
-        log=False,
-    ):
-        super().__init__(
-            root=root,
-            user=user,
-            password=password,
-            server=server,
-            port=port,
-            db=db,
-            dataset_name=dataset_name,
-            block_num=block_num,
-            transform=transform,
-            pre_transform=pre_transform,
-            pre_filter=pre_filter,
-            selector_func=selector_func,
-            log=log,
-        )
-
-    @staticmethod
-    def db_select(
-        selector=select(Snapshot),
-    ) -> SelectOfScalar[int] | SelectOfScalar[Snapshot]:
-        return (
-            selector.join(Molecule)
-            .where(Molecule.total_charge == -1)
-            .where(Molecule.total_multiplicity == 1)
-        )
+    dataset_name = "qm9star_anion"
+    snapshot_filter = charge_multiplicity_filter(-1, 1)
 
 
 class RadicalQM9starDataset(BaseQM9starDataset):
-    def __init__(
-        self,
-        root=os.path.curdir,
-        user="hxchem",
-        password="hxchem",
-        server="127.0.0.1",
-        port=5432,
-        db="qm9star",
-        dataset_name="qm9star_radical",
-        block_num=5,
-        transform=transform_data,
-        pre_transform=None,
-        pre_filter=None,
-        selector_func: Callable = None,
-        log=False,
-    ):
-        super().__init__(
-            root=root,
-            user=user,
-            password=password,
-            server=server,
-            port=port,
-            db=db,
-            dataset_name=dataset_name,
-            block_num=block_num,
-            transform=transform,
-            pre_transform=pre_transform,
-            pre_filter=pre_filter,
-            selector_func=selector_func,
-            log=log,
-        )
-
-    @staticmethod
-    def db_select(
-        selector=select(Snapshot),
-    ) -> SelectOfScalar[int] | SelectOfScalar[Snapshot]:
-        return (
-            selector.join(Molecule)
-            .where(Molecule.total_charge == 0)
-            .where(Molecule.total_multiplicity == 2)
-        )
+    dataset_name = "qm9star_radical"
+    snapshot_filter = charge_multiplicity_filter(0, 2)
@@ -0,0 +1,112 @@
+"""
+Precomputed neighbour lists and DimeNet++ triplets.
+
+`DimeNetPPCM` builds, for every batch, the radius graph of the atoms and the
+triplets `k -> j -> i` of that graph (`radius_graph` and `xyz_to_dat`). Both only
+depend on which atoms are within `cutoff` of each other, so for a dataset they can be
+computed once, by the `DimeNetTopology` pre-transform, and stored with the processed
+chunks. A model built with `DimeNetPPCM(cached_topology=True)` then reads them from the
+batch and only computes the distances and angles (`topology_geometry`), which keeps
+the gradients with respect to the positions.
+
+```python
+dataset = NeutralQM9starDataset(pre_transform=DimeNetTopology(cutoff=5.0))
+model = DimeNetPPCM(cutoff=5.0, cached_topology=True)
+```
+"""
+
+import torch
+from torch import Tensor
+from torch_geometric.data import Data
+from torch_geometric.transforms import BaseTransform
+
+
+class TopologyData(Data):
+    """
+    A `Data` with a cached topology: `edge_index` (`j -> i`, the nodes of the
+    graph) and the triplets `idx_kj`, `idx_ji` (the edges `k -> j` and `j -> i` of each
+    triplet), which index the edges so are shifted by the number of edges of the
+    previous graphs when batched.
+    """
+
+    def __inc__(self, key: str, value, *args, **kwargs):
+        if key in ("idx_kj", "idx_ji"):
+            return self.edge_index.size(1)
+        return super().__inc__(key, value, *args, **kwargs)
+
+
+def radius_edges(pos: Tensor, cutoff: float) -> Tensor:
+    """
+    The edges `j -> i` between the distinct atoms of one molecule closer than
+    `cutoff`, ordered by `i` then `j`.
+
+    The same edges as `radius_graph(pos, r=cutoff)`, except that the neighbours are
+    not capped at its `max_num_neighbors=32` (which no QM9star molecule reaches).
+    """
+    dist = torch.cdist(pos, pos)
+    within = dist < cutoff
+    within.fill_diagonal_(False)
+    i, j = within.nonzero(as_tuple=True)
+    return torch.stack([j, i])
+
+
+def triplet_indices(edge_index: Tensor, num_nodes: int) -> tuple[Tensor, Tensor]:
+    """
+    The triplets `k -> j -> i` (`k != i`) of a graph as `(idx_kj, idx_ji)`, the edges
+    `k -> j` and `j -> i` of each, in the order of `xyz_to_dat`: by edge `j -> i`,
+    then by `k`.
+    """
+    j, i = edge_index
+    num_edges = edge_index.size(1)
+    # the edges into each node, ordered by source
+    incoming = torch.argsort(i * num_nodes + j)
+    in_degree = torch.bincount(i, minlength=num_nodes)
+    in_start = torch.cumsum(in_degree, 0) - in_degree
+    # every edge j -> i pairs with every edge into j
+    num_triplets = in_degree[j]
+    idx_ji = torch.arange(num_edges).repeat_interleave(num_triplets)
+    triplet_start = torch.cumsum(num_triplets, 0) - num_triplets
+    rank = torch.arange(len(idx_ji)) - triplet_start.repeat_interleave(num_triplets)
+    idx_kj = incoming[in_start[j].repeat_interleave(num_triplets) + rank]
+    distinct = j[idx_kj] != i[idx_ji]
+    return idx_kj[distinct], idx_ji[distinct]
+
+
+def topology_geometry(
+    pos: Tensor, edge_index: Tensor, idx_kj: Tensor, idx_ji: Tensor
+) -> tuple[Tensor, Tensor, Tensor, Tensor]:
+    """
+    The `dist, angle, i, j` of `xyz_to_dat` from a cached topology: the length of each
+    edge `j -> i` and the angle between `j -> i` and `j -> k` of each triplet.
+    """
+    j, i = edge_index
+    dist = (pos[i] - pos[j]).pow(2).sum(dim=-1).sqrt()
+    pos_j = pos[j[idx_ji]]
+    pos_ji = pos[i[idx_ji]] - pos_j
+    pos_jk = pos[j[idx_kj]] - pos_j
+    a = (pos_ji * pos_jk).sum(dim=-1)
+    b = torch.cross(pos_ji, pos_jk, dim=-1).norm(dim=-1)
+    angle = torch.atan2(b, a)
+    return dist, angle, i, j
+
+
+class DimeNetTopology(BaseTransform):
+    """
+    Pre-transform storing the radius graph at `cutoff` and its triplets with each
+    molecule, as a `TopologyData`, for `DimeNetPPCM(cached_topology=True)`.
+
+    `cutoff` must be the model's: the cached graph is used as is.
+    """
+
+    def __init__(self, cutoff: float = 5.0):
+        self.cutoff = cutoff
+
+    def forward(self, data: Data) -> TopologyData:
+        edge_index = radius_edges(data.pos, self.cutoff)
+        idx_kj, idx_ji = triplet_indices(edge_index, data.num_nodes)
+        return TopologyData(
+            **data.to_dict(), edge_index=edge_index, idx_kj=idx_kj, idx_ji=idx_ji
+        )
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(cutoff={self.cutoff})"
@@ -0,0 +1,244 @@
+"""
+In-process fingerprint similarity search for bulk screening.
+
+`FingerprintIndex` loads every molecule id and its packed 1024-bit fingerprint once,
+then answers batched top-k queries with vectorized popcounts, instead of one vector
+scan in PostgreSQL per query SMILES:
+
+```python
+index = FingerprintIndex.from_session(session, method="morgan", cache_dir="fp_cache")
+ids, scores = index.search(smiles_list, k=5)
+molecules = index.hydrate(session, ids[0])
+```
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Sequence
+
+import numpy as np
+from sqlmodel import Session, func, select
+
+from qm9star_query.crud import molecules_crud
+from qm9star_query.models import Molecule, MoleculeFingerprint
+from qm9star_query.models.molecule import fingerprint_columns
+from qm9star_query.utils import smi_to_embedding
+
+FP_BITS = 1024
+FP_WORDS = FP_BITS // 64
+
+if hasattr(np, "bitwise_count"):
+
+    def popcount(words: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def popcount(words: np.ndarray) -> np.ndarray:
+        return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+
+def pack_fingerprint(bits) -> np.ndarray:
+    """
+    Pack a 0/1 sequence, a pgvector bit string or a float vector into 16 uint64 words.
+    """
+    if isinstance(bits, str):
+        bits = np.frombuffer(bits.encode("ascii"), dtype=np.uint8) - ord("0")
+    return np.packbits(np.asarray(bits) > 0, bitorder="little").view(np.uint64)
+
+
+class FingerprintIndex:
+    def __init__(
+        self,
+        ids: np.ndarray,
+        fingerprints: np.ndarray,
+        method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+        block_size: int = 65536,
+    ):
+        """
+        Args:
+            ids: `Molecule` ids sorted ascending, shape `(n,)`.
+            fingerprints: packed fingerprints, shape `(n, 16)` of uint64.
+            method: the fingerprint method used to embed query SMILES.
+            block_size: database rows scored at once, bounds the scratch memory.
+        """
+        self.ids = ids
+        self.fingerprints = fingerprints
+        self.method = method
+        self.block_size = block_size
+        self.counts = np.concatenate(
+            [
+                popcount(fingerprints[start : start + block_size])
+                for start in range(0, len(fingerprints), block_size)
+            ]
+            or [np.zeros(0, dtype=np.int32)]
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def cache_paths(cache_dir: str, method: str) -> tuple[str, str]:
+        return (
+            os.path.join(cache_dir, f"{method}_ids.npy"),
+            os.path.join(cache_dir, f"{method}_fingerprints.npy"),
+        )
+
+    @classmethod
+    def from_session(
+        cls,
+        session: Session,
+        method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+        cache_dir: str | None = None,
+        mmap: bool = True,
+        batch_size: int = 50000,
+    ) -> "FingerprintIndex":
+        """
+        Load the index from `cache_dir` if present, otherwise from the database.
+
+        The compact `moleculefingerprint` bit table is used when it holds every
+        molecule, the `molecule` vector column otherwise (e.g. when molecules were
+        added since `qm9star-migrate-bit-fp` last ran).
+        """
+        if cache_dir is not None:
+            ids_path, fps_path = cls.cache_paths(cache_dir, method)
+            if os.path.exists(ids_path) and os.path.exists(fps_path):
+                return cls.load(cache_dir, method, mmap=mmap)
+
+        column_name = fingerprint_columns[method]
+        has_bits = session.exec(
+            select(func.to_regclass(MoleculeFingerprint.__tablename__).is_not(None))
+        ).one()
+        if has_bits:
+            bit_count = session.exec(
+                select(func.count(MoleculeFingerprint.molecule_id))
+            ).one()
+            molecule_count = session.exec(select(func.count(Molecule.id))).one()
+            has_bits = 0 < bit_count == molecule_count
+        table = MoleculeFingerprint if has_bits else Molecule
+        id_column = MoleculeFingerprint.molecule_id if has_bits else Molecule.id
+        total = session.exec(select(func.count(id_column))).one()
+        ids = np.empty(total, dtype=np.int64)
+        fingerprints = np.empty((total, FP_WORDS), dtype=np.uint64)
+        rows = session.exec(
+            select(id_column, getattr(table, column_name))
+            .order_by(id_column)
+            .execution_options(yield_per=batch_size)
+        )
+        n = 0
+        for molecule_id, fingerprint in rows:
+            if n == total:
+                break
+            ids[n] = molecule_id
+            fingerprints[n] = pack_fingerprint(fingerprint)
+            n += 1
+        index = cls(ids[:n], fingerprints[:n], method=method)
+        if cache_dir is not None:
+            index.save(cache_dir)
+            if mmap:
+                return cls.load(cache_dir, method, mmap=True)
+        return index
+
+    @classmethod
+    def load(
+        cls,
+        cache_dir: str,
+        method: Literal["morgan", "rdk", "atompair", "torsion"] = "morgan",
+        mmap: bool = True,
+    ) -> "FingerprintIndex":
+        ids_path, fps_path = cls.cache_paths(cache_dir, method)
+        mmap_mode = "r" if mmap else None
+        return cls(
+            np.load(ids_path, mmap_mode=mmap_mode),
+            np.load(fps_path, mmap_mode=mmap_mode),
+            method=method,
+        )
+
+    def save(self, cache_dir: str) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        ids_path, fps_path = self.cache_paths(cache_dir, self.method)
+        np.save(ids_path, np.ascontiguousarray(self.ids))
+        np.save(fps_path, np.ascontiguousarray(self.fingerprints))
+
+    def embed(self, smiles_list: Sequence[str]) -> np.ndarray:
+        return np.stack(
+            [
+                pack_fingerprint(smi_to_embedding(smiles, self.method))
+                for smiles in smiles_list
+            ]
+        )
+
+    def _scores(
+        self, query: np.ndarray, metric: Literal["tanimoto", "cosine"]
+    ) -> np.ndarray:
+        query_count = popcount(query)
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            stop = start + self.block_size
+            common = popcount(self.fingerprints[start:stop] & query)
+            counts = self.counts[start:stop]
+            if metric == "tanimoto":
+                denominator = counts + query_count - common
+            elif metric == "cosine":
+                denominator = np.sqrt(counts.astype(np.float32) * query_count)
+            else:
+                raise ValueError("Invalid metric")
+            with np.errstate(divide="ignore", invalid="ignore"):
+                block = common / denominator
+            scores[start:stop] = np.where(denominator > 0, block, 0.0)
+        return scores
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        # exact top-k; ties are broken by ascending id like `ORDER BY distance, id`
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        if k < len(scores):
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+            rows = np.flatnonzero(scores >= kth)
+        else:
+            rows = np.arange(len(scores))
+        return rows[np.lexsort((rows, -scores[rows]))][:k]
+
+    def search(
+        self,
+        queries: Sequence[str] | np.ndarray,
+        k: int = 5,
+        metric: Literal["tanimoto", "cosine"] = "tanimoto",
+        n_threads: int | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the `k` most similar molecules for every query.
+
+        Args:
+            queries: SMILES strings, or fingerprints already packed by `pack_fingerprint`.
+            k: number of neighbours per query.
+            metric: `tanimoto` or binary `cosine` similarity.
+            n_threads: worker threads, numpy releases the GIL while scoring.
+
+        Returns:
+            `(ids, scores)`, both of shape `(len(queries), min(k, len(self)))`, most
+            similar first. Scores are similarities, i.e. `1 - distance`.
+        """
+        if len(queries) and isinstance(queries[0], str):
+            queries = self.embed(queries)
+        queries = np.asarray(queries, dtype=np.uint64).reshape(-1, FP_WORDS)
+        k = max(0, min(k, len(self)))
+
+        def search_one(query: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            scores = self._scores(query, metric)
+            rows = self._top_k(scores, k)
+            return self.ids[rows], scores[rows]
+
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            results = list(executor.map(search_one, queries))
+        if not results:
+            return np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+        ids, scores = zip(*results)
+        return np.stack(ids), np.stack(scores)
+
+    @staticmethod
+    def hydrate(session: Session, ids: Sequence[int]) -> Sequence[Molecule]:
+        return molecules_crud.get_molecules_by_ids(
+            session=session, molecule_ids=[int(i) for i in ids]
+        )
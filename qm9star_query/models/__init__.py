@@ -10,8 +10,8 @@ from datetime import datetime
 
 from qm9star_query.models.user import UserBase
 from qm9star_query.models.formula import FormulaBase
-from qm9star_query.models.molecule import MoleculeBase
-from qm9star_query.models.snapshot import SnapshotBase
+from qm9star_query.models.molecule import MoleculeBase, MoleculeFingerprintBase
+from qm9star_query.models.snapshot import SnapshotBase, SnapshotSDFBase
 from sqlalchemy import ARRAY, Column, Integer
 from sqlmodel import Field, Relationship
 
@@ -46,6 +46,10 @@ class Molecule(MoleculeBase, table=True):
     formula: Formula = Relationship(back_populates="molecules")
 
 
+class MoleculeFingerprint(MoleculeFingerprintBase, table=True):
+    molecule_id: int = Field(primary_key=True, foreign_key="molecule.id")
+
+
 class Snapshot(SnapshotBase, table=True):
     id: int | None = Field(default=None, primary_key=True)
     hash_token: str | None = Field(default=None, unique=True, index=True)
@@ -58,3 +62,7 @@ class Snapshot(SnapshotBase, table=True):
 
     molecule_id: int = Field(default=None, foreign_key="molecule.id")
     molecule: Molecule = Relationship(back_populates="snapshots")
+
+
+class SnapshotSDF(SnapshotSDFBase, table=True):
+    hash_token: str = Field(primary_key=True)
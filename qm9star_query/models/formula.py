@@ -144,3 +144,7 @@ class FormulaOut(SQLModel):
 class FormulasOut(SQLModel):
     count: int = Field(description="The count of formulas")
     data: List[FormulaOut] = Field(description="The list of formulas")
+    next_cursor: str | None = Field(
+        default=None,
+        description="Pass as `cursor` to fetch the next page, `None` on the last page",
+    )
@@ -1,12 +1,20 @@
 from datetime import datetime
 from typing import List
 
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import BIT, Vector
 from sqlalchemy import Column
 from sqlmodel import Field, SQLModel
 
 from qm9star_query.models.formula import FormulaOut
 
+# fingerprint method -> `Molecule` vector column
+fingerprint_columns = {
+    "morgan": "morgan_fp3_1024",
+    "rdk": "rdkit_fp_1024",
+    "atompair": "atompair_fp_1024",
+    "torsion": "topological_torsion_fp_1024",
+}
+
 
 class MoleculeBase(SQLModel):
     # Topological properties of the molecule
@@ -27,6 +35,14 @@ class MoleculeBase(SQLModel):
     topological_torsion_fp_1024: List[int] = Field(sa_column=Column(Vector(1024)))
 
 
+class MoleculeFingerprintBase(SQLModel):
+    # bit(1024) copies of the `MoleculeBase` vectors, 128 bytes each instead of 4 KB
+    morgan_fp3_1024: str = Field(sa_column=Column(BIT(1024)))
+    rdkit_fp_1024: str = Field(sa_column=Column(BIT(1024)))
+    atompair_fp_1024: str = Field(sa_column=Column(BIT(1024)))
+    topological_torsion_fp_1024: str = Field(sa_column=Column(BIT(1024)))
+
+
 class MoleculeOut(SQLModel):
     id: int
     smiles: str = Field(description="The SMILES string of the molecule")
@@ -64,3 +80,22 @@ class MoleculesOut(SQLModel):
     data: list[MoleculeOut] = Field(
         description="The list of `Molecule` objects in the query result"
     )
+    next_cursor: str | None = Field(
+        default=None,
+        description="Pass as `cursor` to fetch the next page, `None` on the last page",
+    )
+
+
+class MoleculeNeighboursOut(SQLModel):
+    smiles: str = Field(description="The query SMILES string")
+    count: int = Field(description="The count of molecules found for this SMILES")
+    data: list[MoleculeOut] = Field(
+        description="The most similar `Molecule` objects, closest first"
+    )
+
+
+class MoleculesBatchOut(SQLModel):
+    count: int = Field(description="The count of query SMILES")
+    results: list[MoleculeNeighboursOut] = Field(
+        description="The neighbours of every query SMILES, in query order"
+    )
@@ -1,7 +1,7 @@
 from datetime import datetime
 from typing import List
 
-from sqlalchemy import ARRAY, Column, Float, Integer
+from sqlalchemy import ARRAY, Column, Float, Integer, Text
 from sqlmodel import Field, SQLModel
 
 from qm9star_query.models.molecule import MoleculeOut
@@ -249,6 +249,12 @@ class SnapshotOut(SnapshotBase):
     molecule: MoleculeOut = Field(description="The molecule this snapshot belongs to")
 
 
+class SnapshotSDFBase(SQLModel):
+    # MolBlock rendered from the snapshot geometry, shared by every snapshot whose
+    # `hash_token` (and therefore geometry) is the same
+    sdf_block: str = Field(sa_column=Column(Text))
+
+
 class SnapshotSDFOut(SQLModel):
     smiles: str = Field(description="The SMILES string of the snapshot")
     sdf_block: str = Field(description="The 3D SDF block of the snapshot")
@@ -257,3 +263,7 @@ class SnapshotSDFOut(SQLModel):
 class SnapshotsOut(SQLModel):
     count: int = Field(description="The count of snapshots")
     snapshots: List[SnapshotOut] = Field(description="The list of snapshots")
+    next_cursor: str | None = Field(
+        default=None,
+        description="Pass as `cursor` to fetch the next page, `None` on the last page",
+    )
@@ -75,8 +75,17 @@ class MoleculeFilter(SQLModel):
     method: Literal["morgan", "rdk", "atompair", "torsion"] = Field(
         description="fingerprint method", default="morgan"
     )
-    distance: Literal["l2", "inner_product", "cosine"] = Field(
-        description="distance metric", default="cosine"
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"] = Field(
+        description="distance metric, `tanimoto` and `hamming` search the bit fingerprints",
+        default="cosine",
+    )
+    ef_search: int | None = Field(
+        description="HNSW candidate list size for the vector search, larger is more accurate but slower",
+        default=None,
+    )
+    probes: int | None = Field(
+        description="number of IVFFlat lists scanned by the vector search, larger is more accurate but slower",
+        default=None,
     )
     numeric_filters: List[NumericFilter] = Field(
         description="list of `NumericFilter`, default is empty", default_factory=list
@@ -86,6 +95,30 @@ class MoleculeFilter(SQLModel):
     )
 
 
+class MoleculeSmilesBatch(SQLModel):
+    smiles: List[str] = Field(
+        description="SMILES strings to search, at most 1000", max_length=1000
+    )
+    method: Literal["morgan", "rdk", "atompair", "torsion"] = Field(
+        description="fingerprint method", default="morgan"
+    )
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"] = Field(
+        description="distance metric, `tanimoto` and `hamming` search the bit fingerprints",
+        default="cosine",
+    )
+    limit: int = Field(
+        description="number of neighbours per SMILES, 1 to 100", default=5, ge=1, le=100
+    )
+    ef_search: int | None = Field(
+        description="HNSW candidate list size for the vector search, larger is more accurate but slower",
+        default=None,
+    )
+    probes: int | None = Field(
+        description="number of IVFFlat lists scanned by the vector search, larger is more accurate but slower",
+        default=None,
+    )
+
+
 class ClassFilter(SQLModel):
     column: Literal[
         "filename",
@@ -129,10 +162,45 @@ class SnapshotFilter(SQLModel):
     method: Literal["morgan", "rdk", "atompair", "torsion"] = Field(
         description="fingerprint method", default="morgan"
     )
-    distance: Literal["l2", "inner_product", "cosine"] = Field(
-        description="distance metric", default="cosine"
+    distance: Literal["l2", "inner_product", "cosine", "tanimoto", "hamming"] = Field(
+        description="distance metric, `tanimoto` and `hamming` search the bit fingerprints",
+        default="cosine",
+    )
+    ef_search: int | None = Field(
+        description="HNSW candidate list size for the vector search, larger is more accurate but slower",
+        default=None,
+    )
+    probes: int | None = Field(
+        description="number of IVFFlat lists scanned by the vector search, larger is more accurate but slower",
+        default=None,
     )
 
 
 class ItemCount(SQLModel):
     count: int = Field(description="number of items")
+    estimated: bool = Field(
+        description="whether `count` is the planner estimate rather than an exact count",
+        default=False,
+    )
+
+
+class PoolStatus(SQLModel):
+    size: int = Field(description="connections kept open by the pool")
+    checked_in: int = Field(description="idle connections")
+    checked_out: int = Field(description="connections in use")
+    overflow: int = Field(description="connections opened beyond the pool size")
+
+
+class PoolsStatus(SQLModel):
+    sync_engine: PoolStatus = Field(description="pool of the sync engine (export)")
+    async_engine: PoolStatus = Field(description="pool of the async engine (queries)")
+
+
+class ResultCacheStats(SQLModel):
+    backend: str | None = Field(description="cache backend, `None` when disabled")
+    hits: int = Field(description="pages served from the cache", default=0)
+    misses: int = Field(description="pages not found in the cache", default=0)
+    evictions: int = Field(description="pages evicted for size", default=0)
+    entries: int = Field(description="pages cached", default=0)
+    bytes: int = Field(description="size of the cached pages", default=0)
+    max_bytes: int = Field(description="size limit of the cache", default=0)
@@ -4,6 +4,8 @@ try:
     from torch_geometric.data import Data
     from torch_scatter import scatter
     from torch.autograd import grad
+
+    from qm9star_query.dataset.topology import topology_geometry
 except Exception as e:
     raise ImportError(
         """
@@ -38,6 +40,7 @@ class DimeNetPPCM(torch.nn.Module):
         num_output_layers (int, optional): Number of linear layers for the output blocks. (default: :obj:`3`)
         act: (function, optional): The activation funtion. (default: :obj:`swish`)
         output_init: (str, optional): The initialization fot the output. It could be :obj:`GlorotOrthogonal` and :obj:`zeros`. (default: :obj:`GlorotOrthogonal`)
+        cached_topology (bool, optional): If set to :obj:`True`, will read the radius graph and its triplets (:obj:`edge_index`, :obj:`idx_kj`, :obj:`idx_ji`) from the batch, as stored by the :obj:`DimeNetTopology` pre-transform at the same :obj:`cutoff`, instead of computing them for every batch. (default: :obj:`False`)
     """
 
     def __init__(
@@ -59,12 +62,14 @@ class DimeNetPPCM(torch.nn.Module):
         act=swish,
         output_init="GlorotOrthogonal",
         ret_res_dict=False,
+        cached_topology=False,
     ):
         super(DimeNetPPCM, self).__init__()
 
         self.cutoff = cutoff
         self.energy_and_force = energy_and_force
         self.ret_res_dict = ret_res_dict
+        self.cached_topology = cached_topology
         self.init_ez = init(num_radial, hidden_channels, act)
         self.init_ec = init(num_radial, hidden_channels, act)
         self.init_em = init(num_radial, hidden_channels, act)
@@ -144,11 +149,17 @@ class DimeNetPPCM(torch.nn.Module):
 
         if self.energy_and_force:
             pos.requires_grad_()
-        edge_index = radius_graph(pos, r=self.cutoff, batch=batch)
-        num_nodes = z.size(0)
-        dist, angle, i, j, idx_kj, idx_ji = xyz_to_dat(
-            pos, edge_index, num_nodes, use_torsion=False
-        )
+        if self.cached_topology:
+            idx_kj, idx_ji = batch_data["idx_kj"], batch_data["idx_ji"]
+            dist, angle, i, j = topology_geometry(
+                pos, batch_data["edge_index"], idx_kj, idx_ji
+            )
+        else:
+            edge_index = radius_graph(pos, r=self.cutoff, batch=batch)
+            num_nodes = z.size(0)
+            dist, angle, i, j, idx_kj, idx_ji = xyz_to_dat(
+                pos, edge_index, num_nodes, use_torsion=False
+            )
 
         emb = self.emb(dist, angle, idx_kj)
 
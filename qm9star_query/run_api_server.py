@@ -1,8 +1,10 @@
 from qm9star_query.api.main import api_router
 from qm9star_query.core.config import settings
 from qm9star_query.core.db import engine, init_db
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.routing import APIRoute
+from sqlalchemy.exc import OperationalError
 from sqlmodel import Session
 from starlette.middleware.cors import CORSMiddleware
 
@@ -14,6 +16,9 @@ def custom_generate_unique_id(route: APIRoute) -> str:
 with Session(engine) as session:
     init_db(session)
 
+# SQLSTATE of a statement cancelled by `statement_timeout`
+QUERY_CANCELED = "57014"
+
 description = """
 This is a RESTful API for querying QM9* dataset, whose original paper is 
 _"[QM9star, two million DFT-computed equilibrium structures for ions and radicals with atomic information](https://www.nature.com/articles/s41597-024-03933-6)"_.
@@ -71,4 +76,16 @@ if settings.BACKEND_CORS_ORIGINS:
         allow_headers=["*"],
     )
 
-app.include_router(api_router, prefix=settings.API_V1_STR)
\ No newline at end of file
+app.include_router(api_router, prefix=settings.API_V1_STR)
+
+
+@app.exception_handler(OperationalError)
+async def statement_timeout_handler(request: Request, exc: OperationalError):
+    orig = exc.orig
+    sqlstate = getattr(orig, "sqlstate", None) or getattr(orig, "pgcode", None)
+    if sqlstate != QUERY_CANCELED:
+        raise exc
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Query exceeded the statement timeout, narrow it down"},
+    )
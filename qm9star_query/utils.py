@@ -5,9 +5,17 @@ LastEditors: TMJ
 LastEditTime: 2025-02-02 16:37:10
 Description: 请填写简介
 '''
+import asyncio
 import hashlib
-from typing import List, Literal
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Hashable, List, Literal, Sequence
 
+import numpy as np
 from rdkit import Chem
 from rdkit.Chem import AllChem
 
@@ -69,6 +77,63 @@ def smi_to_embedding(
         raise ValueError("Invalid method")
 
 
+_embedding_executor: ProcessPoolExecutor | None = None
+
+
+def get_embedding_executor(max_workers: int | None = None) -> ProcessPoolExecutor:
+    """
+    A process pool shared by the bulk RDKit helpers, created on first use.
+    """
+    global _embedding_executor
+    if _embedding_executor is None:
+        _embedding_executor = ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _embedding_executor
+
+
+_rdkit_executor: ThreadPoolExecutor | None = None
+
+
+def get_rdkit_executor(max_workers: int | None = None) -> ThreadPoolExecutor:
+    """
+    A bounded thread pool for RDKit calls made from async code, created on first use,
+    so that fingerprinting and SDF rendering never block the event loop.
+    """
+    global _rdkit_executor
+    if _rdkit_executor is None:
+        _rdkit_executor = ThreadPoolExecutor(
+            max_workers=max_workers or min(4, os.cpu_count() or 1),
+            thread_name_prefix="rdkit",
+        )
+    return _rdkit_executor
+
+
+async def run_rdkit(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        get_rdkit_executor(), partial(func, *args, **kwargs)
+    )
+
+
+def smis_to_embeddings(
+    smiles_list: Sequence[str],
+    method: Literal["morgan", "rdk", "atompair", "torsion"],
+    parallel_threshold: int = 64,
+) -> List[List[int]]:
+    """
+    Embed many SMILES, in the shared process pool once there are enough of them to
+    pay for the inter-process transfer.
+    """
+    if len(smiles_list) < parallel_threshold:
+        return [smi_to_embedding(smiles, method) for smiles in smiles_list]
+    chunksize = max(1, len(smiles_list) // (4 * (os.cpu_count() or 1)))
+    return list(
+        get_embedding_executor().map(
+            partial(smi_to_embedding, method=method), smiles_list, chunksize=chunksize
+        )
+    )
+
+
 def check_smi_equal(smi1: str, smi2: str):
     if smi1 == smi2:
         return True
@@ -103,26 +168,64 @@ def get_snapshot_hash_token(snapshot: Snapshot):
 
 
 def recover_rdmol(
-    coords: List[List[float]],
-    atoms: List[str],
-    bonds: List[List[int]],
-    formal_charges: List[int],
-    formal_num_radicals: List[int],
+    coords: List[List[float]] | np.ndarray,
+    atoms: List[str] | List[int] | np.ndarray,
+    bonds: List[List[int]] | np.ndarray,
+    formal_charges: List[int] | np.ndarray,
+    formal_num_radicals: List[int] | np.ndarray,
 ) -> Chem.Mol:
-    xyz_block = build_xyz(coords, atoms)
-    rdmol = Chem.RWMol(Chem.MolFromXYZBlock(xyz_block))
+    """
+    Build the molecule directly from the snapshot arrays (lists or NumPy arrays):
+    atoms and bonds are added to an `RWMol` and the coordinates copied into its
+    conformer in one call, without formatting and re-parsing an XYZ block.
+    """
+    rdmol = Chem.RWMol()
+    for atom, charge, spin in zip(atoms, formal_charges, formal_num_radicals):
+        rdatom = Chem.Atom(atom if isinstance(atom, str) else int(atom))
+        rdatom.SetFormalCharge(int(charge))
+        rdatom.SetNumRadicalElectrons(int(spin))
+        rdmol.AddAtom(rdatom)
     for bond_start, bond_end, bond_order in bonds:
-        rdmol.AddBond(bond_start, bond_end, bond_list[bond_order])
-    for atom, charge, spin in zip(
-        rdmol.GetAtoms(), formal_charges, formal_num_radicals
-    ):
-        atom.SetFormalCharge(charge)
-        atom.SetNumRadicalElectrons(spin)
+        rdmol.AddBond(int(bond_start), int(bond_end), bond_list[bond_order])
+    positions = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    conformer = Chem.Conformer(len(positions))
+    if hasattr(conformer, "SetPositions"):
+        conformer.SetPositions(positions)
+    else:
+        # older RDKit without `Conformer.SetPositions`
+        for index, position in enumerate(positions.tolist()):
+            conformer.SetAtomPosition(index, position)
+    conformer.Set3D(True)
+    rdmol.AddConformer(conformer, assignId=True)
     rdmol = rdmol.GetMol()
     Chem.SanitizeMol(rdmol)
     return rdmol
 
 
+def recover_rdmol_from_record(record: Sequence) -> Chem.Mol:
+    """
+    `recover_rdmol` of one row of `mol_block_columns`, mappable over a process pool.
+    """
+    return recover_rdmol(*record)
+
+
+def recover_rdmols(
+    records: Sequence[Sequence], parallel_threshold: int = 256
+) -> List[Chem.Mol]:
+    """
+    Rebuild many molecules from rows of `mol_block_columns`, in the shared process
+    pool once there are enough of them to pay for pickling the molecules back.
+    """
+    if len(records) < parallel_threshold:
+        return [recover_rdmol_from_record(record) for record in records]
+    chunksize = max(1, len(records) // (4 * (os.cpu_count() or 1)))
+    return list(
+        get_embedding_executor().map(
+            recover_rdmol_from_record, records, chunksize=chunksize
+        )
+    )
+
+
 def recover_rdmol_from_snapshot(snapshot: Snapshot) -> Chem.Mol:
     return recover_rdmol(
         coords=snapshot.coords,
@@ -133,6 +236,72 @@ def recover_rdmol_from_snapshot(snapshot: Snapshot) -> Chem.Mol:
     )
 
 
+# the `Snapshot` columns `recover_rdmol` needs, in the order of its arguments
+mol_block_columns = (
+    "coords",
+    "atoms",
+    "bonds",
+    "formal_charges",
+    "formal_num_radicals",
+)
+
+
+def mol_block_from_record(record: Sequence) -> str:
+    """
+    The MolBlock of one row of `mol_block_columns`; a plain function of plain values,
+    so it can be mapped over a process pool.
+    """
+    return Chem.MolToMolBlock(recover_rdmol_from_record(record))
+
+
+class MolBlockCache:
+    """
+    A thread-safe LRU of rendered MolBlocks, for the blocks that were not precomputed.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._blocks: OrderedDict[Hashable, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key: Hashable | None, render: Callable[[], str]) -> str:
+        if key is None or self.maxsize <= 0:
+            return render()
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                return block
+        # rendered outside the lock, a concurrent miss of the same key renders twice
+        block = render()
+        with self._lock:
+            self._blocks[key] = block
+            while len(self._blocks) > self.maxsize:
+                self._blocks.popitem(last=False)
+        return block
+
+
+mol_block_cache = MolBlockCache()
+
+
+def snapshot_to_mol_block(snapshot: Snapshot) -> str:
+    """
+    The 3D MolBlock of a snapshot, cached by `hash_token`.
+    """
+    return mol_block_cache.get_or_render(
+        ("snapshot", snapshot.hash_token) if snapshot.hash_token else None,
+        lambda: Chem.MolToMolBlock(recover_rdmol_from_snapshot(snapshot)),
+    )
+
+
+def smiles_to_mol_block(smiles: str) -> str:
+    """
+    The 2D MolBlock of a SMILES string, cached by the string.
+    """
+    return mol_block_cache.get_or_render(
+        ("smiles", smiles), lambda: Chem.MolToMolBlock(Chem.MolFromSmiles(smiles))
+    )
+
 
 def build_xyz(
     coords: List[List[float]],
@@ -158,6 +327,7 @@ def build_xyz_from_snapshot(snapshot: Snapshot):
         atoms=snapshot.atoms,
     )
 
+
 def smiles_to_formula_dict(smi: str):
     mol = Chem.AddHs(Chem.MolFromSmiles(smi))
     formula_dict = {element: 0 for element in elements_in_pt}